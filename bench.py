@@ -0,0 +1,185 @@
+"""End-to-end benchmark of the bot against in-memory Google Sheets and Telegram.
+
+Updates go through the real dispatcher (middlewares, handlers), and rows through the outbox,
+only Google and Telegram are faked (see telegrind.fakes), the database is the one at DATABASE_URL,
+so use a scratch one, e.g. the compose postgres service:
+
+    python bench.py --chats 20 --messages 10 --sheets-latency 0.3 --telegram-latency 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import statistics
+import time
+from collections import Counter
+from datetime import datetime
+from functools import partial
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.types import Update
+from dotenv import load_dotenv
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from telegrind import cache
+from telegrind.bot.records import mark_delivered
+from telegrind.bot.setup import setup_dispatcher
+from telegrind.debounce import Debouncer, Gatherer
+from telegrind.fakes import FakeClientManager, FakeSession, FakeFetcher, FakeRates
+from telegrind.index import RowIndex
+from telegrind.mirror import Mirror
+from telegrind.models import Model, Chat
+from telegrind.outbox import Outbox
+from telegrind.rates import Rates
+from telegrind.tickets import TicketLog
+from telegrind.startup import ensure_schema
+
+# far from real chat ids
+FIRST_CHAT_ID = -(10 ** 13)
+
+
+class Feeder:
+    """Makes up updates from chats and feeds them to the dispatcher, timing each."""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, **data):
+        self.dp = dp
+        self.bot = bot
+        self.data = data
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def message(self, chat_id: int, text: str, message_id: int | None = None, **extra) -> dict:
+        return dict(
+            message_id=message_id or next(self._message_ids),
+            date=int(time.time()),
+            chat=dict(id=chat_id, type="private"),
+            from_user=dict(id=chat_id, is_bot=False, first_name="Bench"),
+            text=text,
+            **extra,
+        )
+
+    async def feed(self, **event) -> float:
+        update = Update.model_validate(
+            dict(update_id=next(self._update_ids), **event), context={"bot": self.bot}
+        )
+        started = time.perf_counter()
+        await self.dp.feed_update(self.bot, update, **self.data)
+        return time.perf_counter() - started
+
+
+class Flow:
+    """Runs one kind of message for every chat, chats concurrently, messages of a chat in order."""
+
+    def __init__(self, name: str, feeder: Feeder, agcm: FakeClientManager, session: FakeSession):
+        self.name = name
+        self.feeder = feeder
+        self.agcm = agcm
+        self.apis = agcm.api, session.telegram
+        self.latencies: list[float] = []
+
+    async def run(self, chats: dict[int, list[dict]]):
+        before = [Counter(api.calls) for api in self.apis]
+        started = time.perf_counter()
+
+        async def chat(events: list[dict]):
+            for event in events:
+                self.latencies.append(await self.feeder.feed(**event))
+
+        await asyncio.gather(*(chat(events) for events in chats.values()))
+        # until the rows are in the sheets, as the background drainer would do
+        outbox = self.feeder.data["outbox"]
+        delivered = partial(mark_delivered, self.feeder.bot)
+        while (await outbox.drain(self.agcm, delivered))[0]:
+            pass
+        self.elapsed = time.perf_counter() - started
+        self.calls = [api.calls.total() - b.total() for api, b in zip(self.apis, before)]
+
+    def report(self) -> str:
+        n = len(self.latencies)
+        q = statistics.quantiles(self.latencies, n=100) if n > 1 else self.latencies * 99
+        sheets, telegram = (c / n for c in self.calls)
+        return (
+            f"{self.name:<8} {n:>6} {n / self.elapsed:>8.1f} "
+            f"{q[49] * 1000:>8.1f} {q[98] * 1000:>8.1f} {sheets:>8.2f} {telegram:>8.2f}"
+        )
+
+
+async def main(args: argparse.Namespace) -> None:
+    dp = setup_dispatcher()
+    engine = create_async_engine(os.environ["DATABASE_URL"], echo=False)
+    await ensure_schema(engine, Model.metadata)
+    async_session = async_sessionmaker(engine, expire_on_commit=False)
+
+    agcm = FakeClientManager(latency=args.sheets_latency)
+    session = FakeSession(latency=args.telegram_latency)
+    bot = Bot("42:BENCH", session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    index = RowIndex(async_session)
+    feeder = Feeder(
+        dp,
+        bot,
+        async_session=async_session,
+        agcm=agcm,
+        index=index,
+        outbox=Outbox(engine, async_session, index),
+        fetcher=FakeFetcher(),
+        tickets=TicketLog(async_session),
+        edits=Debouncer(args.edit_debounce),
+        forwards=Gatherer(2),
+        mirror=Mirror(async_session),
+        rates=Rates(async_session, FakeRates()),
+        ai=None,
+    )
+
+    chat_ids = [FIRST_CHAT_ID - i for i in range(args.chats)]
+    async with async_session() as s, s.begin():
+        await s.execute(
+            insert(Chat)
+            .values([dict(chat_id=c, sheet_url=f"https://fake/{c}") for c in chat_ids])
+            .on_conflict_do_nothing(index_elements=[Chat.chat_id])
+        )
+
+    sent = {c: [feeder.message(c, f"{100 + i} кофе #еда вчера") for i in range(args.messages)] for c in chat_ids}
+    flows = [
+        ("record", {c: [dict(message=m) for m in msgs] for c, msgs in sent.items()}),
+        ("edit", {
+            c: [dict(edited_message=dict(m, text=f"2{m['text']}", edit_date=int(time.time()))) for m in msgs]
+            for c, msgs in sent.items()
+        }),
+        ("delete", {
+            c: [dict(message=feeder.message(c, "-", reply_to_message=m)) for m in msgs]
+            for c, msgs in sent.items()
+        }),
+        ("ticket", {
+            c: [
+                dict(message=feeder.message(c, f"http://consumer.oofd.kz?i={c}{i}&f=1&s=300&t=20240312T101500"))
+                for i in range(args.messages)
+            ]
+            for c in chat_ids
+        }),
+    ]
+
+    print(f"{args.chats} chats x {args.messages} messages, {datetime.now():%d.%m.%y %H:%M}")
+    print(f"{'flow':<8} {'msgs':>6} {'msg/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'sheets':>8} {'telegram':>8}")
+    for name, chats in flows:
+        flow = Flow(name, feeder, agcm, session)
+        await flow.run(chats)
+        print(flow.report())
+    print("sheets calls:", dict(agcm.api.calls))
+    print("cache stats:", cache.stats())
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=10, help="messages per chat and flow")
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="seconds per Sheets API call")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="seconds per Bot API call")
+    parser.add_argument("--edit-debounce", type=float, default=2, help="seconds to wait for more edits")
+    load_dotenv()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
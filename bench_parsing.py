@@ -0,0 +1,146 @@
+"""Throughput of message parsing, from text to sheet row, without any I/O.
+
+The corpus is made up of the forms advertised in the bot's tips, with random amounts,
+currencies, dates, comments and categories, plus some chatter that is not a record:
+
+    python bench_parsing.py --messages 100000
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from aiogram.types import Message
+from dateparser.search import search_dates
+
+from telegrind.dates import dateparser_settings, search_date
+from telegrind.fakes import FakeClientManager
+from telegrind.parsing import classify
+from telegrind.sheets import Outcome, Loan, Wish
+
+COMMENTS = ["", "кофе", "шоколадка", "хостинг", "обед с коллегами", "такси до дома", "продукты", "подарок маме"]
+CATEGORIES = ["еда", "транспорт", "дом", "связь", "подарки"]
+DATES = ["", "вчера", "позавчера", "2 часа назад", "три дня назад", "1 января", "15.03.24", "в 14:30", "сегодня в 9:15"]
+# dateparser reads these wrong, see telegrind/dates.py
+DIVERGENT = {"1 января", "15.03.24", "сегодня в 9:15"}
+NAMES = ["Вася Пупкин", "Петя", "Маша", "Иван Иванович"]
+CHATTER = [
+    "привет", "спасибо!", "что ты умеешь?", "/report", "ок",
+    "http://consumer.oofd.kz?i=123&f=1&s=300&t=20240312T101500",
+]
+
+
+def amount(rng: random.Random) -> str:
+    value = rng.choice([rng.randint(1, 50_000), round(rng.uniform(1, 500), 2)])
+    return str(value).replace(".", rng.choice([".", ","]))
+
+
+def outcome(rng: random.Random) -> str:
+    parts = [amount(rng)]
+    if rng.random() < 0.2:
+        parts.append(rng.choice(["USD", "EUR", "rub"]))
+    parts += [rng.choice(DATES), rng.choice(COMMENTS)]
+    rng.shuffle(parts[-2:])
+    if rng.random() < 0.3:
+        parts.append("#" + rng.choice(CATEGORIES))
+    return " ".join(p for p in parts if p)
+
+
+def loan(rng: random.Random) -> str:
+    parts = [rng.choice(["займ", "заём", "долг"]), rng.choice(NAMES), rng.choice(["", "+", "-"]) + amount(rng)]
+    if rng.random() < 0.3:
+        parts.append("USD")
+    if rng.random() < 0.3:
+        parts.append(f"{rng.randint(1, 28):02}.{rng.randint(1, 12):02}.2024")
+    parts.append(rng.choice(COMMENTS))
+    return " ".join(p for p in parts if p)
+
+
+def wish(rng: random.Random) -> str:
+    return f"{rng.choice(['хочу', 'Хочу'])} {rng.choice(COMMENTS) or 'велосипед'}"
+
+
+def corpus(n: int, seed: int = 42) -> list[str]:
+    """Mostly expenses, as in real chats."""
+    rng = random.Random(seed)
+    kinds = rng.choices([outcome, loan, wish, lambda r: r.choice(CHATTER)], weights=[80, 8, 4, 8], k=n)
+    return [kind(rng) for kind in kinds]
+
+
+def minute(date: datetime) -> datetime:
+    return date.replace(second=0, microsecond=0)
+
+
+def agrees(text: str, ours: tuple[str, datetime] | None, theirs: list[tuple[str, datetime]] | None) -> bool:
+    """Whether the grammar found the date dateparser did, the known divergences aside."""
+    if any(d in text for d in DIVERGENT):
+        return True
+    for found, date in theirs or []:
+        if ours and (found.startswith(ours[0]) or ours[0].endswith(found)):
+            return minute(date) == minute(ours[1])
+        if not found[0].isdigit():
+            return False
+        # dateparser takes amounts for dates too, or for a part of the date after them
+        if ours and ours[0] in found:
+            return True
+    return ours is None
+
+
+def rate(n: int, started: float) -> str:
+    return f"{n / (time.perf_counter() - started):>12,.0f} msg/s"
+
+
+async def main(args: argparse.Namespace) -> None:
+    texts = corpus(args.messages)
+    print(f"{len(texts)} messages:", dict(Counter(p.kind if p else None for p in map(classify, texts))))
+
+    # uncached, as for new messages
+    started = time.perf_counter()
+    for text in texts:
+        classify.__wrapped__(text)
+    print(f"{'classify':<10}", rate(len(texts), started))
+
+    # as the router does it, every record handler's filter asks in turn
+    classify.cache_clear()
+    started = time.perf_counter()
+    for text in texts:
+        Outcome.classify(text) or Loan.classify(text) or Wish.classify(text)
+    print(f"{'route':<10}", rate(len(texts), started))
+
+    agc = await FakeClientManager().authorize()
+    ags = await agc.open_by_url("https://fake/bench")
+    sheets = {s.kind: s(ags) for s in (Outcome, Loan, Wish)}
+    now = datetime.now()
+    messages = [
+        Message(message_id=i, date=now, chat=dict(id=1, type="private"), text=text)
+        for i, text in enumerate(texts, 1)
+    ]
+    # the chat's config gets cached
+    await sheets[Outcome.kind].cfg.get_data()
+    classify.cache_clear()
+    started = time.perf_counter()
+    for message in messages:
+        if parsed := classify(message.text):
+            await sheets[parsed.kind].make_row(message, parsed)
+    print(f"{'make_row':<10}", rate(len(texts), started))
+
+    # the grammar against the dateparser it stands in for, on the texts with a date
+    now = datetime.now(timezone.utc).astimezone()
+    dated = [t for t in texts if any(d and d in t for d in DATES)][:args.dates]
+    started = time.perf_counter()
+    ours = [search_date(text, now) for text in dated]
+    print(f"{'dates':<10}", rate(len(dated), started))
+    started = time.perf_counter()
+    theirs = [search_dates(text, languages=["ru", "en"], settings=dateparser_settings(now)) for text in dated]
+    print(f"{'dateparser':<10}", rate(len(dated), started))
+    differ = [text for text, o, t in zip(dated, ours, theirs) if not agrees(text, o, t)]
+    print(f"{len(differ)} of {len(dated)} dates differ from dateparser's", *differ[:10], sep="\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=50_000)
+    parser.add_argument("--dates", type=int, default=2_000, help="texts to compare with dateparser, it is slow")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,135 @@
+"""Time to first reply of a freshly started bot process, against in-memory Google Sheets and Telegram.
+
+Every run starts a new interpreter, which imports the bot, gets ready as main.py does
+(schema check, Google authorization, optionally warming the chat up) and handles one message.
+The database is the one at DATABASE_URL, as for bench.py, so use a scratch one:
+
+    python bench_startup.py --runs 5 --sheets-latency 0.3
+    python bench_startup.py --runs 5 --sheets-latency 0.3 --warm
+"""
+import time
+
+# before the imports below, as in main.py
+STARTED = time.perf_counter()
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+
+from dotenv import load_dotenv
+
+FIRST_CHAT_ID = -(10 ** 13) - 10 ** 6
+
+
+async def child(args: argparse.Namespace) -> dict:
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.types import Update
+    from sqlalchemy import select, delete
+    from sqlalchemy.dialects.postgresql import insert
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+    from telegrind.bot.middleware import get_client
+    from telegrind.bot.setup import setup_dispatcher
+    from telegrind.debounce import Debouncer, Gatherer
+    from telegrind.fakes import FakeClientManager, FakeSession, FakeFetcher, FakeRates
+    from telegrind.index import RowIndex
+    from telegrind.mirror import Mirror
+    from telegrind.models import Model, Chat, OutboxRow
+    from telegrind.outbox import Outbox
+    from telegrind.rates import Rates
+    from telegrind.startup import Timings, ensure_schema, warm_chat
+    from telegrind.tickets import TicketLog
+
+    timings = Timings(STARTED)
+    timings.mark("imports")
+    dp = setup_dispatcher()
+    engine = create_async_engine(os.environ["DATABASE_URL"], echo=False)
+    async_session = async_sessionmaker(engine, expire_on_commit=False)
+    agcm = FakeClientManager(latency=args.sheets_latency)
+    session = FakeSession(latency=args.telegram_latency)
+    bot = Bot("42:BENCH", session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    index = RowIndex(async_session)
+    data = dict(
+        async_session=async_session,
+        agcm=agcm,
+        index=index,
+        outbox=Outbox(engine, async_session, index),
+        fetcher=FakeFetcher(),
+        tickets=TicketLog(async_session),
+        edits=Debouncer(2),
+        forwards=Gatherer(2),
+        mirror=Mirror(async_session),
+        rates=Rates(async_session, FakeRates()),
+        ai=None,
+    )
+    timings.mark("setup")
+
+    await asyncio.gather(ensure_schema(engine, Model.metadata), get_client(agcm))
+    chat_id = FIRST_CHAT_ID - os.getpid()
+    async with async_session() as s, s.begin():
+        await s.execute(insert(Chat).values(chat_id=chat_id, sheet_url=f"https://fake/{chat_id}"))
+    timings.mark("ready")
+    if args.warm:
+        async with async_session() as s:
+            chat = await s.scalar(select(Chat).where(Chat.chat_id == chat_id))
+        await warm_chat(await agcm.authorize(), chat)
+        timings.mark("warm")
+
+    message = dict(
+        message_id=1,
+        date=int(time.time()),
+        chat=dict(id=chat_id, type="private"),
+        from_user=dict(id=chat_id, is_bot=False, first_name="Bench"),
+        text=args.text,
+    )
+    update = Update.model_validate(dict(update_id=1, message=message), context={"bot": bot})
+    await dp.feed_update(bot, update, **data)
+    timings.mark("first reply")
+    result = dict(timings.steps, total=timings.total, sheets_calls=sum(agcm.api.calls.values()))
+
+    async with async_session() as s, s.begin():
+        await s.execute(delete(OutboxRow).where(OutboxRow.chat_id == chat_id))
+        await s.execute(delete(Chat).where(Chat.chat_id == chat_id))
+    await engine.dispose()
+    return result
+
+
+def main(args: argparse.Namespace) -> None:
+    command = [sys.executable, __file__, "--child", "--text", args.text]
+    command += ["--sheets-latency", str(args.sheets_latency), "--telegram-latency", str(args.telegram_latency)]
+    command += ["--warm"] if args.warm else []
+    runs = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        run = json.loads(output.strip().splitlines()[-1])
+        # interpreter startup included
+        run["wall"] = time.perf_counter() - started
+        runs.append(run)
+
+    print(f"{args.runs} runs, {'warm' if args.warm else 'cold'} chat, medians:")
+    for step in runs[0]:
+        print(f"{step:<14} {statistics.median(r[step] for r in runs):>8.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--text", default="500 кофе вчера", help="the first message")
+    parser.add_argument("--warm", action="store_true", help="warm the chat up before its first message")
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="seconds per Sheets API call")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="seconds per Bot API call")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    load_dotenv()
+    logging.basicConfig(level=logging.WARNING)
+    if args.child:
+        print(json.dumps(asyncio.run(child(args))))
+    else:
+        main(args)
@@ -1,16 +1,41 @@
+import time
+
+# before the imports below, the first of the startup timings
+STARTED = time.perf_counter()
+
 import asyncio
 import logging
 import os
+import signal
+from contextlib import asynccontextmanager
+from functools import partial
+from multiprocessing import Queue
 
 from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
 from google.oauth2.service_account import Credentials
-from gspread_asyncio import AsyncioGspreadClientManager
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
+from telegrind import cache, metrics
+from telegrind.archive import Archiver
+from telegrind.bot.handlers.recurring import send_reminder
+from telegrind.bot.middleware import get_client, time_request
+from telegrind.bot.records import mark_delivered
 from telegrind.bot.setup import setup_dispatcher
+from telegrind.bot.sharding import run_sharded, serve_shard, shard_of
+from telegrind.bot.storage import PgStorage, UpdateLog
+from telegrind.debounce import Debouncer, Gatherer
+from telegrind.index import RowIndex
+from telegrind.leader import Leader
+from telegrind.mirror import Mirror
 from telegrind.models import Model
+from telegrind.outbox import Outbox
+from telegrind.rates import Rates, CurrencyApi, RATES_API_URL
+from telegrind.recurring import Reminders
+from telegrind.scheduler import Scheduler, ScheduledClientManager
+from telegrind.startup import Timings, ensure_schema, warm_up
+from telegrind.tickets import OfdFetcher, TicketLog, OFD_API_URL
 
 
 def get_creds():
@@ -29,28 +54,189 @@ def get_creds():
     return scoped
 
 
-async def main() -> None:
+@asynccontextmanager
+async def app(shard: int | None = None):
+    """Wire up the bot, shared by every run mode (and shard workers, which pass their number)."""
+    timings = Timings(STARTED)
+    timings.mark("imports")
     dp = setup_dispatcher()
     engine = create_async_engine(os.environ["DATABASE_URL"], echo=False)
-    async with engine.begin() as conn:
-        await conn.run_sync(Model.metadata.create_all, checkfirst=True)
+    metrics.instrument_engine(engine)
+    metrics.debug = os.getenv("METRICS_DEBUG", "") == "1"
 
     async_session = async_sessionmaker(engine, expire_on_commit=False)
+    # instances sharing the database continue each other's conversations
+    storage = PgStorage(engine, async_session)
+    dp.fsm.storage = storage
 
     token = os.environ["BOT_TOKEN"]
     bot = Bot(token, default=DefaultBotProperties(parse_mode="HTML"))
-    # And the run events dispatching
-    await dp.start_polling(
-        bot, async_session=async_session, agcm=AsyncioGspreadClientManager(get_creds)
+    bot.session.middleware(time_request)
+    scheduler = Scheduler(
+        account_per_minute=float(os.getenv("SHEETS_ACCOUNT_PER_MINUTE", 60)),
+        spreadsheet_per_minute=float(os.getenv("SHEETS_SPREADSHEET_PER_MINUTE", 30)),
     )
+    index = RowIndex(async_session)
+    # sheets the outbox appends to at once, half of the connection pool and of the Sheets burst
+    deliveries = max(1, min(engine.pool.size(), int(scheduler.burst)) // 2)
+    data = dict(
+        async_session=async_session,
+        agcm=ScheduledClientManager(get_creds, scheduler),
+        index=index,
+        outbox=Outbox(engine, async_session, index, concurrency=deliveries),
+        fetcher=OfdFetcher(os.getenv("OFD_API_URL", OFD_API_URL)),
+        tickets=TicketLog(async_session),
+        edits=Debouncer(float(os.getenv("EDIT_DEBOUNCE", 2))),
+        forwards=Gatherer(float(os.getenv("FORWARD_WINDOW", 2))),
+        mirror=Mirror(
+            async_session, interval=float(os.getenv("MIRROR_SYNC_INTERVAL", 1800))
+        ),
+        rates=Rates(async_session, CurrencyApi(os.getenv("RATES_API_URL") or RATES_API_URL)),
+        updates=None,
+        ai=None,
+    )
+    # updates may come twice only to webhook instances, or to a shard worker's replacement;
+    # a single polling process spares every update its two queries
+    if os.getenv("WEBHOOK_URL") or int(os.getenv("WORKERS", 1)) > 1:
+        data["updates"] = UpdateLog(async_session, lease=float(os.getenv("UPDATE_LEASE", 300)))
+    if ai_api_url := os.getenv("AI_API_URL"):
+        from telegrind.ai import AiParser, AI_MODEL
 
-    # teardown
-    await engine.dispose()
+        data["ai"] = AiParser(
+            ai_api_url,
+            api_key=os.getenv("AI_API_KEY", ""),
+            model=os.getenv("AI_MODEL") or AI_MODEL,
+            max_batch=int(os.getenv("AI_BATCH", 20)),
+            max_delay=float(os.getenv("AI_BATCH_DELAY", 0.5)),
+            per_chat=int(os.getenv("AI_PER_CHAT", 2)),
+        )
+    timings.mark("setup")
 
+    async def schema():
+        with timings.step("schema"):
+            await ensure_schema(engine, Model.metadata)
 
-if __name__ == "__main__":
+    async def google():
+        # the first message would wait for it otherwise, and retries if this fails
+        with timings.step("google"):
+            try:
+                await get_client(data["agcm"])
+            except Exception as e:
+                logging.warning("failed to authorize with Google: %r", e)
+
+    async def telegram():
+        # opens the connection the first reply goes through
+        with timings.step("telegram"):
+            try:
+                await bot.get_me()
+            except Exception as e:
+                logging.warning("failed to reach Telegram: %r", e)
+
+    await asyncio.gather(schema(), google(), telegram())
+    timings.mark("ready")
+    logging.info("started in %.2fs: %s", timings.total, timings)
+
+    metrics_runner = None
+    if metrics_port := os.getenv("METRICS_PORT"):
+        # shard workers serve their own metrics on the following ports
+        port = int(metrics_port) + (0 if shard is None else shard + 1)
+        metrics_runner = await metrics.serve(port=port)
+        logging.info("serving metrics on :%s/metrics", port)
+
+    jobs = [asyncio.create_task(storage.listen())]
+    workers = int(os.getenv("WORKERS", 1))
+    # the supervisor of shard workers handles no updates itself
+    if shard is not None or os.getenv("WEBHOOK_URL") or workers <= 1:
+        warm = warm_up(
+            partial(get_client, data["agcm"]),
+            async_session,
+            owns=lambda chat_id: shard is None or shard_of(chat_id, workers) == shard,
+            limit=int(os.getenv("WARM_CHATS", 100)),
+        )
+        jobs.append(asyncio.create_task(warm))
+    # shard workers leave periodic jobs to the main process, and instances to their leader
+    if shard is None:
+        reminders = Reminders(engine, async_session)
+        archiver = Archiver(
+            async_session,
+            index,
+            min_rows=int(os.getenv("ARCHIVE_MIN_ROWS", 1000)),
+            interval=float(os.getenv("ARCHIVE_INTERVAL", 86400)),
+        )
+        periodic = [
+            partial(data["mirror"].run, data["agcm"]),
+            partial(data["outbox"].run, data["agcm"], partial(mark_delivered, bot)),
+            partial(reminders.run, partial(send_reminder, bot)),
+            partial(archiver.run, data["agcm"]),
+        ]
+        if data["updates"]:
+            periodic.append(data["updates"].run)
+        leader = Leader(engine)
+        jobs.append(asyncio.create_task(leader.run(*periodic)))
+    try:
+        yield dp, bot, data
+    finally:
+        # teardown
+        for job in jobs:
+            job.cancel()
+        # the leader lets go of its lock and jobs
+        await asyncio.gather(*jobs, return_exceptions=True)
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await data["fetcher"].close()
+        await data["rates"].close()
+        if data["ai"]:
+            await data["ai"].close()
+        logging.info("cache stats: %s", cache.stats())
+        logging.info("sheets scheduler stats: %s", scheduler.stats())
+        await engine.dispose()
+
+
+async def main() -> None:
+    async with app() as (dp, bot, data):
+        # And the run events dispatching
+        if webhook_url := os.getenv("WEBHOOK_URL"):
+            from telegrind.bot.webhook import run_webhook
+
+            await run_webhook(
+                dp,
+                bot,
+                base_url=webhook_url,
+                path=os.getenv("WEBHOOK_PATH", "/webhook"),
+                secret=os.getenv("WEBHOOK_SECRET") or None,
+                port=int(os.getenv("WEBHOOK_PORT", 8080)),
+                **data,
+            )
+        elif (workers := int(os.getenv("WORKERS", 1))) > 1:
+            await bot.delete_webhook()
+            await run_sharded(dp, bot, workers, shard_worker)
+        else:
+            # in case we are switching back from webhook mode
+            await bot.delete_webhook()
+            await dp.start_polling(bot, **data)
+
+
+async def run_shard(queue: Queue, acks: Queue, shard: int) -> None:
+    async with app(shard) as (dp, bot, data):
+        await serve_shard(dp, bot, queue, acks, **data)
+        await bot.session.close()
+
+
+def shard_worker(queue: Queue, acks: Queue, shard: int) -> None:
+    """Worker process entrypoint, see telegrind.bot.sharding."""
+    # supervisor tells workers when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup()
+    asyncio.run(run_shard(queue, acks, shard))
+
+
+def setup() -> None:
     load_dotenv()
     logging.basicConfig(
         level=logging.INFO, format="%(asctime)s %(levelname)-8s %(name)s - %(message)s"
     )
+
+
+if __name__ == "__main__":
+    setup()
     asyncio.run(main())
@@ -0,0 +1,237 @@
+"""Parsing free-form messages with a language model.
+
+Messages no pattern understands are gathered from all chats for up to `max_delay` seconds
+(or until `max_batch` of them) and parsed by a single request to an OpenAI-compatible
+chat completions endpoint. Results are cached by normalized text,
+and a chat gets at most `per_chat` of its messages parsed at once.
+"""
+import asyncio
+import json
+import logging
+import re
+from collections import Counter
+
+import aiohttp
+
+from . import cache, metrics
+from .parsing import Parsed, OUTCOME, LOAN, WISH
+
+log = logging.getLogger(__name__)
+
+AI_API_URL = 'https://api.openai.com/v1'
+AI_MODEL = 'gpt-4o-mini'
+
+SYSTEM_PROMPT = f"""You parse messages sent to a personal finance bot, mostly in Russian.
+You get JSON {{"messages": [{{"id": 0, "text": "..."}}, ...]}} and answer with JSON
+{{"results": [{{"id": 0, ...}}, ...]}}, one result per message, with these fields:
+- kind: "{OUTCOME}" for an expense, "{LOAN}" for money lent or borrowed, "{WISH}" for something wanted, null otherwise
+- amount: number; for loans negative when the counterparty borrowed from the author
+  (or took money back), positive when the counterparty lent to the author (or paid back)
+- currency: ISO 4217 code if the message names a currency, else null
+- date: date or time words exactly as written in the message, null if none
+- counterparty: who the loan is with, null for other kinds
+- description: what the money was spent on, or what is wanted, without the amount, currency and date
+- category: one lowercase word without "#" if the message has a hashtag, else null
+"""
+
+# loans take calendar dates only, see parsing.PATTERN
+LOAN_DATE = re.compile(r'^\d{2}\.\d{2}\.\d{4}$')
+# cached "not a record", as cache.TTLCache returns None for missing keys
+UNKNOWN = object()
+# the model left the message out of its results
+MISSING = object()
+
+
+def normalize(text: str) -> str:
+    return ' '.join(text.casefold().split())
+
+
+def to_parsed(item: dict) -> Parsed | None:
+    """Record from the model's result, None when it is not one or makes no sense."""
+    kind = item.get('kind')
+    amount = item.get('amount')
+    if kind not in (OUTCOME, LOAN, WISH):
+        return None
+    if kind != WISH and (not isinstance(amount, (int, float)) or isinstance(amount, bool)):
+        return None
+
+    def text(name: str) -> str:
+        value = item.get(name)
+        return ' '.join(str(value).split()) if value not in (None, '') else ''
+
+    currency = text('currency').upper()
+    date, description = text('date'), text('description')
+    if kind == WISH:
+        return Parsed(WISH, description=description)
+    if kind == LOAN:
+        if date and not LOAN_DATE.match(date):
+            # left for the reader, as the loan pattern does
+            description, date = f'{date} {description}'.strip(), ''
+        return Parsed(
+            LOAN,
+            amount=float(amount),
+            currency=currency if len(currency) == 3 else None,
+            date=date or None,
+            counterparty=text('counterparty') or 'Неизвестно',
+            description=description or None,
+        )
+    return Parsed(
+        OUTCOME,
+        amount=float(amount),
+        currency=currency if len(currency) == 3 else None,
+        # make_row finds the date in the description, as for patterned messages
+        description=f'{date} {description}'.strip(),
+        category=text('category').lstrip('#').lower() or None,
+    )
+
+
+class AiParser:
+    def __init__(
+        self,
+        api_url: str = AI_API_URL,
+        api_key: str = '',
+        model: str = AI_MODEL,
+        max_batch: int = 20,
+        max_delay: float = 0.5,
+        per_chat: int = 2,
+        timeout: float = 60,
+    ):
+        self.api_url = api_url.rstrip('/') + '/chat/completions'
+        self.api_key = api_key
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.per_chat = per_chat
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: aiohttp.ClientSession | None = None
+        # (normalized, original) texts waiting for the next request
+        self._batch: list[tuple[str, str]] = []
+        # results being waited for by normalized text, same texts share a request
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._timer: asyncio.Task | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self._chats: dict[int, asyncio.Semaphore] = {}
+        self._active = Counter()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # created lazily, it must be created inside the running loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        return self._session
+
+    async def parse(self, chat_id: int, text: str) -> Parsed | None:
+        """Record in the text, None when there is none or the model is unavailable."""
+        key = normalize(text)
+        cached = cache.ai.get(key)
+        if cached is not None:
+            metrics.ai_messages.inc(result='cached')
+            return None if cached is UNKNOWN else cached
+
+        semaphore = self._chats.setdefault(chat_id, asyncio.Semaphore(self.per_chat))
+        self._active[chat_id] += 1
+        try:
+            async with semaphore:
+                return await self._submit(key, text)
+        finally:
+            self._active[chat_id] -= 1
+            if not self._active[chat_id]:
+                del self._active[chat_id]
+                del self._chats[chat_id]
+
+    async def _submit(self, key: str, text: str) -> Parsed | None:
+        future = self._inflight.get(key)
+        if future is None:
+            future = self._inflight[key] = asyncio.get_running_loop().create_future()
+            self._batch.append((key, text))
+            if len(self._batch) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = self._spawn(self._flush_later())
+        # shared with other waiters, which must not be cancelled along
+        return await asyncio.shield(future)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self._timer = None
+        self._flush()
+
+    def _flush(self):
+        """Send what is gathered so far."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._batch:
+            self._spawn(self._parse_batch(self._batch))
+            self._batch = []
+
+    async def _parse_batch(self, batch: list[tuple[str, str]], retries: int = 1):
+        try:
+            results = await self.request([text for _, text in batch])
+        except Exception as e:
+            log.warning('failed to parse %d messages with %s: %r', len(batch), self.model, e)
+            metrics.ai_messages.inc(len(batch), result='failed')
+            results = None
+
+        missing = []
+        for i, (key, text) in enumerate(batch):
+            result = results[i] if results else None
+            if result is MISSING:
+                if retries:
+                    missing.append((key, text))
+                    continue
+                # not an answer, so not cached either
+                metrics.ai_messages.inc(result='missing')
+                result = None
+            elif results:
+                cache.ai.set(key, UNKNOWN if result is None else result)
+                metrics.ai_messages.inc(result='parsed' if result else 'unknown')
+            future = self._inflight.pop(key)
+            if not future.done():
+                future.set_result(result)
+        if missing:
+            log.info('%s left out %d of %d messages, asking again', self.model, len(missing), len(batch))
+            await self._parse_batch(missing, retries - 1)
+
+    async def request(self, texts: list[str]) -> list:
+        """Parse texts in a single completion, results in the same order.
+
+        A result is a Parsed, None when the text is not a record, or MISSING when the model left it out.
+        """
+        body = dict(
+            model=self.model,
+            temperature=0,
+            response_format={'type': 'json_object'},
+            messages=[
+                {'role': 'system', 'content': SYSTEM_PROMPT},
+                {'role': 'user', 'content': json.dumps(
+                    {'messages': [{'id': i, 'text': t} for i, t in enumerate(texts)]}, ensure_ascii=False
+                )},
+            ],
+        )
+        headers = {'Authorization': f'Bearer {self.api_key}'} if self.api_key else {}
+        with metrics.ai_requests.time():
+            async with self.session.post(self.api_url, json=body, headers=headers) as resp:
+                resp.raise_for_status()
+                data = await resp.json()
+        content = json.loads(data['choices'][0]['message']['content'])
+        by_id = {
+            item.get('id'): item
+            for item in content.get('results', [])
+            if isinstance(item, dict)
+        }
+        return [to_parsed(by_id[i]) if i in by_id else MISSING for i in range(len(texts))]
+
+    async def close(self):
+        """Parse what is pending and release the HTTP session."""
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
@@ -0,0 +1,186 @@
+"""Yearly rollover of long worksheets.
+
+Rows dated before the current year are moved from a live worksheet to `<worksheet> <year>`
+by a single batch update (cut-paste into the archive, then delete from the live one),
+so appends, finds and filters of the live worksheet stay fast.
+Deletes and edits wait for a rollover of the chat, see RowIndex.lock.
+Every move records the range of '#' it took, so edits and deletes of old messages
+look in the right archive right away, and the row index learns the new positions of the moved rows
+and of those below them.
+The local mirror keeps archived rows, marked with their archive, reports still count them.
+Archive worksheets are not mirrored: archived rows keep the values they had when moved,
+hand edits of the archives don't reach reports.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+
+from gspread.utils import ValueRenderOption
+from gspread_asyncio import AsyncioGspreadClientManager
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from .index import RowIndex
+from .mirror import to_datetime
+from .models import Chat, Record, ArchiveRange
+from .outbox import INDEXED
+from .scheduler import background
+from .sheets import Transaction, Outcome, Commodity, open_spreadsheet, runs
+
+log = logging.getLogger(__name__)
+
+ARCHIVED = (Outcome, Commodity)
+
+
+def to_key(value) -> int | None:
+    # kaspi imports are keyed by statement, not by message
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Archiver:
+    def __init__(
+        self,
+        async_session: async_sessionmaker[AsyncSession],
+        index: RowIndex,
+        min_rows: int = 1000,
+        interval: float = 24 * 3600,
+    ):
+        self.async_session = async_session
+        self.index = index
+        # smaller worksheets are fast enough as they are
+        self.min_rows = min_rows
+        self.interval = interval
+
+    async def _mark(self, chat_id: int, worksheet: str, titles: dict[str, list[str]], archived: bool):
+        """Mark (or unmark) mirrored rows as moved to the archives, by title."""
+        async with self.async_session() as session:
+            async with session.begin():
+                for title, keys in titles.items():
+                    for i in range(0, len(keys), 1000):
+                        await session.execute(
+                            update(Record)
+                            .where(
+                                Record.chat_id == chat_id,
+                                Record.worksheet == worksheet,
+                                Record.key.in_(keys[i:i + 1000]),
+                                Record.archive.is_(None) if archived else Record.archive == title,
+                            )
+                            .values(archive=title if archived else None)
+                        )
+
+    async def rollover(self, chat_id: int, sheet: Transaction) -> int:
+        """Move the worksheet's rows of past years to archives, return number of moved rows."""
+        conf = await sheet.cfg.get_data()
+        year = conf.now().year
+        agw, _ = await sheet.get_agw()
+        # the grid is never smaller than the rows in it, small worksheets are not read at all
+        if agw.row_count - 1 < self.min_rows:
+            return 0
+        rows = await agw.get_values(value_render_option=ValueRenderOption.unformatted)
+        if len(rows) - 1 < self.min_rows:
+            return 0
+
+        date_col = sheet.fields['date']
+        # 0-based indexes of rows to move, by year; rows without '#' stay, archives must have it in every row
+        years: dict[int, list[int]] = defaultdict(list)
+        for i, row in enumerate(rows[1:], 1):
+            if len(row) <= date_col or row[0] in ('', None) or row[date_col] in ('', None):
+                continue
+            date = to_datetime(row[date_col])
+            if date and date.year < year:
+                years[date.year].append(i)
+        if not years:
+            return 0
+
+        requests = []
+        # where each moved row goes, (title, 1-based row)
+        moved: dict[int, tuple[str, int]] = {}
+        for y, indexes in sorted(years.items()):
+            archive = sheet.archive(y)
+            archive_agw, _ = await archive.get_agw()
+            dest = len(await archive_agw.col_values(1))
+            requests.append({'appendDimension': {
+                'sheetId': archive_agw.id, 'dimension': 'ROWS', 'length': len(indexes),
+            }})
+            if agw.col_count > archive_agw.col_count:
+                # user-added columns go along
+                requests.append({'appendDimension': {
+                    'sheetId': archive_agw.id, 'dimension': 'COLUMNS',
+                    'length': agw.col_count - archive_agw.col_count,
+                }})
+            for start, end in runs(indexes):
+                requests.append({'cutPaste': {
+                    'source': {'sheetId': agw.id, 'startRowIndex': start, 'endRowIndex': end},
+                    'destination': {'sheetId': archive_agw.id, 'rowIndex': dest, 'columnIndex': 0},
+                    'pasteType': 'PASTE_NORMAL',
+                }})
+                for i in range(start, end):
+                    moved[i] = archive.ws_name, dest + i - start + 1
+                dest += end - start
+        # bottom up, so indexes of the rows above stay put
+        for start, end in reversed(runs(sorted(moved))):
+            requests.append({'deleteDimension': {'range': {
+                'sheetId': agw.id, 'dimension': 'ROWS', 'startIndex': start, 'endIndex': end,
+            }}})
+
+        titles = defaultdict(list)
+        for i, (title, _) in moved.items():
+            titles[title].append(str(rows[i][0]))
+        # before the sheet changes, so a mirror scan meanwhile doesn't drop them
+        await self._mark(chat_id, sheet.ws_name, titles, archived=True)
+        try:
+            await sheet.ags.batch_update({'requests': requests})
+        except Exception:
+            await self._mark(chat_id, sheet.ws_name, titles, archived=False)
+            raise
+
+        async with self.async_session() as session:
+            async with session.begin():
+                for title, keys in titles.items():
+                    keys = [k for k in map(to_key, keys) if k is not None]
+                    if keys:
+                        session.add(ArchiveRange(
+                            chat_id=chat_id,
+                            worksheet=sheet.ws_name,
+                            title=title,
+                            first_key=min(keys),
+                            last_key=max(keys),
+                            rows=len(keys),
+                        ))
+
+        if sheet.ws_name in INDEXED:
+            # rows appended meanwhile are not in `rows`, only those moved are looked at
+            refs = [
+                (title, key, row_id)
+                for i, (title, row_id) in moved.items()
+                if (key := to_key(rows[i][0])) is not None
+            ]
+            await self.index.move(chat_id, sheet.ws_name, refs, *(i + 1 for i in moved))
+        return len(moved)
+
+    async def rollover_chat(self, agcm: AsyncioGspreadClientManager, chat: Chat):
+        agc = await agcm.authorize()
+        ags = await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)
+        for sheet_cls in ARCHIVED:
+            # rows found by a delete or edit meanwhile would be gone, or others
+            async with self.index.lock(chat.chat_id):
+                moved = await self.rollover(chat.chat_id, sheet_cls(ags))
+            if moved:
+                log.info('archived %d rows of %s for chat %s', moved, sheet_cls.ws_name, chat.chat_id)
+
+    async def run(self, agcm: AsyncioGspreadClientManager):
+        """Periodic rollover of all chats' sheets, with background priority."""
+        while True:
+            await asyncio.sleep(self.interval)
+            async with self.async_session() as session:
+                result = await session.execute(select(Chat).where(Chat.sheet_url.is_not(None)))
+                chats = result.scalars().all()
+            with background():
+                for chat in chats:
+                    try:
+                        await self.rollover_chat(agcm, chat)
+                    except Exception:
+                        log.exception('failed to archive sheets of chat %s', chat.chat_id)
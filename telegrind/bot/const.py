@@ -12,6 +12,10 @@ TIP_TEXT = """<b>Расходы 💸</b>
 Расход в долларах на хостинг вчера
 <pre>41 USD вчера хостинг</pre>
 
+Расход на кофе в категории «еда»
+<pre>1200 кофе #еда</pre>
+Месячные лимиты категорий задаются на листе <i>_budgets</i>.
+
 <b>Займы ⛓</b>
 ---------------
 Вася занял <i>(или забрал)</i> у вас 500 тенге сегодня
@@ -30,6 +34,14 @@ TIP_TEXT = """<b>Расходы 💸</b>
 <pre>займ Вася Пупкин 10 USD три дня назад на жб ставочку</pre>
 
 
+<b>Регулярные платежи 🔁</b>
+---------------
+Напоминать об оплате интернета 15-го числа каждого месяца
+<pre>/payment 15 5000 интернет</pre>
+Список платежей
+<pre>/payments</pre>
+
+
 <b>Вишлист ⛓</b>
 ---------------
 <pre>хочу {название или ссылка}</pre>
@@ -40,4 +52,9 @@ TIP_TEXT = """<b>Расходы 💸</b>
 Чтобы <i>изменить</i> запись, просто <i>отредактируйте</i> соответствующее сообщение.
 
 Чтобы <i>удалить</i> запись, ответьте на соответствующее сообщение знаком минуса "-".
+
+Чтобы удалить несколько, перешлите мне их сообщения с комментарием "-". Удалить 3 последние записи
+<pre>/undo 3</pre>
+
+✍ на сообщении - запись принята, 👍 - она уже в таблице. Что ещё не дошло до таблицы: /pending
 """
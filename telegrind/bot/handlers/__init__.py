@@ -1 +1 @@
-from . import start as start, handlers as handlers
+from . import start as start, kaspi as kaspi, tickets as tickets, reports as reports, recurring as recurring, export as export, undo as undo, handlers as handlers
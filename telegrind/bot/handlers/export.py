@@ -0,0 +1,50 @@
+import logging
+import tempfile
+from pathlib import Path
+
+from aiogram import flags
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, FSInputFile
+from gspread_asyncio import AsyncioGspreadClient
+
+from telegrind.export import export, FORMATS, SUFFIXES
+from telegrind.models import Chat
+from telegrind.sheets import open_spreadsheet
+from telegrind.bot.router import router
+
+log = logging.getLogger(__name__)
+
+# Bot API won't take bigger documents
+MAX_SIZE = 50 * 1024 * 1024
+
+
+@router.message(Command("export"))
+@flags.chat_action(action="upload_document", initial_sleep=0.5)
+async def export_sheets(message: Message, command: CommandObject, agc: AsyncioGspreadClient, chat: Chat):
+    fmt = (command.args or "csv").strip().lower()
+    if fmt not in FORMATS:
+        return await message.reply(f"Умею выгружать в {', '.join(FORMATS)}, например: <pre>/export xlsx</pre>")
+    if not chat.sheet_url:
+        return await message.reply("Сначала пришлите ссылку на таблицу: /start")
+
+    progress = await message.reply("Выгружаю таблицу...")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / f"telegrind{SUFFIXES[fmt]}"
+        try:
+            ags = await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)
+            exported = await export(ags, path, fmt)
+        except ImportError:
+            return await progress.edit_text(f"Не умею выгружать в {fmt}, меня не научили 😔")
+        except Exception as e:
+            log.exception("failed to export sheets of chat %s", chat.chat_id)
+            return await progress.edit_text(f"Не смогла выгрузить таблицу. Детали: \n{e}")
+
+        if not exported:
+            return await progress.edit_text("В таблице пока нет записей")
+        if path.stat().st_size > MAX_SIZE:
+            return await progress.edit_text(f"Выгрузка больше 50 МБ, попробуйте другой формат: {', '.join(FORMATS)}")
+        await message.reply_document(
+            FSInputFile(path),
+            caption="\n".join(f"{title}: {rows}" for title, rows in exported.items()),
+        )
+    return await progress.delete()
@@ -1,68 +1,194 @@
+from typing import TYPE_CHECKING
+
 from aiogram import flags, F
 from aiogram.types import Message
 from gspread_asyncio import AsyncioGspreadSpreadsheet, AsyncioGspreadClient
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from telegrind.debounce import Debouncer
+from telegrind.index import RowIndex
+from telegrind.mirror import Mirror
 from telegrind.models import Chat
-from telegrind.sheets import Outcome, Loan, Wish
+from telegrind.outbox import Outbox, SHEETS
+from telegrind.parsing import Parsed, OUTCOME
+from telegrind.rates import Rates
+from telegrind.sheets import Outcome, Loan, Wish, open_spreadsheet
+from telegrind.tickets import TicketLog
+from telegrind.bot.records import (
+    find_record,
+    delete_records,
+    save_record,
+    budget_warning,
+    acknowledge,
+    understand,
+)
 from telegrind.bot.router import router
 from telegrind.bot.const import TIP_TEXT
 
+if TYPE_CHECKING:
+    # imported by main only when a model is configured
+    from telegrind.ai import AiParser
+
+# sheets of records made from text, by parsing.Parsed kind
+RECORDS = {s.kind: s for s in (Outcome, Loan, Wish)}
 
-@router.message(F.text.regexp(Outcome.pattern))
+
+@router.message(F.text.func(Outcome.classify).as_("parsed"))
 @flags.chat_action(action="typing", initial_sleep=0.5)
-async def record_outcome(message: Message, agc: AsyncioGspreadClient, chat: Chat):
-    ags: AsyncioGspreadSpreadsheet = await agc.open_by_url(chat.sheet_url)
-    await Outcome(ags).record(message)
-    return await message.reply("Записала!")
+async def record_outcome(
+    message: Message,
+    parsed: Parsed,
+    agc: AsyncioGspreadClient,
+    chat: Chat,
+    outbox: Outbox,
+    mirror: Mirror,
+    session: AsyncSession,
+    rates: Rates,
+):
+    ags: AsyncioGspreadSpreadsheet = await open_spreadsheet(
+        agc, chat.chat_id, chat.sheet_url
+    )
+    row = await save_record(Outcome(ags), message, chat, outbox, mirror, parsed)
+    warning = await budget_warning(ags, chat, session, rates, row)
+    return await acknowledge(message, warning)
 
 
-@router.message(F.text.regexp(Loan.pattern))
+@router.message(F.text.func(Loan.classify).as_("parsed"))
 @flags.chat_action(action="typing", initial_sleep=0.5)
-async def record_loan(message: Message, agc: AsyncioGspreadClient, chat: Chat):
-    ags: AsyncioGspreadSpreadsheet = await agc.open_by_url(chat.sheet_url)
-    await Loan(ags).record(message)
-    return await message.reply("Записала!")
+async def record_loan(
+    message: Message,
+    parsed: Parsed,
+    agc: AsyncioGspreadClient,
+    chat: Chat,
+    outbox: Outbox,
+    mirror: Mirror,
+):
+    ags: AsyncioGspreadSpreadsheet = await open_spreadsheet(
+        agc, chat.chat_id, chat.sheet_url
+    )
+    await save_record(Loan(ags), message, chat, outbox, mirror, parsed)
+    return await acknowledge(message)
 
 
-@router.message(F.text.regexp(Wish.pattern))
+@router.message(F.text.func(Wish.classify).as_("parsed"))
 @flags.chat_action(action="typing", initial_sleep=0.5)
-async def record_wish(message: Message, agc: AsyncioGspreadClient, chat: Chat):
-    ags: AsyncioGspreadSpreadsheet = await agc.open_by_url(chat.sheet_url)
-    await Wish(ags).record(message)
-    return await message.reply("Записала!")
+async def record_wish(
+    message: Message,
+    parsed: Parsed,
+    agc: AsyncioGspreadClient,
+    chat: Chat,
+    outbox: Outbox,
+    mirror: Mirror,
+):
+    ags: AsyncioGspreadSpreadsheet = await open_spreadsheet(
+        agc, chat.chat_id, chat.sheet_url
+    )
+    await save_record(Wish(ags), message, chat, outbox, mirror, parsed)
+    return await acknowledge(message)
 
 
 @router.edited_message(F.text)
 @flags.chat_action(action="typing", initial_sleep=0.5)
 async def update_changed_message(
-    edited_message: Message, agc: AsyncioGspreadClient, chat: Chat
+    edited_message: Message,
+    agc: AsyncioGspreadClient,
+    chat: Chat,
+    index: RowIndex,
+    outbox: Outbox,
+    mirror: Mirror,
+    session: AsyncSession,
+    rates: Rates,
+    edits: Debouncer,
+    ai: "AiParser | None",
 ):
-    ags: AsyncioGspreadSpreadsheet = await agc.open_by_url(chat.sheet_url)
-    for sheet in (Outcome(ags), Loan(ags), Wish(ags)):
-        cell = await sheet.search_row(edited_message.message_id)
-        if cell:
-            row = await sheet.make_row(edited_message)
-            await sheet.change_row(cell.row, row)
-            return await edited_message.reply("Поправила!")
+    # only the last of quick successive edits gets written (and replied to)
+    if not await edits.settle((chat.chat_id, edited_message.message_id)):
+        return
+
+    ags: AsyncioGspreadSpreadsheet = await open_spreadsheet(
+        agc, chat.chat_id, chat.sheet_url
+    )
+    parsed = await understand(chat, edited_message.text, ai)
+
+    def fields(sheet):
+        # make_row parses the text itself (and fails) when it is not the sheet's kind
+        return parsed if parsed and parsed.kind == sheet.kind else None
+
+    sheet = row = None
+    # not in the sheet yet, change the queued row
+    pending = await outbox.pending(chat.chat_id, edited_message.message_id)
+    if pending:
+        sheet = SHEETS[pending.worksheet](ags)
+        row = await sheet.make_row(edited_message, fields(sheet))
+        if not await outbox.replace(pending.id, row):
+            sheet = None
+    if not sheet:
+        await outbox.wait_sent(chat.chat_id, edited_message.message_id)
+        async with index.lock(chat.chat_id):
+            found = await find_record(ags, chat, index, edited_message.message_id)
+            if found:
+                sheet, row_id = found
+                row = await sheet.make_row(edited_message, fields(sheet))
+                await sheet.change_row(row_id, row)
+    if sheet:
+        # archives are mirrored under the live worksheet
+        await mirror.put(chat.chat_id, type(sheet), [row])
+        warning = ""
+        if sheet.kind == OUTCOME:
+            warning = await budget_warning(ags, chat, session, rates, row)
+        return await edited_message.reply("Поправила!" + warning)
 
     return await edited_message.reply("Не нашла этого в книге...")
 
 
 @router.message(F.reply_to_message.text)
 @flags.chat_action(action="typing", initial_sleep=0.5)
-async def delete_record(message: Message, agc: AsyncioGspreadClient, chat: Chat):
+async def delete_record(
+    message: Message,
+    agc: AsyncioGspreadClient,
+    chat: Chat,
+    index: RowIndex,
+    outbox: Outbox,
+    mirror: Mirror,
+    edits: Debouncer,
+    tickets: TicketLog,
+):
     if message.text.strip() == "-":
         # delete record
         msg: Message = message.reply_to_message
-        ags: AsyncioGspreadSpreadsheet = await agc.open_by_url(chat.sheet_url)
-        for sheet in (Outcome(ags), Loan(ags), Wish(ags)):
-            cell = await sheet.search_row(msg.message_id)
-            if cell:
-                await sheet.delete_row(cell.row)
-                return await msg.reply("Удалила!")
+        ags: AsyncioGspreadSpreadsheet = await open_spreadsheet(
+            agc, chat.chat_id, chat.sheet_url
+        )
+        if await delete_records(ags, chat, index, outbox, mirror, edits, tickets, [msg.message_id]):
+            return await msg.reply("Удалила!")
         return await msg.reply("Не нашла этого в книге...")
 
 
 @router.message(F.text)
-async def catchall(message: Message):
-    return await message.reply(f"Не поняла... \n\n{TIP_TEXT}")
+@flags.chat_action(action="typing", initial_sleep=0.5)
+async def catchall(
+    message: Message,
+    agc: AsyncioGspreadClient,
+    chat: Chat,
+    outbox: Outbox,
+    mirror: Mirror,
+    session: AsyncSession,
+    rates: Rates,
+    ai: "AiParser | None",
+):
+    # no pattern fits, maybe the language model understands it
+    parsed = None
+    if ai and chat.sheet_url:
+        parsed = await ai.parse(chat.chat_id, message.text)
+    if not parsed:
+        return await message.reply(f"Не поняла... \n\n{TIP_TEXT}")
+
+    ags: AsyncioGspreadSpreadsheet = await open_spreadsheet(
+        agc, chat.chat_id, chat.sheet_url
+    )
+    sheet = RECORDS[parsed.kind](ags)
+    row = await save_record(sheet, message, chat, outbox, mirror, parsed)
+    warning = ""
+    if parsed.kind == OUTCOME:
+        warning = await budget_warning(ags, chat, session, rates, row)
+    return await acknowledge(message, warning)
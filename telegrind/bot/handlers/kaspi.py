@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import tempfile
+from itertools import islice
+from pathlib import Path
+
+from aiogram import flags, F, Bot
+from aiogram.types import Message
+from gspread_asyncio import AsyncioGspreadClient
+
+from telegrind.kaspi import parse_statement
+from telegrind.mirror import Mirror
+from telegrind.models import Chat
+from telegrind.scheduler import background
+from telegrind.sheets import Outcome, open_spreadsheet, keys_of
+from telegrind.bot.router import router
+
+log = logging.getLogger(__name__)
+
+# rows per append request
+CHUNK_SIZE = 500
+
+
+@router.message(F.document.mime_type == "application/pdf")
+@flags.chat_action(action="typing", initial_sleep=0.5)
+async def import_kaspi_statement(
+    message: Message, bot: Bot, agc: AsyncioGspreadClient, chat: Chat, mirror: Mirror
+):
+    try:
+        import pypdf  # noqa
+    except ImportError:
+        return await message.reply("Не умею читать PDF, меня не научили 😔")
+
+    ags = await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)
+    sheet = Outcome(ags)
+    progress = await message.reply("Читаю выписку...")
+    imported = skipped = 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # keep the file on disk, pages are read from it one by one
+        path = Path(tmp) / "statement.pdf"
+        await bot.download(message.document, destination=path)
+        records = parse_statement(path)
+
+        # bulk import must not hold back other users' messages
+        with background():
+            try:
+                known = await sheet.keys()
+                # statements of past years were imported into what are archives now
+                if archives := await sheet.archives():
+                    known.update(*await keys_of(ags, archives))
+                while chunk := await asyncio.to_thread(
+                    lambda: list(islice(records, CHUNK_SIZE))
+                ):
+                    rows = [Outcome.from_kaspi(r) for r in chunk if r["key"] not in known]
+                    skipped += len(chunk) - len(rows)
+                    if rows:
+                        await sheet.write_rows(rows)
+                        await mirror.put(chat.chat_id, sheet, rows)
+                        known.update(row[0] for row in rows)
+                        imported += len(rows)
+                    await progress.edit_text(
+                        f"Читаю выписку... записала {imported}, пропустила {skipped}"
+                    )
+            except Exception as e:
+                log.exception("failed to import statement")
+                return await progress.edit_text(
+                    f"Не смогла дочитать выписку, записала {imported}. Детали: \n{e}"
+                )
+
+    if not imported and not skipped:
+        return await progress.edit_text("Не нашла в этом документе расходов из выписки Kaspi")
+    return await progress.edit_text(
+        f"Записала {imported} расходов из выписки!"
+        + (f" Ещё {skipped} уже были в книге." if skipped else "")
+    )
@@ -0,0 +1,166 @@
+from aiogram import flags, Bot
+from aiogram.filters import Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import (
+    CallbackQuery,
+    InlineKeyboardMarkup,
+    Message,
+)
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from gspread_asyncio import AsyncioGspreadClient
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from telegrind.mirror import Mirror
+from telegrind.models import Chat, RecurringPayment
+from telegrind.outbox import Outbox
+from telegrind.rates import Rates
+from telegrind.recurring import next_due, notify, parse
+from telegrind.sheets import ConfigSheet, Outcome, open_spreadsheet
+from telegrind.bot.records import save_row, budget_warning
+from telegrind.bot.router import router
+
+HELP_TEXT = """Чтобы я напоминала о платеже каждый месяц, укажите день месяца, сумму и название:
+<pre>/payment 15 5000 интернет</pre>
+<pre>/payment 1 300 USD аренда #жильё</pre>
+Список платежей: /payments"""
+
+
+class Paid(CallbackData, prefix="paid"):
+    id: int
+
+
+class DropPayment(CallbackData, prefix="drop_payment"):
+    id: int
+
+
+def describe(payment: RecurringPayment) -> str:
+    return f"{payment.title} - {payment.amount:g} {payment.currency}"
+
+
+def without_button(markup: InlineKeyboardMarkup | None, data: str) -> InlineKeyboardMarkup | None:
+    """Same keyboard without the pressed button, None when nothing is left."""
+    rows = [
+        [b for b in row if b.callback_data != data] for row in (markup.inline_keyboard if markup else [])
+    ]
+    rows = [row for row in rows if row]
+    return InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+
+async def send_reminder(bot: Bot, chat_id: int, payments: list[RecurringPayment]):
+    """One message about all the chat's payments due, see telegrind.recurring.Reminders."""
+    keyboard = InlineKeyboardBuilder()
+    for p in payments:
+        keyboard.button(text=f"✅ Оплачено: {p.title}", callback_data=Paid(id=p.id))
+    keyboard.adjust(1)
+    await bot.send_message(
+        chat_id,
+        "Пора платить:\n" + "\n".join(describe(p) for p in payments),
+        reply_markup=keyboard.as_markup(),
+    )
+
+
+@router.message(Command("payment"))
+@flags.chat_action(action="typing", initial_sleep=0.5)
+async def add_payment(
+    message: Message,
+    command: CommandObject,
+    agc: AsyncioGspreadClient,
+    chat: Chat,
+    session: AsyncSession,
+):
+    fields = parse(command.args or "")
+    if not fields:
+        return await message.reply(HELP_TEXT)
+
+    ags = await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)
+    conf = await ConfigSheet(ags).get_data()
+    fields["currency"] = fields["currency"] or conf.currency
+    payment = RecurringPayment(
+        chat_id=chat.chat_id,
+        dt_offset=conf.dt_offset,
+        next_due=next_due(fields["day"], conf.dt_offset, conf.now()),
+        **fields,
+    )
+    async with session.begin():
+        session.add(payment)
+        await session.flush()
+        await notify(session, payment.id)
+    return await message.reply(
+        f"Буду напоминать {payment.day}-го числа: {describe(payment)}"
+    )
+
+
+@router.message(Command("payments"))
+async def list_payments(message: Message, chat: Chat, session: AsyncSession):
+    async with session.begin():
+        result = await session.execute(
+            select(RecurringPayment)
+            .where(RecurringPayment.chat_id == chat.chat_id)
+            .order_by(RecurringPayment.day, RecurringPayment.id)
+        )
+        payments = result.scalars().all()
+    if not payments:
+        return await message.reply(f"Регулярных платежей пока нет.\n\n{HELP_TEXT}")
+
+    keyboard = InlineKeyboardBuilder()
+    for p in payments:
+        keyboard.button(text=f"❌ {p.title}", callback_data=DropPayment(id=p.id))
+    keyboard.adjust(1)
+    return await message.reply(
+        "Регулярные платежи:\n"
+        + "\n".join(f"{p.day}-го: {describe(p)}" for p in payments),
+        reply_markup=keyboard.as_markup(),
+    )
+
+
+@router.callback_query(DropPayment.filter())
+async def drop_payment(
+    callback: CallbackQuery, callback_data: DropPayment, chat: Chat, session: AsyncSession
+):
+    async with session.begin():
+        await session.execute(
+            delete(RecurringPayment).where(
+                RecurringPayment.id == callback_data.id,
+                RecurringPayment.chat_id == chat.chat_id,
+            )
+        )
+        await notify(session, callback_data.id)
+    if isinstance(callback.message, Message):
+        await callback.message.edit_reply_markup(
+            reply_markup=without_button(callback.message.reply_markup, callback.data)
+        )
+    return await callback.answer("Больше не буду напоминать")
+
+
+@router.callback_query(Paid.filter())
+async def record_payment(
+    callback: CallbackQuery,
+    callback_data: Paid,
+    bot: Bot,
+    agc: AsyncioGspreadClient,
+    chat: Chat,
+    outbox: Outbox,
+    mirror: Mirror,
+    session: AsyncSession,
+    rates: Rates,
+):
+    async with session.begin():
+        payment = await session.get(RecurringPayment, callback_data.id)
+    if not payment or payment.chat_id != chat.chat_id:
+        return await callback.answer("Этого платежа уже нет")
+    await callback.answer()
+    if isinstance(callback.message, Message):
+        # pressing it twice would record the payment twice
+        await callback.message.edit_reply_markup(
+            reply_markup=without_button(callback.message.reply_markup, callback.data)
+        )
+
+    ags = await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)
+    conf = await ConfigSheet(ags).get_data()
+    # row is keyed by this message, so replying "-" to it deletes the record
+    reply = await bot.send_message(chat.chat_id, "Записываю оплату...")
+    row = Outcome.from_payment(reply.message_id, payment, conf.now())
+    await save_row(Outcome(ags), row, chat, outbox, mirror)
+    warning = await budget_warning(ags, chat, session, rates, row)
+    return await reply.edit_text(f"Записала оплату: {describe(payment)}" + warning)
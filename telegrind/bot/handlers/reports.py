@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from aiogram import flags
+from aiogram.filters import Command
+from aiogram.types import Message
+from gspread_asyncio import AsyncioGspreadClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from telegrind.models import Chat
+from telegrind.budgets import month_of
+from telegrind.outbox import Outbox
+from telegrind.rates import Rates
+from telegrind.reports import monthly_totals, loan_balances, category_totals
+from telegrind.sheets import Config, ConfigSheet, Outcome, open_spreadsheet
+from telegrind.bot.router import router
+
+log = logging.getLogger(__name__)
+
+MONTHS = 6
+# seconds /pending waits for the chat's settings
+PENDING_TIMEOUT = 5
+
+
+def money(amount: float, currency: str | None) -> str:
+    return f"{amount:,.2f}".replace(",", " ") + f" {currency or ''}".rstrip()
+
+
+@router.message(Command("report"))
+@flags.chat_action(action="typing", initial_sleep=0.5)
+async def report(
+    message: Message, chat: Chat, session: AsyncSession, agc: AsyncioGspreadClient, rates: Rates
+):
+    conf = Config()
+    if chat.sheet_url:
+        conf = await ConfigSheet(await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)).get_data()
+    now = conf.now().replace(tzinfo=None)
+    since = datetime(now.year - (now.month <= MONTHS - 1), (now.month - MONTHS) % 12 + 1, 1)
+
+    # everything in the chat's currency, expenses at the rates of their days, balances at today's
+    await rates.fill_records(chat.chat_id, Outcome.ws_name, conf.currency, since)
+    await rates.fill([now.date()])
+    async with session.begin():
+        totals = await monthly_totals(session, chat.chat_id, since, conf.currency)
+        loans = await loan_balances(session, chat.chat_id, conf.currency, now.date())
+        categories = await category_totals(session, chat.chat_id, month_of(now), conf.currency, now.date())
+
+    lines = ["<b>Расходы по месяцам</b>"]
+    if totals:
+        lines.append("<pre>")
+        lines.extend(f"{month:%m.%Y}  {money(total, curr)}" for month, curr, total in totals)
+        lines.append("</pre>")
+    else:
+        lines.append("Пока ничего нет")
+
+    if categories:
+        lines.append(f"<b>По категориям за {now:%m.%Y}</b>\n<pre>")
+        lines.extend(f"#{cat}  {money(total, curr)}" for cat, curr, total in categories)
+        lines.append("</pre>")
+
+    if loans:
+        lines.append("<b>Долги</b>\n<pre>")
+        for who, curr, total in loans:
+            if total < 0:
+                lines.append(f"{who} должен {money(-total, curr)}")
+            else:
+                lines.append(f"{who}: вы должны {money(total, curr)}")
+        lines.append("</pre>")
+
+    return await message.reply("\n".join(lines))
+
+
+@router.message(Command("pending"))
+async def pending(message: Message, chat: Chat, outbox: Outbox, agc: AsyncioGspreadClient):
+    count, oldest, error = await outbox.stats(chat.chat_id)
+    if not count:
+        return await message.reply("Все записи уже в таблице 👍")
+    conf = Config()
+    try:
+        # the time zone is in the sheet, which may be why rows wait: not for long then
+        conf = await asyncio.wait_for(
+            ConfigSheet(await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)).get_data(), PENDING_TIMEOUT
+        )
+    except Exception as e:
+        log.warning("failed to read settings of chat %s: %r", chat.chat_id, e)
+    oldest = oldest.astimezone(conf.tz)
+    lines = [f"Ждут записи в таблицу: {count}, самая давняя с {oldest:%d.%m.%y %H:%M}"]
+    if error:
+        lines.append(f"Таблица пока не отвечает. Детали: \n{error}")
+    return await message.reply("\n".join(lines))
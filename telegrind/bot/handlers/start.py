@@ -14,6 +14,7 @@ from telegrind.models import Chat, File
 from telegrind.sheets import ConfigSheet
 from telegrind.bot.router import router
 from telegrind.bot.const import TIP_TEXT
+from telegrind.bot.middleware import save_sheet_url
 
 log = logging.getLogger(__name__)
 
@@ -82,8 +83,7 @@ async def obtain_sheet_url(
         )
 
     # on success
-    chat.sheet_url = sheet_url
-    await session.commit()
+    await save_sheet_url(session, chat, sheet_url)
 
     await state.clear()
     await message.answer(
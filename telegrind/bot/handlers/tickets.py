@@ -0,0 +1,76 @@
+import logging
+from io import BytesIO
+
+from aiogram import flags, F, Bot
+from aiogram.types import Message
+from gspread_asyncio import AsyncioGspreadClient
+
+from telegrind.mirror import Mirror
+from telegrind.models import Chat
+from telegrind.outbox import Outbox
+from telegrind.sheets import Outcome, Commodity, open_spreadsheet
+from telegrind.tickets import TICKET_URL, TicketFetcher, TicketLog, fiscal_id, decode_qr
+from telegrind.bot.records import acknowledge
+from telegrind.bot.router import router
+
+log = logging.getLogger(__name__)
+
+
+async def record_ticket(
+    message: Message, url: str, agc: AsyncioGspreadClient, chat: Chat, fetcher: TicketFetcher,
+    outbox: Outbox, mirror: Mirror, tickets: TicketLog,
+):
+    fid = fiscal_id(url)
+    if not fid:
+        return await message.reply("Не похоже на ссылку с чека...")
+    # before fetching, so that the same receipt sent twice at once is recorded once
+    if not await tickets.claim(chat.chat_id, fid, message.message_id):
+        return await message.reply("Этот чек уже записан!")
+
+    try:
+        data = await fetcher.fetch(url)
+    except Exception as e:
+        log.warning("failed to fetch ticket %s: %s", fid, e)
+        await tickets.release(chat.chat_id, fid)
+        return await message.reply(f"Не смогла получить чек. Детали: \n{e}")
+
+    try:
+        ags = await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)
+        outcome, commodity = Outcome(ags), Commodity(ags)
+        outcome_rows = [Outcome.from_ticket(message, data)]
+        commodity_rows = commodity.make_rows(message, data)
+        await outbox.put(
+            chat.chat_id, chat.sheet_url, [(outcome, outcome_rows), (commodity, commodity_rows)]
+        )
+    except Exception:
+        await tickets.release(chat.chat_id, fid)
+        raise
+    await mirror.put(chat.chat_id, outcome, outcome_rows, message.date)
+    await mirror.put(chat.chat_id, commodity, commodity_rows, message.date)
+    return await acknowledge(message)
+
+
+@router.message(F.text.regexp(TICKET_URL, mode="search").as_("match"))
+@flags.chat_action(action="typing", initial_sleep=0.5)
+async def record_ticket_link(
+    message: Message, match, agc: AsyncioGspreadClient, chat: Chat, fetcher: TicketFetcher,
+    outbox: Outbox, mirror: Mirror, tickets: TicketLog,
+):
+    return await record_ticket(message, match.group(), agc, chat, fetcher, outbox, mirror, tickets)
+
+
+@router.message(F.photo)
+@flags.chat_action(action="typing", initial_sleep=0.5)
+async def record_ticket_photo(
+    message: Message, bot: Bot, agc: AsyncioGspreadClient, chat: Chat, fetcher: TicketFetcher,
+    outbox: Outbox, mirror: Mirror, tickets: TicketLog,
+):
+    image = BytesIO()
+    await bot.download(message.photo[-1], destination=image)
+    try:
+        url = await decode_qr(image.getvalue())
+    except ImportError:
+        return await message.reply("Не умею читать QR-коды на фото, пришлите ссылку из чека")
+    if not url:
+        return await message.reply("Не нашла QR-код чека на фото...")
+    return await record_ticket(message, url, agc, chat, fetcher, outbox, mirror, tickets)
@@ -0,0 +1,123 @@
+from datetime import datetime
+
+from aiogram import flags, F
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message
+from gspread_asyncio import AsyncioGspreadClient
+
+from telegrind.debounce import Debouncer, Gatherer
+from telegrind.index import RowIndex
+from telegrind.mirror import Mirror
+from telegrind.models import Chat
+from telegrind.outbox import Outbox, INDEXED
+from telegrind.parsing import classify
+from telegrind.sheets import open_spreadsheet
+from telegrind.tickets import TicketLog
+from telegrind.bot.records import delete_records
+from telegrind.bot.router import router
+
+# records that /undo takes back at once, at most
+MAX_UNDO = 100
+
+
+@router.message(Command("undo"))
+@flags.chat_action(action="typing", initial_sleep=0.5)
+async def undo(
+    message: Message,
+    command: CommandObject,
+    agc: AsyncioGspreadClient,
+    chat: Chat,
+    index: RowIndex,
+    outbox: Outbox,
+    mirror: Mirror,
+    edits: Debouncer,
+    tickets: TicketLog,
+):
+    count = (command.args or "1").strip()
+    if not count.isdigit() or not 1 <= int(count) <= MAX_UNDO:
+        return await message.reply(
+            f"Сколько последних записей удалить? Не больше {MAX_UNDO}, например: <pre>/undo 3</pre>"
+        )
+    if not chat.sheet_url:
+        return await message.reply("Сначала пришлите ссылку на таблицу: /start")
+
+    message_ids = await mirror.latest(chat.chat_id, list(INDEXED), int(count))
+    if not message_ids:
+        return await message.reply("Нечего удалять")
+    ags = await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)
+    deleted = await delete_records(ags, chat, index, outbox, mirror, edits, tickets, message_ids)
+    return await message.reply(f"Удалила записей: {deleted}")
+
+
+def matches(records: list[tuple[int, datetime, float | None]], sent_at: datetime, amount: float | None) -> list[int]:
+    """Messages a forward may be of: records sent the same second, narrowed by its amount if several."""
+    same = {m: a for m, s, a in records if s == sent_at}
+    if len(same) > 1 and amount is not None:
+        # none of them with the amount leaves it unclear as well
+        same = {m: a for m, a in same.items() if a is not None and round(a, 2) == round(amount, 2)} or same
+    return list(same)
+
+
+# forwarded with a comment, the "-" and the forwards come as separate messages, in any order
+@router.message(F.text.func(str.strip) == "-", ~F.reply_to_message)
+@flags.chat_action(action="typing", initial_sleep=0.5)
+async def delete_forwarded(
+    message: Message,
+    agc: AsyncioGspreadClient,
+    chat: Chat,
+    index: RowIndex,
+    outbox: Outbox,
+    mirror: Mirror,
+    edits: Debouncer,
+    tickets: TicketLog,
+    forwards: Gatherer,
+):
+    # forwards tell when the original was sent (to the second), not its message
+    sent = [s for s in await forwards.gather(chat.chat_id, None) if s is not None]
+    if not sent:
+        return await message.reply(
+            "Чтобы удалить запись, ответьте на её сообщение знаком минуса \"-\". "
+            "Чтобы удалить несколько, перешлите мне их сообщения с комментарием \"-\""
+        )
+
+    records = await mirror.sent_at(chat.chat_id, list(INDEXED), [sent_at for sent_at, _ in sent])
+    message_ids, unclear, missing = set(), 0, 0
+    for sent_at, amount in sent:
+        found = matches(records, sent_at, amount)
+        if len(found) == 1:
+            message_ids.update(found)
+        elif found:
+            unclear += 1
+        else:
+            missing += 1
+    deleted = 0
+    if message_ids:
+        ags = await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)
+        deleted = await delete_records(ags, chat, index, outbox, mirror, edits, tickets, sorted(message_ids))
+
+    replies = [f"Удалила записей: {deleted}"] if deleted else []
+    if unclear:
+        replies.append(
+            f"Не поняла, какие записи удалить, пересланных сообщений: {unclear} - в ту же секунду "
+            "записано несколько похожих. Ответьте на нужное сообщение знаком минуса \"-\""
+        )
+    if missing or not replies:
+        # records made before forwards could be matched have no send time
+        replies.append(
+            f"Не нашла в книге записей пересланных сообщений: {missing or len(sent)}. "
+            "Старые записи удаляются ответом \"-\" на их сообщение или командой /undo"
+        )
+    return await message.reply("\n\n".join(replies))
+
+
+@router.message(F.text, F.forward_origin.type == "user")
+async def forwarded_record(message: Message, chat: Chat, forwards: Gatherer):
+    origin = message.forward_origin
+    # only one's own records may be deleted this way, in groups too
+    if not chat.sheet_url or not message.from_user or origin.sender_user.id != message.from_user.id:
+        raise SkipHandler
+    parsed = classify(message.text)
+    if None not in await forwards.gather(chat.chat_id, (origin.date, parsed.amount if parsed else None)):
+        # no "-" came along, it is a record of its own
+        raise SkipHandler
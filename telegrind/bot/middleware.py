@@ -1,30 +1,127 @@
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.methods import TelegramMethod
 from gspread_asyncio import AsyncioGspreadClientManager, AsyncioGspreadClient
 
-from sqlalchemy import select
+from sqlalchemy import select, update, func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 
+from telegrind import cache, metrics
 from telegrind.models import Chat
 from .dispatcher import dp
+from .storage import UpdateLog, CHATS_CHANNEL
+
+log = logging.getLogger(__name__)
+_agc: tuple[float, AsyncioGspreadClient] | None = None
+
+
+async def get_client(agcm: AsyncioGspreadClientManager) -> AsyncioGspreadClient:
+    """Reuse authorized client until it's time to re-authorize."""
+    global _agc
+    now = time.monotonic()
+    if _agc is None or _agc[0] < now:
+        _agc = now + agcm.reauth_interval, await agcm.authorize()
+    return _agc[1]
+
+
+async def get_chat(session: AsyncSession, chat_id: int) -> Chat:
+    chat = cache.chats.get(chat_id)
+    if chat:
+        return chat
+    async with session.begin():
+        await session.execute(
+            insert(Chat)
+            .values(chat_id=chat_id)
+            .on_conflict_do_nothing(index_elements=[Chat.chat_id])
+        )
+        result = await session.execute(select(Chat).where(Chat.chat_id == chat_id))
+        chat = result.scalar_one()
+    cache.chats.set(chat_id, chat)
+    return chat
+
+
+async def save_sheet_url(session: AsyncSession, chat: Chat, sheet_url: str):
+    """Write-through update of the chat, cached instance is updated as well.
+
+    Other instances drop their cached one, see PgStorage.listen.
+    """
+    async with session.begin():
+        await session.execute(
+            update(Chat).where(Chat.chat_id == chat.chat_id).values(sheet_url=sheet_url)
+        )
+        await session.execute(select(func.pg_notify(CHATS_CHANNEL, str(chat.chat_id))))
+    chat.sheet_url = sheet_url
+    cache.chats.set(chat.chat_id, chat)
 
 
 @dp.update.middleware()
 async def populate_chat_data(handler, event, data):
     async_session: async_sessionmaker[AsyncSession] = data["async_session"]
+    # session does not touch the database until it's used
     async with async_session() as session:
-        async with session.begin():
-            result = await session.execute(
-                select(Chat).where(Chat.chat_id == event.event.chat.id)
-            )
-            chat = result.scalar_one_or_none()
-            if not chat:
-                chat = Chat(chat_id=event.event.chat.id)
-                session.add(chat)
+        # set by aiogram for messages and callback queries alike
+        chat = await get_chat(session, data["event_chat"].id)
 
         agcm: AsyncioGspreadClientManager = data["agcm"]
-        agc: AsyncioGspreadClient = await agcm.authorize()
+        agc: AsyncioGspreadClient = await get_client(agcm)
 
         data["agc"] = agc
         data["chat"] = chat
         data["session"] = session
 
         return await handler(event, data)
+
+
+@dp.update.outer_middleware()
+async def deduplicate_update(handler, event, data):
+    """Skip updates another instance (or an earlier delivery) took, see UpdateLog."""
+    updates: UpdateLog | None = data.get("updates")
+    if updates is None:
+        return await handler(event, data)
+    if not await updates.claim(event.update_id):
+        log.info("skipping update %s, handled already", event.update_id)
+        metrics.duplicate_updates.inc()
+        return UNHANDLED
+    try:
+        result = await handler(event, data)
+    except Exception:
+        await updates.finish(event.update_id, handled=False)
+        raise
+    await updates.finish(event.update_id)
+    return result
+
+
+@dp.update.outer_middleware()
+async def time_update(handler, event, data):
+    if not metrics.debug:
+        with metrics.updates.time(event=event.event_type):
+            return await handler(event, data)
+
+    with metrics.collect_spans() as spans:
+        started = time.perf_counter()
+        try:
+            with metrics.updates.time(event=event.event_type):
+                return await handler(event, data)
+        finally:
+            log.info(
+                "update %s took %.3fs: %s",
+                event.update_id,
+                time.perf_counter() - started,
+                metrics.format_spans(spans[:-1]),
+            )
+
+
+async def time_handler(handler, event, data):
+    """Observer middleware, see setup_dispatcher."""
+    with metrics.handlers.time(handler=data["handler"].callback.__name__):
+        return await handler(event, data)
+
+
+async def time_request(make_request, bot: Bot, method: TelegramMethod):
+    """Bot session middleware, times Bot API calls."""
+    with metrics.telegram_requests.time(method=type(method).__name__):
+        return await make_request(bot, method)
@@ -0,0 +1,218 @@
+"""Writing, finding and checking records, shared by the handlers."""
+from contextlib import suppress
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import Message, ReactionTypeEmoji
+from gspread_asyncio import AsyncioGspreadSpreadsheet
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from telegrind.budgets import spent, month_of
+from telegrind.debounce import Debouncer
+from telegrind.index import RowIndex
+from telegrind.mirror import Mirror, to_record
+from telegrind.models import Chat
+from telegrind.outbox import Outbox, INDEXED
+from telegrind.parsing import Parsed, classify
+from telegrind.rates import Rates
+from telegrind.sheets import (
+    Outcome,
+    Loan,
+    Commodity,
+    Wish,
+    Transaction,
+    ConfigSheet,
+    BudgetSheet,
+)
+from telegrind.tickets import TicketLog
+
+if TYPE_CHECKING:
+    # imported by main only when a model is configured
+    from telegrind.ai import AiParser
+
+# reactions to a record's message: queued, then in the sheet
+RECEIVED = "✍"
+DELIVERED = "👍"
+
+
+def sheet_of(sheets: dict[str, Transaction], worksheet: str) -> Transaction | None:
+    """Live sheet by its title, or its archive, e.g. 'Expenses 2025'."""
+    if worksheet in sheets:
+        return sheets[worksheet]
+    live, _, year = worksheet.rpartition(" ")
+    if live in sheets and year.isdigit():
+        return sheets[live].archive(int(year))
+    return None
+
+
+async def find_record(
+    ags: AsyncioGspreadSpreadsheet, chat: Chat, index: RowIndex, message_id: int
+) -> tuple[Transaction, int] | None:
+    """Locate a message's row, using the local index and falling back to a sheet scan."""
+    sheets = {s.ws_name: s for s in (Outcome(ags), Loan(ags), Wish(ags))}
+    ref = await index.get(chat.chat_id, message_id)
+    if ref and (sheet := sheet_of(sheets, ref.worksheet)):
+        if await sheet.check_row(ref.row_id, message_id):
+            return sheet, ref.row_id
+
+    # index is stale or has no idea, old messages are in the archive which got their range
+    candidates = [sheet_of(sheets, title) for title in await index.archives(chat.chat_id, message_id)]
+    for sheet in [s for s in candidates if s] + list(sheets.values()):
+        cell = await sheet.search_row(message_id)
+        if cell:
+            await index.add(chat.chat_id, sheet.ws_name, [message_id], cell.row)
+            return sheet, cell.row
+    return None
+
+
+async def delete_records(
+    ags: AsyncioGspreadSpreadsheet,
+    chat: Chat,
+    index: RowIndex,
+    outbox: Outbox,
+    mirror: Mirror,
+    edits: Debouncer,
+    tickets: TicketLog,
+    message_ids: list[int],
+) -> int:
+    """Delete the messages' records (and receipts' commodities), a single request per worksheet.
+
+    Return how many messages had a record.
+    """
+    deleted = await _delete_records(ags, chat, index, outbox, mirror, edits, message_ids)
+    # their receipts may be sent again
+    await tickets.forget(chat.chat_id, *deleted)
+    return len(deleted)
+
+
+async def _delete_records(
+    ags: AsyncioGspreadSpreadsheet,
+    chat: Chat,
+    index: RowIndex,
+    outbox: Outbox,
+    mirror: Mirror,
+    edits: Debouncer,
+    message_ids: list[int],
+) -> set[int]:
+    for message_id in message_ids:
+        edits.cancel((chat.chat_id, message_id))
+    # not in the sheet yet, they never get there
+    discarded = await outbox.discard(chat.chat_id, *message_ids)
+    for worksheet in {w for _, w in discarded}:
+        await mirror.remove(chat.chat_id, worksheet, *(m for m, w in discarded if w == worksheet))
+    deleted = {m for m, _ in discarded}
+    rest = set(message_ids) - deleted
+    if not rest:
+        return deleted
+
+    found: dict[Transaction, dict[int, list[int]]] = {}
+
+    async def locate(sheets: list[Transaction], ids: set[int]):
+        # a read of the '#' column per worksheet finds them all, old messages are in archives
+        by_name = {s.ws_name: s for s in sheets}
+        archives = [sheet_of(by_name, title) for title in await index.archives(chat.chat_id, *ids)]
+        left = set(ids)
+        for sheet in [s for s in archives if s] + sheets:
+            if left and (rows := await sheet.rows_of(left)):
+                found[sheet] = rows
+                left -= rows.keys()
+
+    await outbox.wait_sent(chat.chat_id, *rest)
+    async with index.lock(chat.chat_id):
+        if len(rest) == 1:
+            (message_id,) = rest
+            if record := await find_record(ags, chat, index, message_id):
+                sheet, row_id = record
+                found[sheet] = {message_id: [row_id]}
+        else:
+            await locate([Outcome(ags), Loan(ags), Wish(ags)], rest)
+        deleted |= {m for rows in found.values() for m in rows}
+        # a receipt's commodities go along with its expense
+        if receipts := await mirror.known(chat.chat_id, Commodity.ws_name, deleted & rest):
+            await locate([Commodity(ags)], receipts)
+        for sheet, rows in found.items():
+            row_ids = [r for ids in rows.values() for r in ids]
+            await sheet.delete_rows(row_ids)
+            if type(sheet).ws_name in INDEXED:
+                await index.remove(chat.chat_id, sheet.ws_name, *row_ids)
+            # archives are mirrored under the live worksheet
+            await mirror.remove(chat.chat_id, type(sheet).ws_name, *rows)
+    return deleted
+
+
+async def save_row(
+    sheet: Transaction, row: list, chat: Chat, outbox: Outbox, mirror: Mirror, sent_at: datetime | None = None
+):
+    """Queue a row keyed by its message for the sheet, and remember it locally."""
+    await outbox.put(chat.chat_id, chat.sheet_url, [(sheet, [row])])
+    await mirror.put(chat.chat_id, sheet, [row], sent_at)
+
+
+async def save_record(
+    sheet: Transaction,
+    message: Message,
+    chat: Chat,
+    outbox: Outbox,
+    mirror: Mirror,
+    parsed: Parsed | None = None,
+) -> list:
+    row = await sheet.make_row(message, parsed)
+    await save_row(sheet, row, chat, outbox, mirror, message.date)
+    return row
+
+
+async def understand(chat: Chat, text: str, ai: "AiParser | None") -> Parsed | None:
+    """Record in the text, asking the language model (if there is one) when no pattern fits."""
+    parsed = classify(text)
+    if parsed is None and ai:
+        parsed = await ai.parse(chat.chat_id, text)
+    return parsed
+
+
+async def acknowledge(message: Message, text: str = ""):
+    """React to a queued record, replying only when there is something to tell."""
+    try:
+        await message.react([ReactionTypeEmoji(emoji=RECEIVED)])
+    except TelegramAPIError:
+        # reactions may be turned off in the chat
+        return await message.reply("Записала!" + text)
+    if text.strip():
+        return await message.reply(text.strip())
+
+
+async def mark_delivered(bot: Bot, chat_id: int, message_ids: list[int]):
+    """Let the chat know its records reached the sheet, see Outbox.run."""
+    for message_id in message_ids:
+        with suppress(TelegramAPIError):
+            await bot.set_message_reaction(
+                chat_id, message_id, [ReactionTypeEmoji(emoji=DELIVERED)]
+            )
+
+
+async def budget_warning(
+    ags: AsyncioGspreadSpreadsheet, chat: Chat, session: AsyncSession, rates: Rates, row: list
+) -> str:
+    """Warning to add to the reply when the expense's category is over its budget."""
+    record = to_record(Outcome, row)
+    if not record["category"] or not record["date"]:
+        return ""
+    conf = await ConfigSheet(ags).get_data()
+    budget = (await BudgetSheet(ags).get_data(conf.currency)).get(record["category"])
+    if not budget:
+        return ""
+    # expenses in other currencies count at the stored rates, a slow provider must not hold the reply
+    day = record["date"].date()
+    rates.fill_soon([day])
+    # running total, already including this expense
+    async with session.begin():
+        total = await spent(
+            session, chat.chat_id, record["category"], budget.currency, month_of(record["date"]), day
+        )
+    if total <= budget.limit:
+        return ""
+    return (
+        f"\n\n⚠️ Бюджет #{record['category']} превышен: "
+        f"{total:.2f} из {budget.limit:.2f} {budget.currency}"
+    )
@@ -9,6 +9,8 @@ def setup_dispatcher() -> Dispatcher:
     from . import middleware  # noqa
 
     router.message.middleware(ChatActionMiddleware())
+    for observer in (router.message, router.edited_message, router.callback_query):
+        observer.middleware(middleware.time_handler)
     dp.include_router(router)
 
     return dp
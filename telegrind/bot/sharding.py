@@ -0,0 +1,260 @@
+"""Run the bot in several worker processes, each owning a subset of chats.
+
+Supervisor process polls Telegram and routes every update to a worker by chat id,
+so all updates of a chat end up in the same process, in the order they came.
+
+Workers acknowledge every update they are done with. When a worker dies, the updates
+it had not acknowledged (queued, waiting for others, or being handled) go to its
+replacement, in their order. UpdateLog skips the ones it had handled or begun to,
+so a crash mid-update never records a message twice, but may lose that one update.
+"""
+import asyncio
+import logging
+import multiprocessing as mp
+import signal
+from functools import partial
+from multiprocessing.process import BaseProcess
+from queue import Empty
+from typing import Callable, Coroutine
+
+from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+from aiogram.methods import TelegramMethod
+
+from telegrind.debounce import Debouncer
+
+log = logging.getLogger(__name__)
+
+
+def chat_id_of(update: dict) -> int | None:
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+    return None
+
+
+def shard_of(chat_id: int | None, workers: int) -> int:
+    return hash(chat_id) % workers if chat_id is not None else 0
+
+
+def is_barrier(update: dict) -> bool:
+    """Edits and deletes must not overtake the message they refer to."""
+    message = update.get("message") or {}
+    return "edited_message" in update or "reply_to_message" in message
+
+
+def is_edit(update: dict) -> bool:
+    return "edited_message" in update
+
+
+def edited_of(update: dict) -> int | None:
+    """Id of the message an edit changes."""
+    return (update.get("edited_message") or {}).get("message_id")
+
+
+def deleted_of(update: dict) -> int | None:
+    """Id of the message a "-" reply takes back."""
+    message = update.get("message") or {}
+    if (message.get("text") or "").strip() == "-":
+        return (message.get("reply_to_message") or {}).get("message_id")
+    return None
+
+
+class ChatOrder:
+    """Runs updates concurrently, except that edits and deletes of a chat
+    wait for all the updates of that chat that came before them
+    (and everything waits for the edits and deletes before it).
+
+    Edits don't wait for earlier edits though, so that the handler can debounce them,
+    and a delete can drop the edits of its message which have not started.
+    """
+
+    def __init__(self):
+        # task, barrier, id of the message it edits
+        self._chats: dict[int | None, list[tuple[asyncio.Task, bool, int | None]]] = {}
+        self._dropped: set[asyncio.Task] = set()
+
+    def submit(
+        self, chat_id: int | None, barrier: bool, coro: Coroutine, edit: int | None = None
+    ) -> asyncio.Task:
+        earlier = self._chats.setdefault(chat_id, [])
+        editing = edit is not None
+        deps = [t for t, b, e in earlier if (barrier or b) and not (editing and e is not None)]
+        task = asyncio.create_task(self._run(deps, coro))
+        earlier.append((task, barrier, edit))
+        task.add_done_callback(partial(self._done, chat_id))
+        return task
+
+    def drop_edits(self, chat_id: int | None, message_id: int):
+        """Skip the message's edits which have not started yet, their turn still counts for the order."""
+        for task, _, edit in self._chats.get(chat_id, []):
+            if edit == message_id:
+                self._dropped.add(task)
+
+    async def _run(self, deps: list[asyncio.Task], coro: Coroutine):
+        if deps:
+            await asyncio.wait(deps)
+        if asyncio.current_task() in self._dropped:
+            return coro.close()
+        try:
+            return await coro
+        except Exception:
+            log.exception("failed to process update")
+
+    def _done(self, chat_id: int | None, task: asyncio.Task):
+        self._dropped.discard(task)
+        left = [item for item in self._chats.get(chat_id, []) if item[0] is not task]
+        if left:
+            self._chats[chat_id] = left
+        else:
+            self._chats.pop(chat_id, None)
+
+    async def wait(self):
+        tasks = [item[0] for items in self._chats.values() for item in items]
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+async def serve_shard(dp: Dispatcher, bot: Bot, queue: mp.Queue, acks: mp.Queue, **data) -> None:
+    """Worker side: handle updates from the queue until None comes, putting their ids to acks."""
+
+    async def feed(update: dict):
+        result = await dp.feed_raw_update(bot, update, **data)
+        if isinstance(result, TelegramMethod):
+            await dp.silent_call_request(bot, result)
+
+    order = ChatOrder()
+    edits: Debouncer | None = data.get("edits")
+    loop = asyncio.get_running_loop()
+    while (update := await loop.run_in_executor(None, queue.get)) is not None:
+        chat_id = chat_id_of(update)
+        if (message_id := deleted_of(update)) is not None:
+            # the delete waits for the message's edits before it, which it would only make useless:
+            # drop the ones still waiting for their turn, cut short the ones sleeping out their debounce
+            # (one which got its turn but has not begun to debounce yet still goes through)
+            order.drop_edits(chat_id, message_id)
+            if edits:
+                edits.cancel((chat_id, message_id))
+        task = order.submit(chat_id, is_barrier(update), feed(update), edited_of(update))
+        task.add_done_callback(lambda _, update_id=update["update_id"]: acks.put(update_id))
+    await order.wait()
+
+
+class Supervisor:
+    """Keeps worker processes running and routes updates to them by chat id."""
+
+    def __init__(self, workers: int, target: Callable[[mp.Queue, mp.Queue, int], None]):
+        self.ctx = mp.get_context("spawn")
+        self.target = target
+        self.queues: list[mp.Queue] = [self.ctx.Queue() for _ in range(workers)]
+        self.acks: list[mp.Queue] = [self.ctx.Queue() for _ in range(workers)]
+        # routed to a worker and not acknowledged yet, by update id, in the order they came
+        self.pending: list[dict[int, dict]] = [{} for _ in range(workers)]
+        self.procs: list[BaseProcess | None] = [None] * workers
+
+    def _spawn(self, i: int):
+        proc = self.ctx.Process(
+            target=self.target, args=(self.queues[i], self.acks[i], i), name=f"shard-{i}"
+        )
+        proc.start()
+        self.procs[i] = proc
+
+    def _collect(self, i: int):
+        while True:
+            try:
+                update_id = self.acks[i].get_nowait()
+            except Empty:
+                return
+            self.pending[i].pop(update_id, None)
+
+    def _respawn(self, i: int):
+        """Start a worker in place of a dead one, with the updates it left."""
+        self._collect(i)
+        # a worker killed while using its queues may leave them broken, the new one gets its own
+        for old in (self.queues[i], self.acks[i]):
+            # nobody reads them anymore, don't wait to flush them at exit
+            old.cancel_join_thread()
+            old.close()
+        self.queues[i], self.acks[i] = self.ctx.Queue(), self.ctx.Queue()
+        for update in self.pending[i].values():
+            self.queues[i].put(update)
+        if self.pending[i]:
+            log.warning("shard %d left %d updates, passing them on", i, len(self.pending[i]))
+        self._spawn(i)
+
+    def start(self):
+        for i in range(len(self.queues)):
+            self._spawn(i)
+
+    def route(self, update: dict):
+        i = shard_of(chat_id_of(update), len(self.queues))
+        self.pending[i][update["update_id"]] = update
+        self.queues[i].put(update)
+
+    async def watch(self, interval: float = 1.0):
+        """Restart crashed workers, with the updates they had not finished."""
+        while True:
+            await asyncio.sleep(interval)
+            for i, proc in enumerate(self.procs):
+                if proc.is_alive():
+                    self._collect(i)
+                else:
+                    log.warning("shard %d exited with code %s, restarting", i, proc.exitcode)
+                    self._respawn(i)
+
+    async def stop(self, timeout: float = 30):
+        for queue in self.queues:
+            queue.put(None)
+        for proc in self.procs:
+            await asyncio.to_thread(proc.join, timeout)
+            if proc.is_alive():
+                log.warning("shard %s did not stop in time, terminating", proc.name)
+                proc.terminate()
+
+
+async def run_sharded(
+    dp: Dispatcher, bot: Bot, workers: int, target: Callable[[mp.Queue, mp.Queue, int], None]
+) -> None:
+    """Poll Telegram in this process and handle updates in `workers` processes
+    running `target` (which should call serve_shard), until SIGINT/SIGTERM."""
+    supervisor = Supervisor(workers, target)
+    supervisor.start()
+    watcher = asyncio.create_task(supervisor.watch())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    stopping = asyncio.create_task(stop.wait())
+
+    offset = None
+    allowed_updates = dp.resolve_used_update_types()
+    try:
+        while not stop.is_set():
+            polling = asyncio.create_task(
+                bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            )
+            await asyncio.wait({polling, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            if not polling.done():
+                polling.cancel()
+                break
+            try:
+                updates = polling.result()
+            except (TelegramNetworkError, TelegramServerError) as e:
+                log.warning("failed to fetch updates: %s", e)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                supervisor.route(update.model_dump(mode="json", exclude_unset=True, by_alias=True))
+                offset = update.update_id + 1
+    finally:
+        watcher.cancel()
+        stopping.cancel()
+        await supervisor.stop()
+        await bot.session.close()
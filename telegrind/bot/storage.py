@@ -0,0 +1,175 @@
+"""State shared by bot instances through Postgres.
+
+PgStorage keeps FSM states (e.g. /start onboarding) in the database, so they survive restarts
+and any instance can continue a conversation. Every update reads the state, so states are
+cached locally, and instances drop each other's stale entries on notification.
+Cached chats (see middleware.get_chat) are dropped the same way.
+
+UpdateLog lets a single instance handle an update, so the one redelivered after a crash,
+a failover or a webhook timeout does not record the same message twice.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from sqlalchemy import select, delete, update, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+from telegrind import cache
+from telegrind.models import FsmState, HandledUpdate
+
+log = logging.getLogger(__name__)
+
+CHANNEL = "fsm"
+CHATS_CHANNEL = "chat"
+
+
+class PgStorage(BaseStorage):
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        async_session: async_sessionmaker[AsyncSession],
+        key_builder: KeyBuilder | None = None,
+    ):
+        self.engine = engine
+        self.async_session = async_session
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def _load(self, key: str) -> tuple[str | None, dict]:
+        cached = cache.states.get(key)
+        if cached is not None:
+            return cached
+        async with self.async_session() as session:
+            row = (await session.execute(
+                select(FsmState.state, FsmState.data).where(FsmState.key == key)
+            )).one_or_none()
+        # most chats have no state at all, that is cached as well
+        value = (row.state, row.data or {}) if row else (None, {})
+        cache.states.set(key, value)
+        return value
+
+    async def _save(self, key: str, state: str | None, data: dict):
+        async with self.async_session() as session:
+            async with session.begin():
+                if state is None and not data:
+                    await session.execute(delete(FsmState).where(FsmState.key == key))
+                else:
+                    stmt = insert(FsmState).values(key=key, state=state, data=data)
+                    await session.execute(stmt.on_conflict_do_update(
+                        index_elements=[FsmState.key],
+                        set_=dict(state=stmt.excluded.state, data=stmt.excluded.data, updated_at=func.now()),
+                    ))
+                await session.execute(select(func.pg_notify(CHANNEL, key)))
+        cache.states.set(key, (state, data))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self.key_builder.build(key)
+        _, data = await self._load(k)
+        await self._save(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k = self.key_builder.build(key)
+        state, _ = await self._load(k)
+        await self._save(k, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data = await self._load(self.key_builder.build(key))
+        return dict(data)
+
+    def _notified(self, connection, pid, channel, payload):
+        cache.states.pop(payload)
+
+    def _chat_notified(self, connection, pid, channel, payload):
+        cache.chats.pop(int(payload))
+
+    async def listen(self, check_interval: float = 10, retry_interval: float = 10):
+        """Drop entries changed by other instances, until cancelled, listening again when disconnected."""
+        while True:
+            try:
+                await self._listen(check_interval)
+            except Exception as e:
+                log.warning("stopped listening to other instances: %r", e)
+            await asyncio.sleep(retry_interval)
+
+    async def _listen(self, check_interval: float):
+        async with self.engine.connect() as conn:
+            # out of transactions, notifications wait for them to end
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            try:
+                raw = await conn.get_raw_connection()
+                await raw.driver_connection.add_listener(CHANNEL, self._notified)
+                await raw.driver_connection.add_listener(CHATS_CHANNEL, self._chat_notified)
+                # set meanwhile by others, or while disconnected
+                cache.states.clear()
+                cache.chats.clear()
+                while True:
+                    await asyncio.sleep(check_interval)
+                    # fails once the connection, and so notifications, are gone
+                    await conn.execute(select(1))
+            finally:
+                # not pooled along with the listeners
+                await conn.invalidate()
+
+    async def close(self) -> None:
+        pass
+
+
+class UpdateLog:
+    def __init__(
+        self,
+        async_session: async_sessionmaker[AsyncSession],
+        lease: float = 300,
+        keep: float = 7 * 24 * 3600,
+    ):
+        self.async_session = async_session
+        # a claim older than this is left by a crashed instance, the update is taken again
+        self.lease = timedelta(seconds=lease)
+        # Telegram redelivers for a day at most
+        self.keep = timedelta(seconds=keep)
+
+    async def claim(self, update_id: int) -> bool:
+        """Take the update, False when it is handled (or being handled) already."""
+        async with self.async_session() as session:
+            async with session.begin():
+                stmt = insert(HandledUpdate).values(update_id=update_id)
+                result = await session.execute(
+                    stmt.on_conflict_do_update(
+                        index_elements=[HandledUpdate.update_id],
+                        set_=dict(claimed_at=func.now()),
+                        where=~HandledUpdate.done & (HandledUpdate.claimed_at < func.now() - self.lease),
+                    )
+                    .returning(HandledUpdate.update_id)
+                )
+                return result.first() is not None
+
+    async def finish(self, update_id: int, handled: bool = True):
+        """Mark the update handled, or let it be taken again when handling failed."""
+        async with self.async_session() as session:
+            async with session.begin():
+                if handled:
+                    await session.execute(
+                        update(HandledUpdate).where(HandledUpdate.update_id == update_id).values(done=True)
+                    )
+                else:
+                    await session.execute(delete(HandledUpdate).where(HandledUpdate.update_id == update_id))
+
+    async def run(self, interval: float = 3600):
+        """Forget old updates, until cancelled."""
+        while True:
+            try:
+                async with self.async_session() as session:
+                    async with session.begin():
+                        await session.execute(
+                            delete(HandledUpdate).where(HandledUpdate.claimed_at < func.now() - self.keep)
+                        )
+            except Exception:
+                log.exception("failed to forget old updates")
+            await asyncio.sleep(interval)
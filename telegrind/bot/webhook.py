@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import signal
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+
+class DrainingRequestHandler(SimpleRequestHandler):
+    """Waits for in-flight updates to be handled before closing the bot session."""
+
+    def __init__(self, *args, drain_timeout: float = 30, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.drain_timeout = drain_timeout
+
+    async def close(self) -> None:
+        tasks = set(self._background_feed_update_tasks)
+        if tasks:
+            log.info("waiting for %d in-flight updates", len(tasks))
+            _, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+            if pending:
+                log.warning("%d updates did not finish in time", len(pending))
+        await super().close()
+
+
+async def run_webhook(
+    dp: Dispatcher,
+    bot: Bot,
+    *,
+    base_url: str,
+    path: str = "/webhook",
+    secret: str | None = None,
+    host: str = "0.0.0.0",
+    port: int = 8080,
+    drain_timeout: float = 30,
+    **data,
+) -> None:
+    """Serve updates from Telegram webhook until SIGINT/SIGTERM."""
+    app = web.Application()
+    handler = DrainingRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret,
+        drain_timeout=drain_timeout,
+        **data,
+    )
+    handler.register(app, path=path)
+    setup_application(app, dp, bot=bot, **data)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    log.info("listening for webhook on %s:%s%s", host, port, path)
+
+    await bot.set_webhook(
+        base_url.rstrip("/") + path,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        # stops accepting requests, then drains in-flight updates (see DrainingRequestHandler)
+        await runner.cleanup()
@@ -0,0 +1,95 @@
+"""Monthly budgets of expense categories.
+
+Limits are kept by the user in the `_budgets` worksheet (see sheets.BudgetSheet),
+spent amounts are running totals in Postgres, shifted by the mirror (see telegrind.mirror)
+along with every record, edit and delete, so checking a budget is a single lookup.
+Periodic mirror scans recount the totals from scratch, which fixes any drift.
+"""
+from collections import defaultdict
+from datetime import date, datetime
+
+from sqlalchemy import select, delete, func, literal
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import CategoryTotal, Record
+from .rates import converted
+
+
+def month_of(dt: datetime) -> datetime:
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def deltas(old: list, new: list) -> dict[tuple[str, str, datetime], float]:
+    """Changes of totals when `old` records are replaced by `new` ones.
+
+    Records are anything with category, currency, date and amount, as attributes or keys.
+    """
+    result = defaultdict(float)
+    for records, sign in ((old, -1), (new, 1)):
+        for r in records:
+            r = r if isinstance(r, dict) else r._asdict()
+            if r['category'] and r['currency'] and r['date'] and r['amount'] is not None:
+                result[(r['category'], r['currency'], month_of(r['date']))] += sign * r['amount']
+    return {k: v for k, v in result.items() if v}
+
+
+async def shift(session: AsyncSession, chat_id: int, changes: dict[tuple[str, str, datetime], float]):
+    if not changes:
+        return
+    stmt = insert(CategoryTotal).values([
+        dict(chat_id=chat_id, category=category, currency=curr, month=month, amount=amount)
+        for (category, curr, month), amount in changes.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[
+            CategoryTotal.chat_id, CategoryTotal.category, CategoryTotal.currency, CategoryTotal.month
+        ],
+        set_={'amount': CategoryTotal.amount + stmt.excluded.amount},
+    )
+    await session.execute(stmt)
+
+
+async def recount(session: AsyncSession, chat_id: int, worksheet: str):
+    """Rebuild the chat's totals from its mirrored expenses."""
+    month = func.date_trunc('month', Record.date)
+    await session.execute(delete(CategoryTotal).where(CategoryTotal.chat_id == chat_id))
+    await session.execute(
+        insert(CategoryTotal).from_select(
+            ['chat_id', 'category', 'currency', 'month', 'amount'],
+            select(Record.chat_id, Record.category, Record.currency, month, func.sum(Record.amount))
+            .where(
+                Record.chat_id == chat_id,
+                Record.worksheet == worksheet,
+                Record.category.is_not(None),
+                Record.currency.is_not(None),
+                Record.date.is_not(None),
+                Record.amount.is_not(None),
+            )
+            .group_by(Record.chat_id, Record.category, Record.currency, month)
+        )
+    )
+
+
+async def spent(
+    session: AsyncSession, chat_id: int, category: str, currency: str, month: datetime, day: date | None = None
+) -> float:
+    """Month's total of the category in `currency`.
+
+    Totals are kept by month and currency, not by day, so the month's total in each other currency
+    is converted at once at the rates of `day` (the first of the month by default), not at the rates
+    of the days of its expenses. Close enough for a limit, and it keeps the check a single lookup.
+    Amounts without a known rate are left out, see telegrind.rates.
+    """
+    amount, curr = converted(
+        CategoryTotal.amount, CategoryTotal.currency, literal(day or month.date()), currency
+    )
+    result = await session.execute(
+        select(func.sum(amount)).where(
+            CategoryTotal.chat_id == chat_id,
+            CategoryTotal.category == category,
+            CategoryTotal.month == month,
+            curr == currency,
+        )
+    )
+    return result.scalar_one_or_none() or 0
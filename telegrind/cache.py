@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """Bounded LRU cache with per-entry time to live and hit/miss counters."""
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 600):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: Hashable, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+# process-wide caches, so messages of hot chats don't hit Google API or database every time
+spreadsheets = TTLCache('spreadsheets', maxsize=1024, ttl=3600)  # (chat_id, sheet_url) -> spreadsheet
+worksheets = TTLCache('worksheets', maxsize=4096, ttl=3600)  # (spreadsheet_id, title) -> worksheet
+configs = TTLCache('configs', maxsize=1024, ttl=300)  # spreadsheet_id -> Config
+budgets = TTLCache('budgets', maxsize=1024, ttl=300)  # spreadsheet_id -> {category: Budget}
+chats = TTLCache('chats', maxsize=4096, ttl=3600)  # chat_id -> Chat (write-through)
+ai = TTLCache('ai', maxsize=4096, ttl=24 * 3600)  # normalized text -> parsing.Parsed or ai.UNKNOWN
+rates = TTLCache('rates', maxsize=4096, ttl=24 * 3600)  # day -> True when its exchange rates are stored
+states = TTLCache('states', maxsize=4096, ttl=3600)  # FSM key -> (state, data), invalidated on notify
+
+
+def stats() -> dict[str, dict]:
+    return {c.name: c.stats() for c in (spreadsheets, worksheets, configs, budgets, chats, ai, rates, states)}
@@ -0,0 +1,148 @@
+"""Date search in free text.
+
+dateparser is slow (both to import and to run), so the forms advertised in TIP_TEXT
+are handled by a precompiled grammar, and dateparser is only used (and imported)
+for text the grammar doesn't understand but which looks like it may contain a date.
+
+Both resolve relative forms alike, to the minute, and a bare time (or a day and month
+without a year) to its last occurrence (records are made after the fact). Where they differ the grammar is deliberately right:
+dateparser misses numeric dates ("1.2.24", "15.03.24"), reads "31.12.2023" as a year only,
+a day and month as a month only ("5 мая" is the 15th of May on the 15th), drops the time
+from "вчера в 9:15" and the date from "1 января в 10:30", and takes "hour ago" for an hour
+of the day ("day ago" it doesn't find at all). It also takes an amount right before
+a date for a part of it, "2451 в 14:30" being in the year 2451 and "43,24 в 14:30" on the 24th.
+"""
+import re
+from datetime import datetime, timedelta
+
+from . import metrics
+
+_NUMBERS = {
+    'один': 1, 'одна': 1, 'одну': 1, 'два': 2, 'две': 2, 'три': 3, 'четыре': 4, 'пять': 5,
+    'шесть': 6, 'семь': 7, 'восемь': 8, 'девять': 9, 'десять': 10,
+    'a': 1, 'an': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
+    'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10,
+}
+_DAYS = {
+    'позавчера': -2, 'вчера': -1, 'сегодня': 0, 'завтра': 1,
+    'yesterday': -1, 'today': 0, 'tomorrow': 1,
+}
+# first three letters of a month name
+_MONTHS = {
+    'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4, 'мая': 5, 'май': 5, 'июн': 6,
+    'июл': 7, 'авг': 8, 'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12,
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12,
+}
+
+_number = '|'.join(sorted(_NUMBERS, key=len, reverse=True))
+_unit = r'''
+    (?P<minutes>мин(?:ут[уы]?)?|minutes?|mins?)
+    |(?P<hours>час(?:а|ов)?|hours?)
+    |(?P<days>д(?:ень|ня|ней)|days?)
+    |(?P<weeks>недел[юиь]|weeks?)
+'''
+_ru_month = r'январ[ья]|феврал[ья]|марта?|апрел[ья]|ма[йя]|июн[ья]|июл[ья]|августа?|сентябр[ья]|октябр[ья]|ноябр[ья]|декабр[ья]'
+_en_month = r'jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?'
+_time = r'(?:\s+(?:в|at)\s+(?P<{p}h>\d{{1,2}}):(?P<{p}m>\d{{2}}))?'
+
+GRAMMAR = re.compile(rf'''
+    (?<!\w)(?:
+        (?:(?P<n>\d+|{_number})\s+)?(?:{_unit})\s+(?:назад|ago)
+        |(?P<day>{'|'.join(_DAYS)}){_time.format(p='day_')}
+        |(?P<d>\d{{1,2}})\s+(?P<month>{_ru_month}|{_en_month})(?:\s+(?P<y>\d{{4}}))?{_time.format(p='d_')}
+        |(?P<en_month>{_en_month})\s+(?P<en_d>\d{{1,2}})(?:,?\s+(?P<en_y>\d{{4}}))?
+        |(?P<num_d>\d{{1,2}})\.(?P<num_m>\d{{1,2}})\.(?P<num_y>\d{{4}}|\d{{2}})
+        |(?:в|at)\s+(?P<at_h>\d{{1,2}}):(?P<at_m>\d{{2}})
+    )(?!\w)
+''', re.I | re.X)
+
+# anything dateparser may find a date in; text without any of these has no date for sure
+DATEISH = re.compile(
+    r'\d|назад|ago|now|сейчас|вчера|сегодня|завтра|yesterday|today|tomorrow'
+    r'|мин|час|сек|дн|день|недел|месяц|год|лет|min|hour|sec|day|week|month|year'
+    r'|понед|вторн|сред|четв|пятн|суббот|воскр|mon|tue|wed|thu|fri|sat|sun'
+    r'|утр|вечер|ночь|полдень|полночь|noon|midnight|morning|evening|night'
+    r'|янв|фев|мар|апр|ма[йя]|июн|июл|авг|сен|окт|ноя|дек'
+    r'|jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec',
+    re.I
+)
+
+
+def _at(dt: datetime, hour: str | None, minute: str | None) -> datetime:
+    if hour is None:
+        return dt
+    return dt.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+
+
+def _midnight(now: datetime, year: int, month: int, day: int) -> datetime:
+    return now.replace(year=year, month=month, day=day, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _past(now: datetime, year: str | None, month: int, day: int) -> datetime:
+    """Day of the given year, or of the last year when none is given and it is yet to come."""
+    if year:
+        return _midnight(now, int(year), month, day)
+    dt = _midnight(now, now.year, month, day)
+    # "31 декабря" sent on the 1st of January
+    return _midnight(now, now.year - 1, month, day) if dt.date() > now.date() else dt
+
+
+def match_date(match: re.Match, now: datetime) -> datetime:
+    g = match.groupdict()
+    if g['minutes'] or g['hours'] or g['days'] or g['weeks']:
+        n = g['n'] or '1'
+        n = int(n) if n.isdigit() else _NUMBERS[n.lower()]
+        unit = next(u for u in ('minutes', 'hours', 'days', 'weeks') if g[u])
+        return now - timedelta(**{unit: n})
+    if g['day']:
+        dt = now + timedelta(days=_DAYS[g['day'].lower()])
+        return _at(dt, g['day_h'], g['day_m'])
+    if g['month']:
+        dt = _past(now, g['y'], _MONTHS[g['month'][:3].lower()], int(g['d']))
+        return _at(dt, g['d_h'], g['d_m'])
+    if g['en_month']:
+        return _past(now, g['en_y'], _MONTHS[g['en_month'][:3].lower()], int(g['en_d']))
+    if g['num_d']:
+        year = int(g['num_y'])
+        year = year + 2000 if year < 100 else year
+        return _midnight(now, year, int(g['num_m']), int(g['num_d']))
+    dt = _at(now, g['at_h'], g['at_m'])
+    # a time yet to come today is yesterday's
+    return dt - timedelta(days=1) if dt > now else dt
+
+
+def dateparser_settings(now: datetime) -> dict:
+    """dateparser's settings resolving dates the way the grammar does."""
+    return {
+        'TIMEZONE': now.strftime('%z'),
+        'RETURN_AS_TIMEZONE_AWARE': True,
+        'RELATIVE_BASE': now,
+        'PREFER_DATES_FROM': 'past',
+    }
+
+
+def search_date(text: str, now: datetime) -> tuple[str, datetime] | None:
+    """Find the first date in text, relative to timezone-aware `now`.
+
+    Returns the matched substring along with the date, like dateparser's `search_dates` does.
+    """
+    with metrics.date_search.time():
+        return _search_date(text, now)
+
+
+def _search_date(text: str, now: datetime) -> tuple[str, datetime] | None:
+    match = GRAMMAR.search(text)
+    if match:
+        try:
+            return match.group(), match_date(match, now)
+        except ValueError:
+            # e.g. 31 of February, let dateparser decide
+            pass
+    elif not DATEISH.search(text):
+        return None
+
+    from dateparser.search import search_dates  # heavy, import only when needed
+
+    matches = search_dates(text, languages=['ru', 'en'], settings=dateparser_settings(now))
+    return matches[0] if matches else None
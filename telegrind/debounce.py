@@ -0,0 +1,71 @@
+import asyncio
+import itertools
+from typing import Any, Hashable
+
+
+class Debouncer:
+    """Lets through only the last of the calls for a key which come within `window` seconds of each other.
+
+    Used to coalesce rapid edits of a message into a single sheet update.
+    """
+
+    def __init__(self, window: float = 2.0):
+        self.window = window
+        self._latest: dict[Hashable, tuple[int, asyncio.Event]] = {}
+        self._seq = itertools.count()
+
+    async def settle(self, key: Hashable) -> bool:
+        """Wait out the window, True when no later call (or cancel) for the key came meanwhile.
+
+        A later call or a cancel cuts the wait short.
+        """
+        seq, superseded = next(self._seq), asyncio.Event()
+        self.cancel(key)
+        self._latest[key] = seq, superseded
+        if self.window:
+            try:
+                await asyncio.wait_for(superseded.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+        if self._latest.get(key, (None,))[0] != seq:
+            return False
+        del self._latest[key]
+        return True
+
+    def cancel(self, key: Hashable):
+        """Make the pending call for the key (if any) settle with False right away."""
+        if latest := self._latest.pop(key, None):
+            latest[1].set()
+
+
+class Gatherer:
+    """Gathers items for a key which come within `window` seconds of each other.
+
+    Used to take messages forwarded together as one batch, whatever order they come in.
+    """
+
+    def __init__(self, window: float = 2.0):
+        self._debouncer = Debouncer(window)
+        self._batches: dict[Hashable, tuple[list, asyncio.Future]] = {}
+
+    async def gather(self, key: Hashable, item: Any) -> list:
+        """Wait out the window, every call of the batch gets all of its items."""
+        if key not in self._batches:
+            self._batches[key] = [], asyncio.get_running_loop().create_future()
+        items, done = self._batches[key]
+        items.append(item)
+        seq = len(items)
+        try:
+            last = await self._debouncer.settle(key)
+        except asyncio.CancelledError:
+            if len(items) == seq and self._batches.get(key, (None,))[0] is items:
+                # the rest of the batch waits for the last call, which is leaving
+                self._debouncer.cancel(key)
+                del self._batches[key]
+                done.set_result(items)
+            raise
+        if last:
+            del self._batches[key]
+            done.set_result(items)
+        # shared with the other calls, which must not be cancelled along
+        return await asyncio.shield(done)
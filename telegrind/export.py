@@ -0,0 +1,239 @@
+"""Export of all the bot's worksheets to a file.
+
+Worksheets (yearly archives included) are read in chunks of rows, a single values batch request
+for as many chunks as fit in `batch_rows`, and written out as they come, so memory use
+does not grow with the spreadsheet. Columns are typed by the worksheet's fields.
+Converting and writing (deflate, openpyxl, pyarrow) run in a thread of the export's own,
+in order, while the event loop goes on.
+
+CSV needs nothing, XLSX needs openpyxl and Parquet needs pyarrow (the `export` extra).
+"""
+import asyncio
+import csv
+import io
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import Iterator
+
+from gspread.utils import ValueRenderOption, absolute_range_name, rowcol_to_a1
+from gspread_asyncio import AsyncioGspreadSpreadsheet
+
+from .mirror import to_float, to_datetime
+from .scheduler import background
+from .sheets import Transaction, Outcome, Loan, Commodity, Wish
+
+EXPORTED = (Outcome, Loan, Commodity, Wish)
+FORMATS = ('csv', 'xlsx', 'parquet')
+SUFFIXES = {'csv': '.csv.zip', 'xlsx': '.xlsx', 'parquet': '.parquet.zip'}
+FLOAT_FIELDS = ('amount', 'quantity')
+
+
+def sheet_of(title: str) -> type[Transaction] | None:
+    """Sheet class of a worksheet title, archives ('Expenses 2025') included."""
+    for sheet in EXPORTED:
+        name, _, year = title.rpartition(' ')
+        if title == sheet.ws_name or (name == sheet.ws_name and year.isdigit()):
+            return sheet
+    return None
+
+
+def column_types(sheet: type[Transaction], width: int) -> list[type]:
+    """float, datetime or str by column, columns added by the user are text."""
+    types = [str] * width
+    for name, i in sheet.fields.items():
+        if i < width:
+            types[i] = float if name in FLOAT_FIELDS else datetime if name == 'date' else str
+    return types
+
+
+def convert(row: list, types: list[type]) -> list:
+    result = []
+    for i, kind in enumerate(types):
+        value = row[i] if i < len(row) else ''
+        if value in ('', None):
+            result.append(None)
+        elif kind is float:
+            result.append(to_float(value))
+        elif kind is datetime:
+            result.append(to_datetime(value))
+        elif isinstance(value, float) and value.is_integer():
+            # unformatted numbers come as floats sometimes, '#' must not read 123.0
+            result.append(str(int(value)))
+        else:
+            result.append(str(value))
+    return result
+
+
+class CsvWriter:
+    """Zip of a CSV per worksheet, Excel friendly."""
+
+    def __init__(self, path: Path):
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        self._file = None
+        self._csv = None
+
+    def begin(self, title: str, names: list[str], types: list[type]):
+        self.end()
+        self._file = io.TextIOWrapper(self.zip.open(f'{title}.csv', 'w'), encoding='utf-8-sig', newline='')
+        self._csv = csv.writer(self._file)
+        self._csv.writerow(names)
+
+    def write(self, rows: list[list]):
+        self._csv.writerows(
+            [v.strftime('%Y-%m-%d %H:%M') if isinstance(v, datetime) else v for v in row] for row in rows
+        )
+
+    def end(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        self.end()
+        self.zip.close()
+
+
+class XlsxWriter:
+    """Workbook with a sheet per worksheet, written row by row."""
+
+    def __init__(self, path: Path):
+        import openpyxl
+
+        self.path = path
+        # write-only workbooks keep rows in temporary files, not in memory
+        self.book = openpyxl.Workbook(write_only=True)
+        self._sheet = None
+
+    def begin(self, title: str, names: list[str], types: list[type]):
+        self._sheet = self.book.create_sheet(title)
+        self._sheet.append(names)
+
+    def write(self, rows: list[list]):
+        for row in rows:
+            self._sheet.append(row)
+
+    def close(self):
+        self.book.save(self.path)
+
+
+class ParquetWriter:
+    """Zip of a Parquet file per worksheet, a row group per chunk."""
+
+    def __init__(self, path: Path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa, self.pq = pa, pq
+        self.path = path
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+        self._writer = None
+        self._title = ''
+        self._part = path.with_name(f'{path.name}.part')
+
+    def begin(self, title: str, names: list[str], types: list[type]):
+        self.end()
+        pa = self.pa
+        kinds = {float: pa.float64(), datetime: pa.timestamp('s'), str: pa.string()}
+        # duplicate or empty headers are allowed in a sheet, not in a schema
+        self.schema = pa.schema([
+            pa.field(name if name and name not in names[:i] else f'{name or "column"}_{i + 1}', kinds[t])
+            for i, (name, t) in enumerate(zip(names, types))
+        ])
+        self._title = title
+        # parquet writes its footer at the end, the zip member is added when it is complete
+        self._writer = self.pq.ParquetWriter(self._part, self.schema, compression='zstd')
+
+    def write(self, rows: list[list]):
+        columns = list(zip(*rows))
+        self._writer.write_table(self.pa.Table.from_arrays(
+            [self.pa.array(c, type=f.type) for c, f in zip(columns, self.schema)], schema=self.schema
+        ))
+
+    def end(self):
+        if self._writer:
+            self._writer.close()
+            self.zip.write(self._part, f'{self._title}.parquet')
+            self._part.unlink()
+            self._writer = None
+
+    def close(self):
+        self.end()
+        self.zip.close()
+
+
+WRITERS = {'csv': CsvWriter, 'xlsx': XlsxWriter, 'parquet': ParquetWriter}
+
+
+def chunks(worksheets: list, chunk_rows: int) -> Iterator[tuple[str, int, str]]:
+    """(title, first row, A1 range) of every chunk of the worksheets, in order."""
+    for ws in worksheets:
+        for start in range(1, ws.row_count + 1, chunk_rows):
+            end = min(start + chunk_rows - 1, ws.row_count)
+            a1 = f'{rowcol_to_a1(start, 1)}:{rowcol_to_a1(end, ws.col_count)}'
+            yield ws.title, start, absolute_range_name(ws.title, a1)
+
+
+def write_batch(writer, batch: list[tuple[str, int, list[list]]], exported: dict[str, int], types: dict[str, list]):
+    """Write the chunks of a response, as (title, first row, values)."""
+    for title, start, values in batch:
+        if start == 1:
+            if not values:
+                continue
+            names = [str(v) for v in values[0]]
+            types[title] = column_types(sheet_of(title), len(names))
+            writer.begin(title, names, types[title])
+            exported[title] = 0
+            values = values[1:]
+        if title not in exported:
+            continue
+        # trailing rows of the grid are empty
+        values = [convert(row, types[title]) for row in values if any(v != '' for v in row)]
+        if values:
+            writer.write(values)
+            exported[title] += len(values)
+
+
+async def export(
+    ags: AsyncioGspreadSpreadsheet,
+    path: Path,
+    fmt: str = 'csv',
+    chunk_rows: int = 5000,
+    batch_rows: int = 20000,
+) -> dict[str, int]:
+    """Write the bot's worksheets to `path`, return number of rows by worksheet."""
+    loop = asyncio.get_running_loop()
+    # a single thread, so that closing waits for the writes before it, cancelled or not
+    thread = ThreadPoolExecutor(1, thread_name_prefix='export')
+    try:
+        writer = await loop.run_in_executor(thread, WRITERS[fmt], path)
+    except BaseException:
+        thread.shutdown(wait=False)
+        raise
+    exported: dict[str, int] = {}
+    types: dict[str, list] = {}
+    try:
+        # one metadata request tells titles and sizes of all the worksheets
+        worksheets = [ws for ws in await ags.worksheets() if sheet_of(ws.title)]
+        pending = chunks(worksheets, chunk_rows)
+        with background():
+            # a response holds batch_rows at most
+            while batch := list(islice(pending, max(1, batch_rows // chunk_rows))):
+                response = await ags.values_batch_get(
+                    [a1 for _, _, a1 in batch],
+                    params={
+                        'valueRenderOption': ValueRenderOption.unformatted,
+                        'dateTimeRenderOption': 'SERIAL_NUMBER',
+                    },
+                )
+                values = [
+                    (title, start, value_range.get('values', []))
+                    for (title, start, _), value_range in zip(batch, response.get('valueRanges', []))
+                ]
+                await loop.run_in_executor(thread, write_batch, writer, values, exported, types)
+    finally:
+        await loop.run_in_executor(thread, writer.close)
+        thread.shutdown(wait=False)
+    return exported
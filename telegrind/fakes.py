@@ -0,0 +1,348 @@
+"""In-memory stand-ins for Google Sheets and Telegram, to measure and try the bot offline.
+
+They implement just what the bot uses, count every call by method
+and can add latency to each, to resemble the real round-trips (see bench.py).
+"""
+import asyncio
+import itertools
+import json
+import re
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, AsyncGenerator
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetFile, TelegramMethod
+from aiogram.types import File, Message
+from aiohttp import web
+from gspread import Cell, WorksheetNotFound
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
+
+
+class FakeAPI:
+    """Call counter and latency shared by all the fake objects of a client."""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.calls = Counter()
+
+    async def call(self, method: str):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeWorksheet:
+    def __init__(self, api: FakeAPI, spreadsheet: 'FakeSpreadsheet', id: int, title: str):
+        self.api = api
+        self.spreadsheet = spreadsheet
+        self.spreadsheet_id = spreadsheet.id
+        self.id = id
+        self.title = title
+        self.rows: list[list] = []
+
+    def _append(self, rows: list[list]) -> dict:
+        start = len(self.rows) + 1
+        self.rows.extend(list(r) for r in rows)
+        width = max((len(r) for r in rows), default=1)
+        return {'updates': {
+            'updatedRange': f"'{self.title}'!A{start}:{rowcol_to_a1(len(self.rows), width)}",
+        }}
+
+    async def append_row(self, values: list, **kwargs) -> dict:
+        await self.api.call('append_row')
+        return self._append([values])
+
+    async def append_rows(self, values: list[list], **kwargs) -> dict:
+        await self.api.call('append_rows')
+        return self._append(values)
+
+    async def set_basic_filter(self, name: str | None = None):
+        await self.api.call('set_basic_filter')
+
+    async def col_values(self, col: int, **kwargs) -> list[str]:
+        await self.api.call('col_values')
+        return [str(r[col - 1]) if len(r) >= col else '' for r in self.rows]
+
+    async def find(self, query: str, in_column: int | None = None, **kwargs) -> Cell | None:
+        await self.api.call('find')
+        for i, row in enumerate(self.rows, 1):
+            for j, value in enumerate(row, 1):
+                if (in_column is None or j == in_column) and str(value) == query:
+                    return Cell(i, j, str(value))
+        return None
+
+    async def acell(self, label: str, **kwargs) -> Cell:
+        await self.api.call('acell')
+        row, col = a1_to_rowcol(label)
+        values = self.rows[row - 1] if row <= len(self.rows) else []
+        return Cell(row, col, str(values[col - 1]) if col <= len(values) else None)
+
+    async def update_cells(self, cells: list[Cell], value_input_option=None):
+        await self.api.call('update_cells')
+        for cell in cells:
+            while len(self.rows) < cell.row:
+                self.rows.append([])
+            row = self.rows[cell.row - 1]
+            row.extend([''] * (cell.col - len(row)))
+            row[cell.col - 1] = cell.value
+
+    @property
+    def row_count(self) -> int:
+        return len(self.rows)
+
+    @property
+    def col_count(self) -> int:
+        return max((len(r) for r in self.rows), default=1)
+
+    async def delete_rows(self, start_index: int, end_index: int | None = None):
+        await self.api.call('delete_rows')
+        del self.rows[start_index - 1:end_index or start_index]
+
+    async def get_values(self, *args, value_render_option=None, **kwargs) -> list[list]:
+        await self.api.call('get_values')
+        if value_render_option is None:
+            # formatted, everything is a string
+            return [[str(v) for v in row] for row in self.rows]
+        return [list(row) for row in self.rows]
+
+
+def from_cell(cell: dict):
+    """Value of sheets.to_cell's CellData, dates as the bot writes them."""
+    value = cell['userEnteredValue']
+    if 'stringValue' in value:
+        return value['stringValue']
+    if 'numberFormat' in cell.get('userEnteredFormat', {}):
+        return (datetime(1899, 12, 30) + timedelta(minutes=round(value['numberValue'] * 24 * 60))).strftime('%d.%m.%y %H:%M')
+    return value['numberValue']
+
+
+class FakeSpreadsheet:
+    def __init__(self, api: FakeAPI, id: str, url: str):
+        self.api = api
+        self.id = id
+        self.url = url
+        self.sheets: dict[str, FakeWorksheet] = {}
+        self._ids = itertools.count()
+        # gspread_asyncio's own worksheet cache, see Sheet.forget
+        self._ws_cache_title = {}
+
+    async def worksheet(self, title: str) -> FakeWorksheet:
+        await self.api.call('worksheet')
+        if title not in self.sheets:
+            raise WorksheetNotFound(title)
+        return self.sheets[title]
+
+    async def add_worksheet(self, title: str, rows: int, cols: int, **kwargs) -> FakeWorksheet:
+        await self.api.call('add_worksheet')
+        self.sheets[title] = FakeWorksheet(self.api, self, next(self._ids), title)
+        return self.sheets[title]
+
+    async def worksheets(self, exclude_hidden: bool = False) -> list[FakeWorksheet]:
+        await self.api.call('fetch_sheet_metadata')
+        return list(self.sheets.values())
+
+    def _read(self, name: str) -> tuple[FakeWorksheet, int, list[list]]:
+        """Worksheet, first row and values of an A1 range, trailing empty rows dropped."""
+        title, _, cells = name.rpartition('!')
+        ws = self.sheets[title.strip("'").replace("''", "'")]
+        # whole columns, e.g. A:A, or from cell to cell, e.g. A2:A or A1:F10
+        first, last = cells.split(':')
+        top, left = a1_to_rowcol(f'{first}1' if first.isalpha() else first)
+        if last.isalpha():
+            bottom, right = len(ws.rows), a1_to_rowcol(f'{last}1')[1]
+        else:
+            bottom, right = a1_to_rowcol(last)
+        rows = ws.rows[top - 1:bottom]
+        values = [[v for v in row[left - 1:right]] for row in rows]
+        while values and not any(v != '' for v in values[-1]):
+            values.pop()
+        return ws, top, values
+
+    async def values_batch_get(self, ranges: list[str], params: dict | None = None) -> dict:
+        await self.api.call('values_batch_get')
+        value_ranges = []
+        for name in ranges:
+            _, _, values = self._read(name)
+            value_ranges.append(dict(range=name, values=values) if values else dict(range=name))
+        return {'valueRanges': value_ranges}
+
+    async def batch_update(self, body: dict) -> dict:
+        """Only requests of archive.Archiver, sheets.append_many and Transaction.delete_rows are understood.
+
+        Grid size is not tracked. Grid data of the response ranges has formatted values only.
+        """
+        await self.api.call('batch_update')
+        by_id = {ws.id: ws for ws in self.sheets.values()}
+        for request in body['requests']:
+            if 'appendCells' in request:
+                by_id[request['appendCells']['sheetId']].rows.extend(
+                    [from_cell(cell) for cell in row['values']] for row in request['appendCells']['rows']
+                )
+            elif 'cutPaste' in request:
+                source, dest = request['cutPaste']['source'], request['cutPaste']['destination']
+                src, dst = by_id[source['sheetId']], by_id[dest['sheetId']]
+                start, end = source['startRowIndex'], source['endRowIndex']
+                cut = src.rows[start:end]
+                src.rows[start:end] = [[] for _ in cut]
+                while len(dst.rows) < dest['rowIndex'] + len(cut):
+                    dst.rows.append([])
+                dst.rows[dest['rowIndex']:dest['rowIndex'] + len(cut)] = cut
+            elif 'deleteDimension' in request:
+                grid = request['deleteDimension']['range']
+                del by_id[grid['sheetId']].rows[grid['startIndex']:grid['endIndex']]
+        response = {'spreadsheetId': self.id, 'replies': [{} for _ in body['requests']]}
+        if body.get('includeSpreadsheetInResponse'):
+            data = {ws.title: [] for ws in self.sheets.values()}
+            for name in body.get('responseRanges', []):
+                ws, top, values = self._read(name)
+                data[ws.title].append({'startRow': top - 1, 'rowData': [
+                    {'values': [{'formattedValue': str(v)} for v in row]} for row in values
+                ]})
+            response['updatedSpreadsheet'] = {'spreadsheetId': self.id, 'sheets': [
+                {'properties': {'sheetId': ws.id, 'title': ws.title}, 'data': data[ws.title]}
+                for ws in self.sheets.values()
+            ]}
+        return response
+
+
+class FakeClient:
+    def __init__(self, api: FakeAPI):
+        self.api = api
+        self.spreadsheets: dict[str, FakeSpreadsheet] = {}
+
+    async def open_by_url(self, url: str) -> FakeSpreadsheet:
+        await self.api.call('open_by_url')
+        if url not in self.spreadsheets:
+            self.spreadsheets[url] = FakeSpreadsheet(self.api, f'fake-{len(self.spreadsheets)}', url)
+        return self.spreadsheets[url]
+
+
+class FakeClientManager:
+    """Stand-in for AsyncioGspreadClientManager, all its clients share the spreadsheets."""
+
+    reauth_interval = 45 * 60
+
+    def __init__(self, latency: float = 0):
+        self.api = FakeAPI(latency)
+        self.client = FakeClient(self.api)
+
+    async def authorize(self) -> FakeClient:
+        return self.client
+
+
+class FakeSession(BaseSession):
+    """Bot session which answers Bot API methods locally.
+
+    Methods returning a message get a new message in the same chat, files are those of `files`
+    by file_id, everything else gets True.
+    """
+
+    def __init__(self, latency: float = 0, files: dict[str, bytes] | None = None, **kwargs):
+        super().__init__(**kwargs)
+        # not `api`, which is the Bot API server downloads go through
+        self.telegram = FakeAPI(latency)
+        self.files = files or {}
+        self._message_ids = itertools.count(10 ** 9)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None) -> Any:
+        await self.telegram.call(type(method).__name__)
+        if isinstance(method, GetFile):
+            file_id = method.file_id
+            return File(file_id=file_id, file_unique_id=file_id, file_path=f'documents/{file_id}')
+        chat_id = getattr(method, 'chat_id', None)
+        if 'Message' not in str(method.__returning__) or chat_id is None:
+            return True
+        return Message.model_validate(
+            dict(
+                message_id=getattr(method, 'message_id', None) or next(self._message_ids),
+                date=datetime.now(),
+                chat=dict(id=chat_id, type='private'),
+                text=getattr(method, 'text', None),
+            ),
+            context={'bot': bot},
+        )
+
+    async def stream_content(self, url: str, *args, **kwargs) -> AsyncGenerator[bytes, None]:
+        yield self.files.get(url.rpartition('/')[2], b'')
+
+    async def close(self):
+        pass
+
+
+class FakeFetcher:
+    """Stand-in for tickets.OfdFetcher, every ticket has the same `items` bought now."""
+
+    def __init__(self, items: int = 3, latency: float = 0):
+        self.api = FakeAPI(latency)
+        self.items = items
+
+    async def fetch(self, url: str) -> dict:
+        await self.api.call('fetch')
+        items = [
+            {'itemType': 1, 'commodity': {'name': f'{i + 1}. Товар {i + 1}', 'price': 100.0 * (i + 1), 'quantity': 1}}
+            for i in range(self.items)
+        ]
+        return {
+            'orgTitle': 'ТОВАРИЩЕСТВО С ОГРАНИЧЕННОЙ ОТВЕТСТВЕННОСТЬЮ "МАГАЗИН"',
+            'ticket': {
+                'totalSum': sum(i['commodity']['price'] for i in items),
+                'transactionDate': datetime.now().isoformat(timespec='seconds'),
+                'items': items,
+            },
+        }
+
+    async def close(self):
+        pass
+
+
+class FakeRates:
+    """Stand-in for rates.CurrencyApi, the same rates every day."""
+
+    RATES = {'USD': 1.0, 'EUR': 0.92, 'RUB': 90.0, 'KZT': 480.0}
+
+    def __init__(self, rates: dict[str, float] | None = None, latency: float = 0):
+        self.api = FakeAPI(latency)
+        self.rates = rates or self.RATES
+
+    async def fetch(self, day) -> dict[str, float]:
+        await self.api.call('fetch')
+        return dict(self.rates)
+
+    async def close(self):
+        pass
+
+
+async def serve_fake_ai(api: FakeAPI, host: str = '127.0.0.1', port: int = 8090) -> web.AppRunner:
+    """Local stand-in for an OpenAI-compatible endpoint, see ai.AiParser.
+
+    Any text with a number in it is an expense of that amount, the rest of the text is its description.
+    The returned runner must be cleaned up.
+    """
+
+    def result(message: dict) -> dict:
+        match = re.search(r'\d+(?:[.,]\d+)?', message['text'])
+        if not match:
+            return {'id': message['id'], 'kind': None}
+        rest = message['text'].replace(match.group(), ' ', 1)
+        return {
+            'id': message['id'],
+            'kind': 'outcome',
+            'amount': float(match.group().replace(',', '.')),
+            'description': ' '.join(rest.split()),
+        }
+
+    async def completions(request: web.Request) -> web.Response:
+        await api.call('chat/completions')
+        body = await request.json()
+        messages = json.loads(body['messages'][-1]['content'])['messages']
+        content = json.dumps({'results': [result(m) for m in messages]}, ensure_ascii=False)
+        return web.json_response({'choices': [{'message': {'role': 'assistant', 'content': content}}]})
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,137 @@
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+
+from sqlalchemy import select, delete, update, and_, or_, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from .models import RowRef, ArchiveRange
+
+# first half of the key of a chat's advisory lock, see RowIndex.lock
+LOCK_SPACE = 0x726f77
+
+
+class RowIndex:
+    """Local message_id -> (worksheet, row) index, so we don't scan sheets to find a record.
+
+    The index may get stale (e.g. user sorted or edited the sheet by hand),
+    so callers must check the row before trusting it.
+    """
+
+    def __init__(self, async_session: async_sessionmaker[AsyncSession]):
+        self.async_session = async_session
+
+    @asynccontextmanager
+    async def lock(self, chat_id: int):
+        """Hold while finding and deleting (or changing) the chat's rows, so they don't move meanwhile.
+
+        Taken by deletes, edits and the yearly rollover of every instance; appends don't move rows.
+        """
+        async with self.async_session() as session:
+            async with session.begin():
+                await session.execute(select(func.pg_advisory_xact_lock(LOCK_SPACE, func.hashtext(str(chat_id)))))
+                yield
+
+    async def get(self, chat_id: int, message_id: int) -> RowRef | None:
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(RowRef)
+                .where(RowRef.chat_id == chat_id, RowRef.message_id == message_id)
+                .order_by(RowRef.id)
+                .limit(1)
+            )
+            return result.scalar_one_or_none()
+
+    async def add(self, chat_id: int, worksheet: str, message_ids: list[int], first_row: int):
+        """Remember rows appended one after another, starting from `first_row`."""
+        if not message_ids:
+            return
+        stmt = insert(RowRef).values([
+            dict(chat_id=chat_id, message_id=m, worksheet=worksheet, row_id=first_row + i)
+            for i, m in enumerate(message_ids)
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[RowRef.chat_id, RowRef.message_id, RowRef.worksheet],
+            set_={'row_id': stmt.excluded.row_id},
+        )
+        async with self.async_session() as session:
+            async with session.begin():
+                await session.execute(stmt)
+
+    async def remove(self, chat_id: int, worksheet: str, *row_ids: int):
+        """Forget deleted rows and shift the rows below them up, by the number of rows deleted above each."""
+        async with self.async_session() as session:
+            async with session.begin():
+                await self._remove(session, chat_id, worksheet, row_ids)
+
+    async def move(self, chat_id: int, worksheet: str, refs: list[tuple[str, int, int]], *row_ids: int):
+        """Rows taken out of the worksheet to others, remember them at these (worksheet, message_id, row_id).
+
+        Rows below shift up as after a delete, those appended meanwhile included.
+        """
+        async with self.async_session() as session:
+            async with session.begin():
+                await self._remove(session, chat_id, worksheet, row_ids)
+                # keep statements within asyncpg's limit of query arguments
+                for i in range(0, len(refs), 1000):
+                    stmt = insert(RowRef).values([
+                        dict(chat_id=chat_id, worksheet=w, message_id=m, row_id=r) for w, m, r in refs[i:i + 1000]
+                    ])
+                    await session.execute(stmt.on_conflict_do_update(
+                        index_elements=[RowRef.chat_id, RowRef.message_id, RowRef.worksheet],
+                        set_={'row_id': stmt.excluded.row_id},
+                    ))
+
+    @staticmethod
+    async def _remove(session: AsyncSession, chat_id: int, worksheet: str, row_ids):
+        deleted = sorted(set(row_ids))
+        if not deleted:
+            return
+        await session.execute(
+            delete(RowRef).where(
+                RowRef.chat_id == chat_id,
+                RowRef.worksheet == worksheet,
+                RowRef.row_id.in_(deleted),
+            )
+        )
+        if len(deleted) == 1:
+            await session.execute(
+                update(RowRef)
+                .where(
+                    RowRef.chat_id == chat_id,
+                    RowRef.worksheet == worksheet,
+                    RowRef.row_id > deleted[0],
+                )
+                .values(row_id=RowRef.row_id - 1)
+            )
+            return
+        result = await session.execute(
+            select(RowRef.id, RowRef.row_id).where(
+                RowRef.chat_id == chat_id,
+                RowRef.worksheet == worksheet,
+                RowRef.row_id > deleted[0],
+            )
+        )
+        shifted = [
+            dict(id=ref_id, row_id=row_id - bisect_left(deleted, row_id))
+            for ref_id, row_id in result.all()
+        ]
+        if shifted:
+            # a single executemany by primary key
+            await session.execute(update(RowRef), shifted)
+
+    async def archives(self, chat_id: int, *message_ids: int) -> list[str]:
+        """Archive worksheets whose '#' range has any of the messages, newest first."""
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(ArchiveRange.title)
+                .where(
+                    ArchiveRange.chat_id == chat_id,
+                    or_(*(
+                        and_(ArchiveRange.first_key <= m, ArchiveRange.last_key >= m)
+                        for m in message_ids
+                    )),
+                )
+                .order_by(ArchiveRange.id.desc())
+            )
+            return list(dict.fromkeys(result.scalars()))
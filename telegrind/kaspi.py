@@ -0,0 +1,49 @@
+"""Kaspi Gold PDF statement parsing.
+
+Statement lines look like
+    12.03.24 - 2 500,00 ₸ Покупки ИП Кафе
+    13.03.24 + 10 000,00 ₸ Пополнение С Kaspi Депозита
+Only expenses (minus sign) are imported, as Outcome rows.
+"""
+import hashlib
+import re
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+LINE = re.compile(
+    r'^(?P<date>\d{2}\.\d{2}\.\d{2})\s+(?P<sign>[+-])\s*(?P<amount>\d[\d\s]*,\d{2})\s*₸\s+'
+    r'(?P<operation>\S+)\s*(?P<details>.*)$'
+)
+
+
+def pages(path: Path) -> Iterator[str]:
+    """Text of the statement, one page at a time, so the whole document is never in memory."""
+    from pypdf import PdfReader  # optional dependency, see [kaspi] extra
+
+    reader = PdfReader(path)
+    for page in reader.pages:
+        yield page.extract_text() or ''
+
+
+def parse_lines(lines: Iterator[str]) -> Iterator[dict]:
+    """Yield expense records, each with a stable `key` to recognize it on repeated imports."""
+    # same purchase twice a day is two records, numbering them keeps keys distinct
+    seen = Counter()
+    for line in lines:
+        match = LINE.match(line.strip())
+        if not match or match['sign'] != '-':
+            continue
+        amount = float(re.sub(r'\s', '', match['amount']).replace(',', '.'))
+        date = datetime.strptime(match['date'], '%d.%m.%y')
+        desc = f"{match['operation']} {match['details']}".strip()
+        ident = f"{match['date']}|{amount:.2f}|{desc}"
+        seen[ident] += 1
+        digest = hashlib.sha1(f'{ident}|{seen[ident]}'.encode()).hexdigest()[:16]
+        yield dict(key=f'kaspi:{digest}', amount=amount, date=date, desc=desc)
+
+
+def parse_statement(path: Path) -> Iterator[dict]:
+    for text in pages(path):
+        yield from parse_lines(text.splitlines())
@@ -0,0 +1,79 @@
+"""Running the periodic jobs in one of the bot's instances at a time.
+
+Every instance (e.g. behind a webhook load balancer) offers to run them, the one holding
+a Postgres advisory lock does. The lock lives as long as its connection, so when the leader
+dies or loses the database another instance takes over within `retry_interval`.
+Jobs run until cancelled, one that stops (e.g. on a database error) is started again.
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+log = logging.getLogger(__name__)
+
+# advisory lock key, any number no other lock of the database uses
+LOCK = 0x7465_6c65
+
+
+def name_of(job: Callable) -> str:
+    return getattr(job, 'func', job).__qualname__
+
+
+class Leader:
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        lock: int = LOCK,
+        retry_interval: float = 10,
+        check_interval: float = 10,
+    ):
+        self.engine = engine
+        self.lock = lock
+        self.retry_interval = retry_interval
+        self.check_interval = check_interval
+        self.leading = False
+
+    async def _lead(self, jobs: tuple[Callable[[], Awaitable], ...]) -> bool:
+        """Run the jobs while holding the lock, False when it is someone else's."""
+        async with self.engine.connect() as conn:
+            # a session-level lock, it must not end with a transaction
+            conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+            if not (await conn.execute(select(func.pg_try_advisory_lock(self.lock)))).scalar():
+                return False
+            log.info('leading the periodic jobs')
+            self.leading = True
+            tasks = {asyncio.create_task(job()): job for job in jobs}
+            try:
+                while True:
+                    done, _ = await asyncio.wait(
+                        tasks, timeout=self.check_interval, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        job = tasks.pop(task)
+                        log.error('periodic job %s stopped, restarting', name_of(job), exc_info=task.exception())
+                        tasks[asyncio.create_task(self._restart(job))] = job
+                    # fails once the connection, and so the lock, is gone
+                    await conn.execute(select(1))
+            finally:
+                self.leading = False
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                # closed rather than pooled, that releases the lock
+                await conn.invalidate()
+
+    async def _restart(self, job: Callable[[], Awaitable]):
+        await asyncio.sleep(self.retry_interval)
+        await job()
+
+    async def run(self, *jobs: Callable[[], Awaitable]):
+        """Run the jobs whenever this instance is the leader, until cancelled."""
+        while True:
+            try:
+                await self._lead(jobs)
+            except Exception as e:
+                log.warning('stopped leading the periodic jobs: %r', e)
+            await asyncio.sleep(self.retry_interval)
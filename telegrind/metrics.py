@@ -0,0 +1,211 @@
+"""Process metrics in Prometheus text format, and per-update span breakdowns for debugging.
+
+Metrics are process-wide, like caches (see telegrind.cache),
+every timed block is also recorded as a span of the update being handled, if any.
+"""
+import bisect
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+# log span breakdown of every update
+debug = False
+# (name, labels, seconds) of the update being handled, when spans are collected
+_spans: ContextVar[list[tuple[str, dict, float]] | None] = ContextVar('spans', default=None)
+
+
+@contextmanager
+def collect_spans():
+    spans = []
+    token = _spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _spans.reset(token)
+
+
+def format_spans(spans: list[tuple[str, dict, float]]) -> str:
+    return ', '.join(
+        f"{name}{'[' + ','.join(map(str, labels.values())) + ']' if labels else ''} {seconds:.3f}s"
+        for name, labels, seconds in spans
+    )
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple[str, ...], key: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, key)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type: str
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        registry.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, '') for n in self.labels)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+            *self.samples(),
+        ])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[self.key(labels)] += amount
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{_labels(self.labels, k)} {v}' for k, v in self.values.items()]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{_labels(self.labels, k)} {v}' for k, v in self.values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(
+        self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets: tuple = BUCKETS
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = defaultdict(float)
+
+    def observe(self, seconds: float, **labels):
+        key = self.key(labels)
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sums[key] += seconds
+        spans = _spans.get()
+        if spans is not None:
+            spans.append((self.name.removeprefix('telegrind_').removesuffix('_seconds'), labels, seconds))
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, counts in self.counts.items():
+            total = 0
+            for le, count in zip((*self.buckets, '+Inf'), counts):
+                total += count
+                bucket = 'le="%s"' % le
+                lines.append(f'{self.name}_bucket{_labels(self.labels, key, bucket)} {total}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {self.sums[key]}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {total}')
+        return lines
+
+
+registry: list[Metric] = []
+
+updates = Histogram('telegrind_update_seconds', 'Whole update handling, middlewares included.', ('event',))
+handlers = Histogram('telegrind_handler_seconds', 'Handler run time.', ('handler',))
+telegram_requests = Histogram('telegrind_telegram_request_seconds', 'Bot API requests.', ('method',))
+sheets_calls = Histogram(
+    'telegrind_sheets_call_seconds', 'Google Sheets API calls.', ('method', 'worksheet')
+)
+sheets_wait = Histogram(
+    'telegrind_sheets_wait_seconds', 'Time spent waiting for Sheets quota.', ('kind', 'priority')
+)
+sheets_queue = Gauge('telegrind_sheets_queue', 'Sheets API calls waiting for quota.', ('priority',))
+sheets_oldest_wait = Gauge(
+    'telegrind_sheets_oldest_wait_seconds', 'How long the longest waiting Sheets API call has waited.', ('priority',)
+)
+sheets_errors = Counter('telegrind_sheets_errors_total', 'Failed Google Sheets API calls.', ('method', 'status'))
+db_queries = Histogram('telegrind_db_query_seconds', 'Database queries.', ('operation',))
+db_errors = Counter('telegrind_db_errors_total', 'Failed database queries.', ('operation',))
+date_search = Histogram('telegrind_date_search_seconds', 'Searching dates in message text.')
+ai_requests = Histogram('telegrind_ai_request_seconds', 'Language model requests, a batch of messages each.')
+ai_messages = Counter('telegrind_ai_messages_total', 'Free-form messages given to the language model.', ('result',))
+outbox_rows = Counter('telegrind_outbox_rows_total', 'Rows taken off the outbox.', ('result',))
+duplicate_updates = Counter('telegrind_duplicate_updates_total', 'Updates skipped as handled already.')
+outbox_lag = Histogram(
+    'telegrind_outbox_lag_seconds', 'Time rows spent in the outbox before reaching the sheet.',
+    buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600),
+)
+
+
+def render() -> str:
+    return '\n'.join(m.render() for m in registry) + '\n'
+
+
+def operation(statement: str | None) -> str:
+    return statement.lstrip().split(None, 1)[0].upper() if statement and statement.strip() else 'UNKNOWN'
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Time every query of the engine, count failed ones."""
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append((context, time.perf_counter()))
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        _, started = conn.info['query_started'].pop()
+        db_queries.observe(time.perf_counter() - started, operation=operation(statement))
+
+    @event.listens_for(engine.sync_engine, 'handle_error')
+    def error(context):
+        # a failed query gets no after_cursor_execute, its start must not pair with the next one
+        started = context.connection.info.get('query_started') if context.connection is not None else None
+        if started and started[-1][0] is context.execution_context:
+            started.pop()
+        db_errors.inc(operation=operation(context.statement))
+
+
+async def serve(host: str = '0.0.0.0', port: int = 9090) -> web.AppRunner:
+    """Start the /metrics endpoint, the returned runner must be cleaned up."""
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,265 @@
+"""Local copy of the chat's worksheets in Postgres, so reports don't pull whole sheets.
+
+The copy is fed by the bot's own writes right away,
+and by periodic diff scans which catch rows edited in the sheet by hand.
+"""
+import asyncio
+import hashlib
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+
+from gspread.utils import ValueRenderOption
+from gspread_asyncio import AsyncioGspreadClientManager
+from sqlalchemy import select, delete, cast, BigInteger
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from . import budgets
+from .models import Chat, OutboxRow, Record
+from .scheduler import background
+from .sheets import Transaction, Outcome, Loan, Commodity, Wish, open_spreadsheet
+
+log = logging.getLogger(__name__)
+
+MIRRORED = (Outcome, Loan, Commodity, Wish)
+
+
+def to_float(value) -> float | None:
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace(' ', '').replace('\xa0', '').replace(',', '.'))
+    except ValueError:
+        return None
+
+
+def to_datetime(value) -> datetime | None:
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None, second=0, microsecond=0)
+    if isinstance(value, (int, float)):
+        # unformatted dates are days since 1899-12-30
+        return (datetime(1899, 12, 30) + timedelta(days=value)).replace(second=0, microsecond=0)
+    for fmt in ('%d.%m.%y %H:%M', '%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y', '%d.%m.%y'):
+        try:
+            return datetime.strptime(str(value).strip(), fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def to_record(sheet: type[Transaction] | Transaction, row: list) -> dict:
+    def get(name):
+        i = sheet.fields.get(name)
+        return row[i] if i is not None and i < len(row) and row[i] != '' else None
+
+    amount = to_float(get('amount')) if get('amount') is not None else None
+    if amount is not None and 'quantity' in sheet.fields:
+        amount *= to_float(get('quantity')) or 1
+    record = dict(
+        amount=round(amount, 2) if amount is not None else None,
+        currency=str(get('currency')).strip().upper() if get('currency') else None,
+        date=to_datetime(get('date')) if get('date') is not None else None,
+        counterparty=str(get('counterparty')).strip() if get('counterparty') else None,
+        description=str(get('description')).strip() if get('description') else None,
+        category=str(get('category')).strip().lower() if get('category') else None,
+    )
+    record['digest'] = hashlib.sha1(repr(sorted(record.items())).encode()).hexdigest()[:16]
+    return record
+
+
+def keyed(rows: list[list]) -> dict[tuple[str, int], list]:
+    """Rows by ('#', n-th occurrence of that '#')."""
+    seqs = Counter()
+    result = {}
+    for row in rows:
+        if not row or row[0] in ('', None):
+            continue
+        key = str(row[0])
+        result[(key, seqs[key])] = row
+        seqs[key] += 1
+    return result
+
+
+class Mirror:
+    def __init__(self, async_session: async_sessionmaker[AsyncSession], interval: float = 1800):
+        self.async_session = async_session
+        self.interval = interval
+
+    async def _upsert(self, session: AsyncSession, values: list[dict]):
+        if not values:
+            return
+        stmt = insert(Record).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Record.chat_id, Record.worksheet, Record.key, Record.seq],
+            set_={c: stmt.excluded[c] for c in (
+                'amount', 'currency', 'date', 'counterparty', 'description', 'category', 'digest'
+            )},
+        )
+        await session.execute(stmt)
+
+    async def put(
+        self,
+        chat_id: int,
+        sheet: type[Transaction] | Transaction,
+        rows: list[list],
+        sent_at: datetime | None = None,
+    ):
+        """Rows the bot has written (or rewritten), `sent_at` of their message is kept on rewrites."""
+        values = [
+            dict(
+                chat_id=chat_id, worksheet=sheet.ws_name, key=key, seq=seq, sent_at=sent_at,
+                **to_record(sheet, row),
+            )
+            for (key, seq), row in keyed(rows).items()
+        ]
+        async with self.async_session() as session:
+            async with session.begin():
+                old = []
+                if 'category' in sheet.fields:
+                    # rewritten rows take their old amounts off the budget totals
+                    result = await session.execute(
+                        select(Record.category, Record.currency, Record.date, Record.amount)
+                        .where(
+                            Record.chat_id == chat_id,
+                            Record.worksheet == sheet.ws_name,
+                            Record.key.in_({v['key'] for v in values}),
+                        )
+                    )
+                    old = result.all()
+                await self._upsert(session, values)
+                if 'category' in sheet.fields:
+                    await budgets.shift(session, chat_id, budgets.deltas(old, values))
+
+    async def remove(self, chat_id: int, worksheet: str, *keys: str | int):
+        async with self.async_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    delete(Record)
+                    .where(
+                        Record.chat_id == chat_id,
+                        Record.worksheet == worksheet,
+                        Record.key.in_({str(k) for k in keys}),
+                    )
+                    .returning(Record.category, Record.currency, Record.date, Record.amount)
+                )
+                await budgets.shift(session, chat_id, budgets.deltas(result.all(), []))
+
+    async def known(self, chat_id: int, worksheet: str, message_ids: set[int]) -> set[int]:
+        """Those of the messages with records in the worksheet, archived ones included."""
+        if not message_ids:
+            return set()
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(Record.key)
+                .where(
+                    Record.chat_id == chat_id,
+                    Record.worksheet == worksheet,
+                    Record.key.in_({str(m) for m in message_ids}),
+                )
+                .distinct()
+            )
+            return {int(k) for k in result.scalars()}
+
+    async def latest(self, chat_id: int, worksheets: list[str], limit: int) -> list[int]:
+        """Messages of the last records in the worksheets, the latest first."""
+        message_id = cast(Record.key, BigInteger).label('message_id')
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(message_id)
+                .where(
+                    Record.chat_id == chat_id,
+                    Record.worksheet.in_(worksheets),
+                    # kaspi imports are keyed by statement, not by message
+                    Record.key.regexp_match('^[0-9]+$'),
+                )
+                .distinct()
+                .order_by(message_id.desc())
+                .limit(limit)
+            )
+            return list(result.scalars())
+
+    async def sent_at(
+        self, chat_id: int, worksheets: list[str], times: list[datetime]
+    ) -> list[tuple[int, datetime, float | None]]:
+        """(message, sent_at, amount) of the records in the worksheets sent at these times."""
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(Record.key, Record.sent_at, Record.amount)
+                .where(
+                    Record.chat_id == chat_id,
+                    Record.worksheet.in_(worksheets),
+                    Record.sent_at.in_(times),
+                )
+                .distinct()
+            )
+            return [(int(k), sent_at, amount) for k, sent_at, amount in result.tuples() if k.isdigit()]
+
+    async def _pending(self, session: AsyncSession, chat_id: int, worksheet: str) -> set[str]:
+        """Keys of the worksheet's rows still in the outbox."""
+        result = await session.execute(
+            select(OutboxRow.message_id)
+            .where(OutboxRow.chat_id == chat_id, OutboxRow.worksheet == worksheet)
+            .distinct()
+        )
+        return {str(m) for m in result.scalars()}
+
+    async def sync(self, chat_id: int, sheet: Transaction) -> int:
+        """Bring the copy of a worksheet up to date with the sheet, return number of changed rows."""
+        # queued rows are not in the sheet yet but not stale either,
+        # looked up before the read and again after it, for those queued meanwhile
+        async with self.async_session() as session:
+            pending = await self._pending(session, chat_id, sheet.ws_name)
+        agw, _ = await sheet.get_agw()
+        rows = await agw.get_values(value_render_option=ValueRenderOption.unformatted)
+        fresh = {k: to_record(sheet, row) for k, row in keyed(rows[1:]).items()}
+
+        async with self.async_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    select(Record.id, Record.key, Record.seq, Record.digest)
+                    .where(
+                        Record.chat_id == chat_id,
+                        Record.worksheet == sheet.ws_name,
+                        # archived rows are no longer in the sheet, but still count in reports
+                        Record.archive.is_(None),
+                    )
+                )
+                known = {(r.key, r.seq): (r.id, r.digest) for r in result}
+                pending |= await self._pending(session, chat_id, sheet.ws_name)
+                stale = [i for k, (i, _) in known.items() if k not in fresh and k[0] not in pending]
+                changed = [
+                    dict(chat_id=chat_id, worksheet=sheet.ws_name, key=key, seq=seq, **record)
+                    for (key, seq), record in fresh.items()
+                    if known.get((key, seq), (None, None))[1] != record['digest']
+                ]
+                if stale:
+                    await session.execute(delete(Record).where(Record.id.in_(stale)))
+                # keep statements within asyncpg's limit of query arguments
+                for i in range(0, len(changed), 1000):
+                    await self._upsert(session, changed[i:i + 1000])
+                if 'category' in sheet.fields:
+                    await budgets.recount(session, chat_id, sheet.ws_name)
+        return len(stale) + len(changed)
+
+    async def sync_chat(self, agcm: AsyncioGspreadClientManager, chat: Chat):
+        agc = await agcm.authorize()
+        ags = await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)
+        for sheet_cls in MIRRORED:
+            changes = await self.sync(chat.chat_id, sheet_cls(ags))
+            if changes:
+                log.info('mirror of %s for chat %s: %d rows changed', sheet_cls.ws_name, chat.chat_id, changes)
+
+    async def run(self, agcm: AsyncioGspreadClientManager):
+        """Periodic diff scans of all chats' sheets, with background priority."""
+        while True:
+            await asyncio.sleep(self.interval)
+            async with self.async_session() as session:
+                result = await session.execute(select(Chat).where(Chat.sheet_url.is_not(None)))
+                chats = result.scalars().all()
+            with background():
+                for chat in chats:
+                    try:
+                        await self.sync_chat(agcm, chat)
+                    except Exception:
+                        log.exception('failed to sync mirror of chat %s', chat.chat_id)
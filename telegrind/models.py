@@ -1,7 +1,9 @@
+from datetime import date, datetime
 from typing import Optional
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import BigInteger
+from sqlalchemy import BigInteger, DateTime, Index, UniqueConstraint, func
+from sqlalchemy.dialects.postgresql import JSONB
 
 
 class Model(AsyncAttrs, DeclarativeBase):
@@ -10,6 +12,9 @@ class Model(AsyncAttrs, DeclarativeBase):
 
 class Chat(Model):
     __tablename__ = 'chat'
+    __table_args__ = (
+        Index('ix_chat_chat_id', 'chat_id', unique=True),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     chat_id: Mapped[int] = mapped_column('chat_id', BigInteger)
@@ -22,3 +27,173 @@ class File(Model):
     id: Mapped[int] = mapped_column(primary_key=True)
     file_id: Mapped[str]
     filename: Mapped[str]
+
+
+class RowRef(Model):
+    """Where the row of a message lives in the chat's spreadsheet."""
+    __tablename__ = 'row_ref'
+    __table_args__ = (
+        UniqueConstraint('chat_id', 'message_id', 'worksheet'),
+        Index('ix_row_ref_chat_worksheet_row_id', 'chat_id', 'worksheet', 'row_id'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    message_id: Mapped[int] = mapped_column(BigInteger)
+    worksheet: Mapped[str]
+    row_id: Mapped[int]
+
+
+class Record(Model):
+    """Local copy of a worksheet row, for reports."""
+    __tablename__ = 'record'
+    __table_args__ = (
+        # '#' repeats for all the commodities of a ticket, seq tells them apart
+        UniqueConstraint('chat_id', 'worksheet', 'key', 'seq'),
+        Index('ix_record_chat_worksheet_date', 'chat_id', 'worksheet', 'date'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    worksheet: Mapped[str]
+    key: Mapped[str]
+    seq: Mapped[int] = mapped_column(default=0)
+    amount: Mapped[Optional[float]]
+    currency: Mapped[Optional[str]]
+    date: Mapped[Optional[datetime]]
+    counterparty: Mapped[Optional[str]]
+    description: Mapped[Optional[str]]
+    category: Mapped[Optional[str]]
+    digest: Mapped[str]
+    # title of the worksheet the row was moved to, see telegrind.archive
+    archive: Mapped[Optional[str]]
+    # when the record's message was sent, forwards of it tell only that
+    sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+
+
+class CategoryTotal(Model):
+    """Running total of a month's expenses in a category, see telegrind.budgets."""
+    __tablename__ = 'category_total'
+    __table_args__ = (
+        UniqueConstraint('chat_id', 'category', 'currency', 'month'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    category: Mapped[str]
+    currency: Mapped[str]
+    month: Mapped[datetime]
+    amount: Mapped[float]
+
+
+class ArchiveRange(Model):
+    """Rows of a worksheet moved to a yearly archive in one go, and the range of their '#'."""
+    __tablename__ = 'archive_range'
+    __table_args__ = (
+        Index('ix_archive_range_chat_keys', 'chat_id', 'first_key', 'last_key'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    worksheet: Mapped[str]
+    title: Mapped[str]
+    first_key: Mapped[int] = mapped_column(BigInteger)
+    last_key: Mapped[int] = mapped_column(BigInteger)
+    rows: Mapped[int]
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+
+class Ticket(Model):
+    """Fiscal receipt recorded by a chat, so that it is recorded once, see telegrind.tickets."""
+    __tablename__ = 'ticket'
+    __table_args__ = (
+        UniqueConstraint('chat_id', 'fiscal_id'),
+        Index('ix_ticket_chat_message', 'chat_id', 'message_id'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    fiscal_id: Mapped[str]
+    # the message that recorded it
+    message_id: Mapped[int] = mapped_column(BigInteger)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+
+class FxRate(Model):
+    """Units of a currency per US dollar on a day, see telegrind.rates."""
+    __tablename__ = 'fx_rate'
+    __table_args__ = (
+        UniqueConstraint('day', 'currency'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    day: Mapped[date]
+    currency: Mapped[str]
+    per_usd: Mapped[float]
+
+
+class RecurringPayment(Model):
+    """Monthly payment to remind about, see telegrind.recurring."""
+    __tablename__ = 'recurring_payment'
+    __table_args__ = (
+        Index('ix_recurring_payment_chat_id', 'chat_id'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    title: Mapped[str]
+    category: Mapped[Optional[str]]
+    amount: Mapped[float]
+    currency: Mapped[str]
+    day: Mapped[int]
+    dt_offset: Mapped[int]
+    next_due: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
+
+class OutboxRow(Model):
+    """Row waiting to be appended to the chat's sheet, see telegrind.outbox."""
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        Index('ix_outbox_chat_message', 'chat_id', 'message_id'),
+    )
+
+    # delivery order
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    sheet_url: Mapped[str]
+    worksheet: Mapped[str]
+    message_id: Mapped[int] = mapped_column(BigInteger)
+    row: Mapped[list] = mapped_column(JSONB)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    attempts: Mapped[int] = mapped_column(default=0)
+    # being appended right now, edits and deletes must go to the sheet
+    sending: Mapped[bool] = mapped_column(default=False)
+    # when it was taken for appending, a crashed deliverer's claim expires
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+    error: Mapped[Optional[str]]
+
+
+class FsmState(Model):
+    """Conversation state of a chat's user, see telegrind.bot.storage."""
+    __tablename__ = 'fsm_state'
+
+    # built by aiogram's key builder, bot, chat and user ids
+    key: Mapped[str] = mapped_column(primary_key=True)
+    state: Mapped[Optional[str]]
+    data: Mapped[dict] = mapped_column(JSONB, default=dict)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+
+class HandledUpdate(Model):
+    """Telegram update taken by one of the bot instances, see telegrind.bot.storage."""
+    __tablename__ = 'handled_update'
+    __table_args__ = (
+        Index('ix_handled_update_claimed_at', 'claimed_at'),
+    )
+
+    update_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    claimed_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    # False while being handled, a crashed instance's claim expires
+    done: Mapped[bool] = mapped_column(default=False)
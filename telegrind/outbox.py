@@ -0,0 +1,362 @@
+"""Durable queue of rows on their way to the chat's sheet.
+
+Handlers commit rows here and acknowledge the user right away, the process running
+background jobs appends them to the sheets in order, a chat's rows for all of its worksheets
+(e.g. a receipt's expense and commodities) in a single request.
+Rows stay in the outbox until the sheet has them, so they survive Google outages and restarts.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+from gspread_asyncio import AsyncioGspreadClientManager
+from sqlalchemy import select, insert, update, delete, func, or_
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+from . import metrics
+from .index import RowIndex
+from .models import OutboxRow
+from .sheets import (
+    DATE_FORMAT,
+    Transaction,
+    Outcome,
+    Loan,
+    Commodity,
+    Wish,
+    open_spreadsheet,
+    keys_of,
+    append_many,
+)
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'outbox'
+SHEETS = {s.ws_name: s for s in (Outcome, Loan, Commodity, Wish)}
+# worksheets with a row per message, tracked by the row index
+INDEXED = (Outcome.ws_name, Loan.ws_name, Wish.ws_name)
+
+# (chat_id, sheet_url)
+Key = tuple[int, str]
+Delivered = Callable[[int, list[int]], Awaitable]
+
+
+def jsonable(row: list) -> list:
+    # sheets.to_cell parses dates back
+    return [v.strftime(DATE_FORMAT) if isinstance(v, datetime) else v for v in row]
+
+
+class Outbox:
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        async_session: async_sessionmaker[AsyncSession],
+        index: RowIndex,
+        batch: int = 1000,
+        max_backoff: float = 300,
+        poll_interval: float = 60,
+        lease: float = 600,
+        concurrency: int = 4,
+    ):
+        self.engine = engine
+        self.async_session = async_session
+        self.index = index
+        self.batch = batch
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        # longer than any append takes, see release
+        self.lease = timedelta(seconds=lease)
+        # sheets appended at once, each holds a pooled connection and takes Sheets write quota
+        self.concurrency = concurrency
+        self._failures: dict[Key, int] = {}
+        # loop time before which a failed worksheet is left alone
+        self._retry_at: dict[Key, float] = {}
+        self._wakeup = asyncio.Event()
+
+    async def put(
+        self,
+        chat_id: int,
+        sheet_url: str,
+        batches: list[tuple[type[Transaction] | Transaction, list[list]]],
+    ):
+        """Queue rows keyed by message id, committed when this returns."""
+        values = [
+            dict(
+                chat_id=chat_id,
+                sheet_url=sheet_url,
+                worksheet=sheet.ws_name,
+                message_id=int(row[0]),
+                row=jsonable(row),
+            )
+            for sheet, rows in batches
+            for row in rows
+        ]
+        if not values:
+            return
+        async with self.async_session() as session:
+            async with session.begin():
+                await session.execute(insert(OutboxRow), values)
+                await session.execute(select(func.pg_notify(CHANNEL, str(chat_id))))
+
+    async def pending(self, chat_id: int, message_id: int) -> OutboxRow | None:
+        """Message's row which is not in the sheet yet and still can be changed."""
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(OutboxRow)
+                .where(
+                    OutboxRow.chat_id == chat_id,
+                    OutboxRow.message_id == message_id,
+                    OutboxRow.worksheet.in_(INDEXED),
+                    ~OutboxRow.sending,
+                )
+                .order_by(OutboxRow.id)
+                .limit(1)
+            )
+            return result.scalar_one_or_none()
+
+    async def replace(self, row_id: int, row: list) -> bool:
+        """Change a queued row, False when it is being appended already."""
+        async with self.async_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    update(OutboxRow)
+                    .where(OutboxRow.id == row_id, ~OutboxRow.sending)
+                    .values(row=jsonable(row))
+                    .returning(OutboxRow.id)
+                )
+                return result.first() is not None
+
+    async def discard(self, chat_id: int, *message_ids: int) -> list[tuple[int, str]]:
+        """Drop messages' queued rows, return (message, worksheet) of each."""
+        async with self.async_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    delete(OutboxRow)
+                    .where(
+                        OutboxRow.chat_id == chat_id,
+                        OutboxRow.message_id.in_(message_ids),
+                        ~OutboxRow.sending,
+                    )
+                    .returning(OutboxRow.message_id, OutboxRow.worksheet)
+                )
+                return sorted({tuple(r) for r in result})
+
+    async def wait_sent(self, chat_id: int, *message_ids: int, timeout: float = 10):
+        """Wait until messages' rows being appended right now are in the sheet (or failed)."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            async with self.async_session() as session:
+                result = await session.execute(
+                    select(OutboxRow.id)
+                    .where(
+                        OutboxRow.chat_id == chat_id,
+                        OutboxRow.message_id.in_(message_ids),
+                        OutboxRow.sending,
+                    )
+                    .limit(1)
+                )
+                if result.first() is None:
+                    return
+            await asyncio.sleep(.5)
+
+    async def stats(self, chat_id: int) -> tuple[int, datetime | None, str | None]:
+        """Number of chat's queued rows, when the oldest was queued and the last delivery error."""
+        async with self.async_session() as session:
+            count, oldest = (await session.execute(
+                select(func.count(), func.min(OutboxRow.created_at)).where(OutboxRow.chat_id == chat_id)
+            )).one()
+            error = (await session.execute(
+                select(OutboxRow.error)
+                .where(OutboxRow.chat_id == chat_id, OutboxRow.error.is_not(None))
+                .order_by(OutboxRow.id)
+                .limit(1)
+            )).scalar_one_or_none()
+        return count, oldest, error
+
+    def _failed(self, key: Key):
+        failures = self._failures[key] = self._failures.get(key, 0) + 1
+        loop = asyncio.get_running_loop()
+        self._retry_at[key] = loop.time() + min(self.max_backoff, 2 ** failures)
+
+    async def deliver(
+        self, agcm: AsyncioGspreadClientManager, key: Key, delivered: Delivered | None = None
+    ) -> int:
+        """Append the next batch of a sheet's rows, return number of rows taken off the outbox."""
+        chat_id, sheet_url = key
+        async with self.async_session() as session:
+            async with session.begin():
+                batch = (
+                    select(OutboxRow.id)
+                    .where(
+                        OutboxRow.chat_id == chat_id,
+                        OutboxRow.sheet_url == sheet_url,
+                        ~OutboxRow.sending,
+                    )
+                    .order_by(OutboxRow.id)
+                    .limit(self.batch)
+                    .with_for_update(skip_locked=True)
+                )
+                # edits and deletes leave rows alone from now on
+                result = await session.execute(
+                    update(OutboxRow)
+                    .where(OutboxRow.id.in_(batch.scalar_subquery()), ~OutboxRow.sending)
+                    .values(sending=True, claimed_at=func.now(), attempts=OutboxRow.attempts + 1)
+                    .returning(OutboxRow)
+                    .execution_options(synchronize_session=False)
+                )
+                rows = sorted(result.scalars(), key=lambda r: r.id)
+        if not rows:
+            return 0
+        ids = [r.id for r in rows]
+        by_worksheet: dict[str, list[OutboxRow]] = {}
+        for r in rows:
+            by_worksheet.setdefault(r.worksheet, []).append(r)
+
+        try:
+            agc = await agcm.authorize()
+            ags = await open_spreadsheet(agc, chat_id, sheet_url)
+            sheets = [SHEETS[w](ags) for w in by_worksheet]
+            # where the rows go, and whether a previous attempt got there without us knowing
+            keys = dict(zip(by_worksheet, await keys_of(ags, sheets)))
+            todo = {
+                w: [r for r in worksheet_rows if r.attempts == 1 or str(r.message_id) not in keys[w]]
+                for w, worksheet_rows in by_worksheet.items()
+            }
+            first_rows = {}
+            if any(todo.values()):
+                # indexed rows are looked for below the last '#', in what the update returns
+                after = [len(keys[w]) if w in INDEXED else None for w in by_worksheet]
+                first_rows = dict(zip(by_worksheet, await append_many(
+                    ags, sheets, [[r.row for r in todo[w]] for w in by_worksheet], after
+                )))
+        except Exception as e:
+            log.warning('failed to append %d outbox rows of chat %s: %r', len(rows), chat_id, e)
+            async with self.async_session() as session:
+                async with session.begin():
+                    await session.execute(
+                        update(OutboxRow)
+                        .where(OutboxRow.id.in_(ids))
+                        .values(sending=False, claimed_at=None, error=str(e)[:500])
+                    )
+            metrics.outbox_rows.inc(len(rows), result='failed')
+            self._failed(key)
+            return 0
+
+        self._failures.pop(key, None)
+        self._retry_at.pop(key, None)
+        message_ids = {r.message_id for r in rows}
+        async with self.async_session() as session:
+            async with session.begin():
+                await session.execute(delete(OutboxRow).where(OutboxRow.id.in_(ids)))
+                result = await session.execute(
+                    select(OutboxRow.message_id)
+                    .where(OutboxRow.chat_id == chat_id, OutboxRow.message_id.in_(message_ids))
+                )
+                # e.g. more of the chat's rows than a batch
+                waiting = set(result.scalars())
+        for w, worksheet_rows in todo.items():
+            # not found e.g. when sorted by hand right away, deletes and edits will look for them
+            if first_rows.get(w):
+                await self.index.add(chat_id, w, [r.message_id for r in worksheet_rows], first_rows[w])
+
+        now = datetime.now(timezone.utc)
+        for r in rows:
+            metrics.outbox_lag.observe((now - r.created_at).total_seconds())
+        appended = sum(map(len, todo.values()))
+        metrics.outbox_rows.inc(appended, result='delivered')
+        if len(rows) > appended:
+            metrics.outbox_rows.inc(len(rows) - appended, result='skipped')
+
+        if delivered and (done := sorted(message_ids - waiting)):
+            try:
+                await delivered(chat_id, done)
+            except Exception:
+                log.exception('failed to report delivered rows of chat %s', chat_id)
+        return len(rows)
+
+    async def drain(
+        self, agcm: AsyncioGspreadClientManager, delivered: Delivered | None = None
+    ) -> tuple[int, float | None]:
+        """One batch of every sheet with queued rows, `concurrency` sheets at a time.
+
+        Return number of rows taken off the outbox and seconds until the nearest retry, if any.
+        """
+        await self.release()
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(OutboxRow.chat_id, OutboxRow.sheet_url)
+                .where(~OutboxRow.sending)
+                .distinct()
+            )
+            keys = [tuple(r) for r in result]
+        # sheets emptied by deletes
+        for key in set(self._retry_at) - set(keys):
+            del self._retry_at[key]
+            self._failures.pop(key, None)
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(key: Key) -> int:
+            async with semaphore:
+                return await self.deliver(agcm, key, delivered)
+
+        counts = await asyncio.gather(*(deliver(key) for key in keys if self._retry_at.get(key, 0) <= now))
+        now = loop.time()
+        retry_in = min((max(0., t - now) for t in self._retry_at.values()), default=None)
+        return sum(counts), retry_in
+
+    async def release(self) -> int:
+        """Put back rows whose append was interrupted (e.g. by a crash), return how many.
+
+        They are checked against the sheet on retry. Claims of a live deliverer are left alone.
+        """
+        async with self.async_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    update(OutboxRow)
+                    .where(
+                        OutboxRow.sending,
+                        # or claimed before claims had a time
+                        or_(OutboxRow.claimed_at.is_(None), OutboxRow.claimed_at < func.now() - self.lease),
+                    )
+                    .values(sending=False, claimed_at=None)
+                    .returning(OutboxRow.id)
+                )
+                released = len(result.all())
+        if released:
+            log.warning('released %d outbox rows of an interrupted append', released)
+        return released
+
+    def _notified(self, connection, pid, channel, payload):
+        self._wakeup.set()
+
+    async def run(self, agcm: AsyncioGspreadClientManager, delivered: Delivered | None = None):
+        """Deliver rows as they come, until cancelled or the database connection is lost."""
+        async with self.engine.connect() as conn:
+            # out of transactions, notifications wait for them to end
+            conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+            try:
+                raw = await conn.get_raw_connection()
+                await raw.driver_connection.add_listener(CHANNEL, self._notified)
+                while True:
+                    self._wakeup.clear()
+                    try:
+                        count, retry_in = await self.drain(agcm, delivered)
+                    except Exception:
+                        log.exception('failed to drain outbox')
+                        count, retry_in = 0, None
+                    if count:
+                        # more may have come meanwhile, or not fit in a batch
+                        continue
+                    timeout = self.poll_interval if retry_in is None else min(retry_in, self.poll_interval)
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        # notifications would not come over a lost connection, see Leader
+                        await conn.execute(select(1))
+            finally:
+                # not pooled along with the listener
+                await conn.invalidate()
@@ -0,0 +1,84 @@
+"""Message text classifier.
+
+A single compiled pattern tells records apart and takes them apart in one pass.
+The router filter attaches the result (see Transaction.classify) and make_row consumes it,
+only the date is searched for later, as relative dates depend on the chat's clock.
+"""
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+OUTCOME, LOAN, WISH = 'outcome', 'loan', 'wish'
+
+_amount = r'\d+(?:[\.,]\d+)?'
+_curr = r'[A-z]{3}'
+_date = r'\d{2}\.\d{2}\.\d{4}'
+CATEGORY = re.compile(r'#(\w+)')
+
+# alternatives in the order handlers used to be tried
+PATTERN = re.compile(rf'''
+    (?P<outcome>{_amount})\b (?:\s*(?P<currency>{_curr})\b)? (?P<text>(?s:.*))
+    |(?:долг|за[еёйи]м)\ (?P<who>.*?)\ (?P<sign>[+-])?(?P<loan>{_amount})
+        (?:\ (?P<loan_currency>{_curr}))? (?:\ (?P<date>{_date}))? (?:\ (?P<loan_text>.*))?$
+    |хочу\s+(?P<wish>.*?)$
+''', re.I | re.X)
+
+
+@dataclass(frozen=True)
+class Parsed:
+    kind: str
+    amount: float | None = None
+    # None when omitted, the chat's default applies
+    currency: str | None = None
+    # loans only, dd.mm.yyyy as written
+    date: str | None = None
+    counterparty: str | None = None
+    # expenses' description still has the date in it, if any
+    description: str | None = None
+    category: str | None = None
+
+
+def to_amount(text: str) -> float:
+    return float(text.replace(',', '.'))
+
+
+@lru_cache(maxsize=1024)
+def classify(text: str) -> Parsed | None:
+    """What kind of record the text is, if any, with its fields.
+
+    Cached, as several router filters ask about the same text.
+    """
+    match = PATTERN.match(text)
+    if not match:
+        return None
+    g = match.groupdict()
+
+    if g['outcome'] is not None:
+        text = g['text'].strip()
+        category = None
+        # a hashtag anywhere in the comment
+        tag = CATEGORY.search(text)
+        if tag:
+            category = tag.group(1).lower()
+            text = ' '.join(text.replace(tag.group(), '', 1).split())
+        return Parsed(
+            OUTCOME,
+            amount=to_amount(g['outcome']),
+            currency=g['currency'].upper() if g['currency'] else None,
+            description=text,
+            category=category,
+        )
+
+    if g['loan'] is not None:
+        # -100 and 100 both mean loan, +100 means payback
+        direction = -1 if g['sign'] in ('-', None) else 1
+        return Parsed(
+            LOAN,
+            amount=to_amount(g['loan']) * direction,
+            currency=g['loan_currency'],
+            date=g['date'],
+            counterparty=g['who'].strip() or 'Неизвестно',
+            description=g['loan_text'],
+        )
+
+    return Parsed(WISH, description=g['wish'])
@@ -0,0 +1,173 @@
+"""Exchange rates for totals over records in several currencies.
+
+Rates are kept in Postgres by day as units of a currency per US dollar, so a single request
+to the provider fills every currency of the day, and any pair converts through the dollar.
+Conversion happens inside the report queries, a whole column at once (see `converted`),
+amounts without a known rate stay in their own currency.
+"""
+import asyncio
+import logging
+from datetime import date
+from typing import Iterable, Protocol
+
+import aiohttp
+from sqlalchemy import select, func, case, literal, ColumnElement
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from . import cache
+from .models import FxRate, Record
+
+log = logging.getLogger(__name__)
+
+# free daily rates of ~300 currencies, tenge included, by day since 2024-03
+RATES_API_URL = 'https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@{day}/v1/currencies/usd.json'
+
+
+class RateProvider(Protocol):
+    async def fetch(self, day: date) -> dict[str, float]:
+        """Units of every currency per US dollar on the day."""
+        ...
+
+    async def close(self) -> None:
+        ...
+
+
+class CurrencyApi:
+    """Fetches daily rates from fawazahmed0/exchange-api over one pooled HTTP session."""
+
+    def __init__(self, api_url: str = RATES_API_URL, timeout: float = 10):
+        self.api_url = api_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # created lazily, it must be created inside the running loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        return self._session
+
+    async def fetch(self, day: date) -> dict[str, float]:
+        # today's rates are published during the day
+        label = 'latest' if day >= date.today() else day.isoformat()
+        async with self.session.get(self.api_url.format(day=label)) as resp:
+            resp.raise_for_status()
+            data = await resp.json(content_type=None)
+        return {
+            code.upper(): float(rate)
+            for code, rate in data['usd'].items()
+            if len(code) == 3 and isinstance(rate, (int, float)) and rate > 0
+        }
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
+def per_usd(currency, day) -> ColumnElement:
+    return (
+        select(FxRate.per_usd)
+        .where(FxRate.day == day, FxRate.currency == currency)
+        .scalar_subquery()
+    )
+
+
+def converted(amount, currency, day, target: str) -> tuple[ColumnElement, ColumnElement]:
+    """Amount in `target` and `target` itself, or the amount as is with its currency when there's no rate.
+
+    Records without currency are in the chat's currency, which `target` is expected to be.
+    """
+    rate = case(
+        (func.coalesce(currency, target) == target, literal(1.0)),
+        else_=per_usd(target, day) / per_usd(currency, day),
+    )
+    return (
+        amount * func.coalesce(rate, 1.0),
+        case((rate.is_(None), currency), else_=literal(target)),
+    )
+
+
+class Rates:
+    def __init__(
+        self,
+        async_session: async_sessionmaker[AsyncSession],
+        provider: RateProvider,
+        concurrency: int = 4,
+        retry_after: float = 3600,
+    ):
+        self.async_session = async_session
+        self.provider = provider
+        self.concurrency = concurrency
+        # days the provider failed for, not asked again for a while
+        self._failed = cache.TTLCache('failed rates', maxsize=1024, ttl=retry_after)
+        self._tasks: set[asyncio.Task] = set()
+
+    async def _fetch(self, day: date, semaphore: asyncio.Semaphore) -> list[dict]:
+        async with semaphore:
+            try:
+                rates = await self.provider.fetch(day)
+            except Exception as e:
+                log.warning('failed to fetch exchange rates of %s: %r', day, e)
+                self._failed.set(day, True)
+                return []
+        return [dict(day=day, currency=c, per_usd=r) for c, r in rates.items()]
+
+    async def fill(self, days: Iterable[date]):
+        """Make sure rates of the days are stored, what is missing is fetched concurrently."""
+        days = {d for d in days if not cache.rates.get(d) and not self._failed.get(d)}
+        if not days:
+            return
+        async with self.async_session() as session:
+            result = await session.execute(select(FxRate.day).where(FxRate.day.in_(days)).distinct())
+            stored = set(result.scalars())
+        for day in stored:
+            cache.rates.set(day, True)
+        missing = sorted(days - stored)
+        if not missing:
+            return
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        fetched = await asyncio.gather(*(self._fetch(day, semaphore) for day in missing))
+        values = [v for day_values in fetched for v in day_values]
+        async with self.async_session() as session:
+            async with session.begin():
+                # keep statements within asyncpg's limit of query arguments
+                for i in range(0, len(values), 5000):
+                    await session.execute(
+                        insert(FxRate).values(values[i:i + 5000]).on_conflict_do_nothing(
+                            index_elements=[FxRate.day, FxRate.currency]
+                        )
+                    )
+        for day_values in fetched:
+            if day_values:
+                cache.rates.set(day_values[0]['day'], True)
+
+    def fill_soon(self, days: Iterable[date]):
+        """Fill the days in the background, for callers that make do with the rates stored so far."""
+        days = {d for d in days if not cache.rates.get(d) and not self._failed.get(d)}
+        if days:
+            task = asyncio.create_task(self.fill(days))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def fill_records(self, chat_id: int, worksheet: str, currency: str, since: date | None = None):
+        """Rates of the days of the worksheet's records in other currencies."""
+        day = func.date(Record.date)
+        stmt = select(day).where(
+            Record.chat_id == chat_id,
+            Record.worksheet == worksheet,
+            Record.currency.is_not(None),
+            Record.currency != currency,
+            Record.date.is_not(None),
+        )
+        if since:
+            stmt = stmt.where(Record.date >= since)
+        async with self.async_session() as session:
+            days = set((await session.execute(stmt.distinct())).scalars())
+        await self.fill(days)
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.provider.close()
@@ -0,0 +1,179 @@
+"""Recurring payments reminders.
+
+Payments live in Postgres, the process running background jobs keeps a min-heap
+of their due times and sleeps until the nearest one, so idle subscriptions cost nothing.
+Changes made by any process reach the heap via Postgres NOTIFY.
+Reminders missed while the bot was down are sent once on start.
+"""
+import asyncio
+import calendar
+import heapq
+import logging
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import TelegramRetryAfter
+from sqlalchemy import select, update, func
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+from .models import RecurringPayment
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'recurring_payment'
+# local time of day to remind at
+REMIND_HOUR = 10
+# e.g. '15 5000 USD интернет #связь' - day of month, amount, optional currency, title
+PATTERN = re.compile(r'^(\d{1,2})\s+(\d+(?:[\.,]\d+)?)(?:\s+([A-z]{3})\b)?\s+(.+)$')
+
+Send = Callable[[int, list[RecurringPayment]], Awaitable]
+
+
+def next_due(day: int, dt_offset: int, after: datetime) -> datetime:
+    """First reminder time after `after`, short months remind on their last day."""
+    tz = timezone(timedelta(hours=dt_offset))
+    local = after.astimezone(tz)
+    year, month = local.year, local.month
+    while True:
+        last = calendar.monthrange(year, month)[1]
+        due = datetime(year, month, min(day, last), REMIND_HOUR, tzinfo=tz)
+        if due > after:
+            return due
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def parse(text: str) -> dict | None:
+    """Payment fields from text like PATTERN, currency is None when omitted."""
+    match = PATTERN.match(text.strip())
+    if not match:
+        return None
+    day, amount, curr, title = match.groups()
+    if not 1 <= int(day) <= 31:
+        return None
+    category = None
+    tag = re.search(r'#(\w+)', title)
+    if tag:
+        category = tag.group(1).lower()
+        title = ' '.join(title.replace(tag.group(), '', 1).split())
+    return dict(
+        day=int(day),
+        amount=float(amount.replace(',', '.')),
+        currency=curr.upper() if curr else None,
+        title=title or category,
+        category=category,
+    )
+
+
+async def notify(session: AsyncSession, payment_id: int):
+    """Let the scheduler know the payment was added, changed or removed (delivered on commit)."""
+    await session.execute(select(func.pg_notify(CHANNEL, str(payment_id))))
+
+
+class Reminders:
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        async_session: async_sessionmaker[AsyncSession],
+        per_second: int = 25,
+    ):
+        self.engine = engine
+        self.async_session = async_session
+        # telegram allows about 30 messages per second to different chats
+        self.per_second = per_second
+        self._heap: list[tuple[datetime, int]] = []
+        # actual due time by payment id, heap entries that don't match are stale
+        self._due: dict[int, datetime] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: set[asyncio.Task] = set()
+
+    def schedule(self, payment_id: int, due: datetime):
+        self._due[payment_id] = due
+        heapq.heappush(self._heap, (due, payment_id))
+        self._wakeup.set()
+
+    def unschedule(self, payment_id: int):
+        # its heap entry is dropped when it comes up
+        self._due.pop(payment_id, None)
+
+    async def load(self, ids: list[int] | None = None):
+        """(Re)schedule given payments, or all of them."""
+        stmt = select(RecurringPayment.id, RecurringPayment.next_due)
+        if ids is not None:
+            stmt = stmt.where(RecurringPayment.id.in_(ids))
+        async with self.async_session() as session:
+            found = dict((await session.execute(stmt)).all())
+        for payment_id in ids or ():
+            if payment_id not in found:
+                self.unschedule(payment_id)
+        for payment_id, due in found.items():
+            self.schedule(payment_id, due)
+
+    def _notified(self, connection, pid, channel, payload):
+        task = asyncio.create_task(self.load([int(payload)]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def pop_due(self, now: datetime) -> list[int]:
+        ids = []
+        while self._heap and self._heap[0][0] <= now:
+            due, payment_id = heapq.heappop(self._heap)
+            if self._due.get(payment_id) == due:
+                del self._due[payment_id]
+                ids.append(payment_id)
+        return ids
+
+    async def _send(self, send: Send, chat_id: int, payments: list[RecurringPayment]):
+        for attempt in range(2):
+            try:
+                return await send(chat_id, payments)
+            except TelegramRetryAfter as e:
+                if attempt:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+    async def fire(self, send: Send, ids: list[int]):
+        """Remind about due payments, one message per chat, within the rate limit.
+
+        Payments are moved to their next due time before sending, so a reminder
+        is never sent twice, even by an instance that took over the jobs meanwhile.
+        """
+        now = datetime.now(timezone.utc)
+        async with self.async_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    select(RecurringPayment)
+                    .where(RecurringPayment.id.in_(ids), RecurringPayment.next_due <= now)
+                    # a concurrent fire waits, then finds them not due anymore
+                    .with_for_update()
+                )
+                payments = result.scalars().all()
+                # missed reminders are not repeated for every missed month
+                due = {p.id: next_due(p.day, p.dt_offset, now) for p in payments}
+                if due:
+                    await session.execute(
+                        update(RecurringPayment), [dict(id=i, next_due=d) for i, d in due.items()]
+                    )
+        for payment_id, d in due.items():
+            self.schedule(payment_id, d)
+        if skipped := [i for i in ids if i not in due]:
+            # moved or reminded about meanwhile
+            await self.load(skipped)
+
+        by_chat = defaultdict(list)
+        for p in payments:
+            by_chat[p.chat_id].append(p)
+        chats = list(by_chat.items())
+        loop = asyncio.get_running_loop()
+        for i in range(0, len(chats), self.per_second):
+            started = loop.time()
+            results = await asyncio.gather(
+                *(self._send(send, chat_id, items) for chat_id, items in chats[i:i + self.per_second]),
+                return_exceptions=True,
+            )
+            for (chat_id, _), r in zip(chats[i:i + self.per_second], results):
+                if isinstance(r, Exception):
+                    log.warning('failed to remind chat %s about payments: %s', chat_id, r)
+            if i + self.per_second < len(chats):
+                await asyncio.sleep(max(0., 1 - (loop.time() - started)))
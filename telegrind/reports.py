@@ -0,0 +1,94 @@
+"""Reports over the local mirror of the sheets (see telegrind.mirror).
+
+Given the chat's currency, amounts in other currencies are converted to it (see telegrind.rates),
+those without a known rate are reported in their own currency.
+"""
+from datetime import date, datetime
+
+from sqlalchemy import select, func, literal
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import Record, CategoryTotal
+from .rates import converted
+from .sheets import Outcome, Loan
+
+
+async def monthly_totals(
+    session: AsyncSession, chat_id: int, since: datetime, currency: str | None = None
+) -> list[tuple[datetime, str, float]]:
+    """Expenses by (month, currency), converted at the rates of their days."""
+    amount, curr = Record.amount, Record.currency
+    if currency:
+        amount, curr = converted(amount, curr, func.date(Record.date), currency)
+    rows = (
+        select(
+            func.date_trunc('month', Record.date).label('month'),
+            curr.label('currency'),
+            amount.label('amount'),
+        )
+        .where(
+            Record.chat_id == chat_id,
+            Record.worksheet == Outcome.ws_name,
+            Record.date >= since,
+        )
+        .subquery()
+    )
+    result = await session.execute(
+        select(rows.c.month, rows.c.currency, func.sum(rows.c.amount))
+        .group_by(rows.c.month, rows.c.currency)
+        .order_by(rows.c.month, rows.c.currency)
+    )
+    return [tuple(r) for r in result]
+
+
+async def loan_balances(
+    session: AsyncSession, chat_id: int, currency: str | None = None, day: date | None = None
+) -> list[tuple[str, str, float]]:
+    """Unsettled loans by (borrower, currency), negative means they owe us.
+
+    Loans are netted in their own currencies first and converted at the rates of `day`,
+    so a loan paid back in another currency settles whatever the rates did meanwhile.
+    """
+    balances = (
+        select(Record.counterparty, Record.currency, func.sum(Record.amount).label('amount'))
+        .where(Record.chat_id == chat_id, Record.worksheet == Loan.ws_name)
+        .group_by(Record.counterparty, Record.currency)
+        .subquery()
+    )
+    amount, curr = balances.c.amount, balances.c.currency
+    if currency:
+        amount, curr = converted(amount, curr, literal(day or date.today()), currency)
+    rows = select(balances.c.counterparty, curr.label('currency'), amount.label('amount')).subquery()
+    total = func.sum(rows.c.amount)
+    result = await session.execute(
+        select(rows.c.counterparty, rows.c.currency, total)
+        .group_by(rows.c.counterparty, rows.c.currency)
+        .having(func.abs(total) >= 0.01)
+        .order_by(total)
+    )
+    return [tuple(r) for r in result]
+
+
+async def category_totals(
+    session: AsyncSession, chat_id: int, month: datetime, currency: str | None = None, day: date | None = None
+) -> list[tuple[str, str, float]]:
+    """Month's expenses by (category, currency), from the budget running totals.
+
+    Totals keep no days, other currencies are converted at the rates of `day`.
+    """
+    amount, curr = CategoryTotal.amount, CategoryTotal.currency
+    if currency:
+        amount, curr = converted(amount, curr, literal(day or date.today()), currency)
+    rows = (
+        select(CategoryTotal.category, curr.label('currency'), amount.label('amount'))
+        .where(CategoryTotal.chat_id == chat_id, CategoryTotal.month == month)
+        .subquery()
+    )
+    total = func.sum(rows.c.amount)
+    result = await session.execute(
+        select(rows.c.category, rows.c.currency, total)
+        .group_by(rows.c.category, rows.c.currency)
+        .having(func.abs(total) >= 0.01)
+        .order_by(total.desc())
+    )
+    return [tuple(r) for r in result]
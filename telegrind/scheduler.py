@@ -0,0 +1,239 @@
+"""Quota-aware scheduling of Google Sheets API calls.
+
+Every call made through gspread_asyncio takes a token from the service account bucket
+and from the bucket of the spreadsheet it touches, reads and writes are accounted separately
+(like Google does: https://developers.google.com/sheets/api/limits).
+Interactive calls (handling a user message) go before background ones,
+429 and 5xx responses are retried with jittered exponential backoff.
+"""
+import asyncio
+import itertools
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import gspread
+import requests
+from gspread_asyncio import AsyncioGspreadClientManager
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+INTERACTIVE, BACKGROUND = 0, 1
+PRIORITIES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+priority: ContextVar[int] = ContextVar('sheets_priority', default=INTERACTIVE)
+
+
+@contextmanager
+def background():
+    """Run Sheets calls made inside with background priority."""
+    token = priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+
+# gspread methods that only read, everything else is accounted as a write
+READS = {
+    'acell', 'cell', 'get', 'get_values', 'get_all_values', 'get_all_records', 'batch_get',
+    'find', 'findall', 'col_values', 'row_values', 'worksheet', 'worksheets', 'get_worksheet',
+    'get_worksheet_by_id', 'fetch_sheet_metadata', 'open_by_key', 'open_by_url', 'open',
+    'values_get', 'values_batch_get', 'list_named_ranges', 'list_protected_ranges',
+}
+
+
+def worksheet_of(method) -> str:
+    obj = getattr(method, '__self__', None)
+    return obj.title if isinstance(obj, gspread.Worksheet) else ''
+
+
+def spreadsheet_of(method) -> str | None:
+    obj = getattr(method, '__self__', None)
+    if isinstance(obj, gspread.Worksheet):
+        return obj.spreadsheet_id
+    if isinstance(obj, gspread.Spreadsheet):
+        return obj.id
+    return None
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: float):
+        self.rate = per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Seconds to wait until a token is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def drain(self):
+        self.tokens = 0
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.capacity
+
+
+class Scheduler:
+    """Hands out API call slots by priority, then by arrival, within token bucket limits."""
+
+    def __init__(
+        self,
+        account_per_minute: float = 60,
+        spreadsheet_per_minute: float = 30,
+        burst: float = 10,
+    ):
+        self.spreadsheet_per_minute = spreadsheet_per_minute
+        self.burst = burst
+        self.account = {
+            kind: TokenBucket(account_per_minute, burst) for kind in ('read', 'write')
+        }
+        self.spreadsheets: dict[tuple[str, str], TokenBucket] = {}
+        self._waiting: list[list] = []
+        self._seq = itertools.count()
+        self._pump_task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+
+    def buckets(self, spreadsheet_id: str | None, kind: str) -> list[TokenBucket]:
+        buckets = [self.account[kind]]
+        if spreadsheet_id:
+            key = spreadsheet_id, kind
+            if key not in self.spreadsheets:
+                self.spreadsheets[key] = TokenBucket(self.spreadsheet_per_minute, self.burst)
+            buckets.append(self.spreadsheets[key])
+        return buckets
+
+    async def acquire(self, spreadsheet_id: str | None, kind: str):
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting.append([priority.get(), next(self._seq), spreadsheet_id, kind, fut, time.monotonic()])
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        self._wakeup.set()
+        await fut
+        self.calls += 1
+
+    def throttle(self, spreadsheet_id: str | None, kind: str):
+        """Google said we are over quota, stop using these buckets for a while."""
+        self.throttled += 1
+        for bucket in self.buckets(spreadsheet_id, kind):
+            bucket.drain()
+
+    async def _pump(self):
+        while self._waiting:
+            self._wakeup.clear()
+            now = time.monotonic()
+            wait = None
+            # buckets needed by an earlier (or more important) call must not be taken by later ones
+            reserved = set()
+            self._waiting.sort(key=lambda w: (w[0], w[1]))
+            left = []
+            for entry in self._waiting:
+                _, _, spreadsheet_id, kind, fut, _ = entry
+                if fut.done():  # cancelled
+                    continue
+                buckets = self.buckets(spreadsheet_id, kind)
+                delays = [b.delay(now) for b in buckets]
+                if max(delays) == 0 and not reserved.intersection(map(id, buckets)):
+                    for b in buckets:
+                        b.take()
+                    fut.set_result(None)
+                    continue
+                reserved.update(id(b) for b, d in zip(buckets, delays) if d > 0)
+                if max(delays) > 0:
+                    wait = max(delays) if wait is None else min(wait, max(delays))
+                left.append(entry)
+            self._waiting = left
+            if len(self.spreadsheets) > 1024:
+                self.spreadsheets = {k: b for k, b in self.spreadsheets.items() if not b.full}
+            self._gauge(now)
+            if wait is not None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+            elif left:
+                # held by reservations only, no refill to wait for: until the next call comes
+                await self._wakeup.wait()
+        self._gauge(time.monotonic())
+
+    def _gauge(self, now: float):
+        for level, name in PRIORITIES.items():
+            waiting = [w for w in self._waiting if w[0] == level and not w[4].done()]
+            metrics.sheets_queue.set(len(waiting), priority=name)
+            metrics.sheets_oldest_wait.set(max((now - w[5] for w in waiting), default=0), priority=name)
+
+    def stats(self) -> dict:
+        waiting = [w for w in self._waiting if not w[4].done()]
+        return {
+            'waiting_interactive': sum(1 for w in waiting if w[0] == INTERACTIVE),
+            'waiting_background': sum(1 for w in waiting if w[0] == BACKGROUND),
+            'calls': self.calls,
+            'retries': self.retries,
+            'throttled': self.throttled,
+        }
+
+
+class ScheduledClientManager(AsyncioGspreadClientManager):
+    """Client manager that runs calls through the Scheduler instead of
+    gspread_asyncio's global lock and fixed delay between all calls."""
+
+    def __init__(
+        self,
+        credentials_fn,
+        scheduler: Scheduler,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 32.0,
+        **kwargs,
+    ):
+        super().__init__(credentials_fn, **kwargs)
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    async def _call(self, method, *args, **kwargs):
+        api_call_count = kwargs.pop('api_call_count', 1)
+        spreadsheet_id = spreadsheet_of(method)
+        kind = 'read' if method.__name__ in READS else 'write'
+        labels = dict(method=method.__name__, worksheet=worksheet_of(method))
+
+        for attempt in itertools.count():
+            with metrics.sheets_wait.time(kind=kind, priority=PRIORITIES[priority.get()]):
+                for _ in range(api_call_count):
+                    await self.scheduler.acquire(spreadsheet_id, kind)
+            await self.before_gspread_call(method, args, kwargs)
+            try:
+                with metrics.sheets_calls.time(**labels):
+                    return await asyncio.to_thread(method, *args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                code = e.response.status_code
+                metrics.sheets_errors.inc(method=method.__name__, status=code)
+                if code != 429 and code < 500 or attempt >= self.max_retries:
+                    raise
+                if code == 429:
+                    self.scheduler.throttle(spreadsheet_id, kind)
+                error = e
+            except requests.RequestException as e:
+                metrics.sheets_errors.inc(method=method.__name__, status='network')
+                if attempt >= self.max_retries:
+                    raise
+                error = e
+
+            self.scheduler.retries += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1)
+            log.warning('%s failed (%s), retrying in %.1fs', method.__name__, error, delay)
+            await asyncio.sleep(delay)
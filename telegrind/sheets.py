@@ -1,13 +1,145 @@
 import re
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Pattern
+from functools import wraps
 
 from aiogram.types import Message
 from gspread import WorksheetNotFound, Cell
-from gspread.utils import ValueInputOption, rowcol_to_a1
-from gspread_asyncio import AsyncioGspreadWorksheet, AsyncioGspreadSpreadsheet
-from dateparser.search import search_dates
+from gspread.exceptions import APIError
+from gspread.utils import ValueInputOption, rowcol_to_a1, a1_to_rowcol, absolute_range_name
+from gspread_asyncio import AsyncioGspreadWorksheet, AsyncioGspreadSpreadsheet, AsyncioGspreadClient
+
+from . import cache
+from .dates import search_date
+from .models import RecurringPayment
+from .parsing import Parsed, OUTCOME, LOAN, WISH, classify
+
+
+async def open_spreadsheet(agc: AsyncioGspreadClient, chat_id: int, url: str) -> AsyncioGspreadSpreadsheet:
+    key = (chat_id, url)
+    ags = cache.spreadsheets.get(key)
+    if ags is None:
+        ags = await agc.open_by_url(url)
+        cache.spreadsheets.set(key, ags)
+    return ags
+
+
+def runs(indexes: list[int]) -> list[tuple[int, int]]:
+    """Sorted indexes as [start, end) runs of consecutive ones."""
+    result = []
+    for i in indexes:
+        if result and result[-1][1] == i:
+            result[-1] = (result[-1][0], i + 1)
+        else:
+            result.append((i, i + 1))
+    return result
+
+
+# dates in rows, as Transaction.make_row and outbox.jsonable write them
+DATE_FORMAT = '%d.%m.%y %H:%M'
+DATE = re.compile(r'^\d{2}\.\d{2}\.\d{2} \d{2}:\d{2}$')
+
+
+def to_cell(value) -> dict:
+    """CellData for appendCells request, which doesn't parse values like USER_ENTERED does."""
+    if isinstance(value, str) and DATE.match(value):
+        value = datetime.strptime(value, DATE_FORMAT)
+    if isinstance(value, datetime):
+        serial = (value.replace(tzinfo=None) - datetime(1899, 12, 30)) / timedelta(days=1)
+        return {
+            'userEnteredValue': {'numberValue': serial},
+            'userEnteredFormat': {'numberFormat': {'type': 'DATE_TIME', 'pattern': 'dd.mm.yy hh:mm'}},
+        }
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': '' if value is None else str(value)}}
+
+
+def forget_all_on_error(function):
+    """Like forget_on_error, for functions of several sheets, passed first."""
+    @wraps(function)
+    async def wrapper(ags: AsyncioGspreadSpreadsheet, sheets: list['Sheet'], *args, **kwargs):
+        try:
+            return await function(ags, sheets, *args, **kwargs)
+        except (APIError, WorksheetNotFound):
+            for sheet in sheets:
+                sheet.forget()
+            raise
+    return wrapper
+
+
+@forget_all_on_error
+async def keys_of(ags: AsyncioGspreadSpreadsheet, sheets: list['Transaction']) -> list[list[str]]:
+    """Values of the '#' column of each sheet, headers included, with a single read."""
+    titles = [(await sheet.get_agw())[0].title for sheet in sheets]
+    response = await ags.values_batch_get([absolute_range_name(t, 'A:A') for t in titles])
+    return [[str(row[0]) if row else '' for row in r.get('values', [])] for r in response['valueRanges']]
+
+
+def block_start(data: list[dict], keys: list[str]) -> int | None:
+    """Row where these '#' run one after another (the last such) in the grid data of a column, if any."""
+    for grid in data:
+        column = [(r.get('values') or [{}])[0].get('formattedValue', '') for r in grid.get('rowData', [])]
+        for i in range(len(column) - len(keys), -1, -1):
+            if column[i:i + len(keys)] == keys:
+                return grid.get('startRow', 0) + i + 1
+    return None
+
+
+@forget_all_on_error
+async def append_many(
+    ags: AsyncioGspreadSpreadsheet,
+    sheets: list['Transaction'],
+    rows: list[list[list]],
+    after: list[int | None] | None = None,
+) -> list[int | None]:
+    """Append rows to several worksheets (and refresh their filters) in a single batch_update call.
+
+    Return the row each worksheet's rows start at, for those with a row given in `after`
+    (e.g. their last row with a '#'): appendCells replies tell nothing, so the '#' column below it
+    comes back along with the update and the appended rows are looked for there. None if not found.
+    """
+    after = after or [None] * len(sheets)
+    requests, ranges, titles = [], [], []
+    for sheet, sheet_rows, last in zip(sheets, rows, after):
+        agw, _ = await sheet.get_agw()
+        titles.append(agw.title)
+        requests.append({'appendCells': {
+            'sheetId': agw.id,
+            'rows': [{'values': [to_cell(v) for v in row]} for row in sheet_rows],
+            'fields': 'userEnteredValue,userEnteredFormat.numberFormat',
+        }})
+        # same as apply_filter
+        requests.append({'setBasicFilter': {'filter': {
+            'range': {'sheetId': agw.id, 'startColumnIndex': 0, 'endColumnIndex': 1},
+        }}})
+        if last is not None and sheet_rows:
+            ranges.append(absolute_range_name(agw.title, f'A{last + 1}:A'))
+    body = {'requests': requests}
+    if ranges:
+        body.update(includeSpreadsheetInResponse=True, responseRanges=ranges, responseIncludeGridData=True)
+    response = await ags.batch_update(body)
+    data = {
+        s['properties']['title']: s.get('data', [])
+        for s in response.get('updatedSpreadsheet', {}).get('sheets', [])
+    }
+    return [
+        block_start(data.get(title, []), [str(r[0]) for r in sheet_rows])
+        if last is not None and sheet_rows else None
+        for title, sheet_rows, last in zip(titles, rows, after)
+    ]
+
+
+def forget_on_error(method):
+    """Drop cached worksheet handles when a call fails, the worksheet may be renamed or deleted."""
+    @wraps(method)
+    async def wrapper(self: 'Sheet', *args, **kwargs):
+        try:
+            return await method(self, *args, **kwargs)
+        except (APIError, WorksheetNotFound):
+            self.forget()
+            raise
+    return wrapper
 
 
 class Sheet:
@@ -19,6 +151,10 @@ class Sheet:
         self._agw = None
 
     async def get_agw(self) -> tuple[AsyncioGspreadWorksheet, bool]:
+        if self._agw:
+            return self._agw, False
+        key = (self.ags.id, self.ws_name)
+        self._agw = cache.worksheets.get(key)
         if self._agw:
             return self._agw, False
         try:
@@ -29,8 +165,15 @@ class Sheet:
                 rows=self.ws_dim[0],
                 cols=self.ws_dim[1]
             ), True
+        cache.worksheets.set(key, self._agw)
         return self._agw, created
 
+    def forget(self):
+        self._agw = None
+        cache.worksheets.pop((self.ags.id, self.ws_name))
+        # gspread_asyncio keeps its own (unbounded) worksheet cache by title
+        self.ags._ws_cache_title.pop(self.ws_name, None)
+
 
 @dataclass
 class Config:
@@ -73,6 +216,12 @@ class ConfigSheet(Sheet):
             await self.write_data(Config())
         return agw, created
 
+    def forget(self):
+        super().forget()
+        self._cfg = None
+        cache.configs.pop(self.ags.id)
+
+    @forget_on_error
     async def write_data(self, conf: Config):
         agw: AsyncioGspreadWorksheet
         agw, created = await super().get_agw()
@@ -80,22 +229,73 @@ class ConfigSheet(Sheet):
         cells.extend([Cell(i + 1, 1, k[0]) for i, k in enumerate(self.keys)])
         cells.extend([Cell(i + 1, 2, getattr(conf, k[1])) for i, k in enumerate(self.keys)])
         await agw.update_cells(cells, ValueInputOption.user_entered)
+        self._cfg = conf
+        cache.configs.set(self.ags.id, conf)
 
+    @forget_on_error
     async def get_data(self) -> Config:
+        if not self._cfg:
+            self._cfg = cache.configs.get(self.ags.id)
         if not self._cfg:
             agw, _ = await self.get_agw()
             rows = await agw.get_values()
             data = {k[1]: k[2](rows[i][1]) for i, k in enumerate(self.keys)}
             self._cfg = Config(**data)
+            cache.configs.set(self.ags.id, self._cfg)
         return self._cfg
 
 
+@dataclass
+class Budget:
+    limit: float
+    currency: str
+
+
+class BudgetSheet(Sheet):
+    """Monthly limits of expenses by category, filled in by the user."""
+    ws_name = '_budgets'
+    headers = ['Категория', 'Лимит в месяц', 'Валюта']
+    ws_dim = (1, len(headers))
+
+    async def get_agw(self) -> tuple[AsyncioGspreadWorksheet, bool]:
+        agw, created = await super().get_agw()
+        if created:
+            await agw.append_row(self.headers, table_range='A1')
+        return agw, created
+
+    def forget(self):
+        super().forget()
+        cache.budgets.pop(self.ags.id)
+
+    @forget_on_error
+    async def get_data(self, default_currency: str) -> dict[str, Budget]:
+        """Budgets by category, rows which don't make sense are skipped."""
+        budgets = cache.budgets.get(self.ags.id)
+        if budgets is None:
+            agw, _ = await self.get_agw()
+            budgets = {}
+            for row in (await agw.get_values())[1:]:
+                row = row + [''] * (len(self.headers) - len(row))
+                category, limit, curr = (v.strip() for v in row[:3])
+                try:
+                    limit = float(limit.replace(' ', '').replace(',', '.'))
+                except ValueError:
+                    continue
+                if category:
+                    budgets[category.lstrip('#').lower()] = Budget(limit, curr.upper() or default_currency)
+            cache.budgets.set(self.ags.id, budgets)
+        return budgets
+
+
 class Transaction(Sheet):
-    pattern: Pattern
+    # parsing.Parsed kind of the sheet's records, if they are made from text
+    kind: str | None = None
     headers: list
+    # Record field -> column index, for the local mirror
+    fields: dict[str, int] = {}
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, ags: AsyncioGspreadSpreadsheet):
+        super().__init__(ags)
         self.cfg = ConfigSheet(self.ags)
 
     async def apply_filter(self, agw: AsyncioGspreadWorksheet):
@@ -109,41 +309,80 @@ class Transaction(Sheet):
             await agw.append_row(self.headers, table_range='A1')
         return agw, created
 
+    def archive(self, year: int) -> 'Transaction':
+        """Same kind of sheet, holding this one's rows of a past year (see telegrind.archive)."""
+        sheet = type(self)(self.ags)
+        sheet.ws_name = f'{self.ws_name} {year}'
+        return sheet
+
+    async def archives(self) -> list['Transaction']:
+        """Archives of the sheet there are in the spreadsheet, newest first, with a single metadata read."""
+        found = {}
+        for ws in await self.ags.worksheets():
+            name, _, year = ws.title.rpartition(' ')
+            if name == self.ws_name and year.isdigit():
+                found[int(year)] = self.archive(int(year))
+                found[int(year)]._agw = ws
+        return [found[y] for y in sorted(found, reverse=True)]
+
+    @classmethod
+    def classify(cls, text: str) -> Parsed | None:
+        """Text's fields when it is a record of this sheet, for the router filter."""
+        parsed = classify(text)
+        return parsed if parsed and parsed.kind == cls.kind else None
+
     @classmethod
-    def parse(cls, text: str) -> tuple:
-        match = cls.pattern.match(text)
-        if not match:
+    def parse(cls, text: str) -> Parsed:
+        parsed = cls.classify(text)
+        if not parsed:
             raise ValueError(f'text does not match pattern of {cls.__name__}')
-        return match.groups()
+        return parsed
 
-    async def make_row(self, message: Message) -> list:
+    async def make_row(self, message: Message, parsed: Parsed | None = None) -> list:
         pass
 
-    async def record(self, *args, **kwargs) -> None:
+    async def record(self, *args, **kwargs) -> int:
         pass
 
-    async def write_rows(self, rows: list):
+    @forget_on_error
+    async def append_rows(self, rows: list) -> int:
+        """Append rows right away, return the number of the first appended row."""
         agw, _ = await self.get_agw()
-        await agw.append_rows(
+        resp = await agw.append_rows(
             rows,
             value_input_option=ValueInputOption.user_entered,
             table_range='A1'
         )
         await self.apply_filter(agw)
+        # e.g. 'Expenses'!A5:E7
+        updated = resp['updates']['updatedRange'].rsplit('!', 1)[-1]
+        return a1_to_rowcol(updated.split(':')[0])[0]
 
-    async def write_row(self, row: list):
+    async def write_rows(self, rows: list) -> int:
+        return await self.append_rows(rows)
+
+    async def write_row(self, row: list) -> int:
+        return await self.write_rows([row])
+
+    @forget_on_error
+    async def keys(self) -> set[str]:
+        """All values of the '#' column."""
         agw, _ = await self.get_agw()
-        await agw.append_row(
-            row,
-            value_input_option=ValueInputOption.user_entered,
-            table_range='A1'
-        )
-        await self.apply_filter(agw)
+        return set(await agw.col_values(1))
 
+    @forget_on_error
     async def search_row(self, message_id: int):
         agw, _ = await self.get_agw()
         return await agw.find(str(message_id), in_column=1)
 
+    @forget_on_error
+    async def check_row(self, row_id: int, message_id: int) -> bool:
+        """Make sure the row still belongs to the message."""
+        agw, _ = await self.get_agw()
+        cell = await agw.acell(rowcol_to_a1(row_id, 1))
+        return cell.value == str(message_id)
+
+    @forget_on_error
     async def change_row(self, row_id: int, row: list):
         agw, _ = await self.get_agw()
         cells = [Cell(row=row_id, col=i+1, value=v) for i, v in enumerate(row)]
@@ -153,98 +392,119 @@ class Transaction(Sheet):
         )
         await self.apply_filter(agw)
 
-    async def delete_row(self, row_id: int):
+    @forget_on_error
+    async def rows_of(self, message_ids: set[int]) -> dict[int, list[int]]:
+        """Rows of the messages found in the sheet, by message, with a single read of the '#' column."""
         agw, _ = await self.get_agw()
-        return await agw.delete_rows(row_id)
-
-
-_amount = r'(\d+(?:[\.,]\d+)?)'
-_curr = r'([A-z]{3})'
-_date = r'(\d{2}\.\d{2}\.\d{4})'
+        keys = {str(m): m for m in message_ids}
+        rows = {}
+        for i, v in enumerate(await agw.col_values(1)):
+            if v in keys:
+                # e.g. all the commodities of a ticket
+                rows.setdefault(keys[v], []).append(i + 1)
+        return rows
+
+    @forget_on_error
+    async def delete_rows(self, row_ids: list[int]):
+        """Delete the rows with a single request."""
+        agw, _ = await self.get_agw()
+        # bottom up, so indexes of the rows above stay put
+        await self.ags.batch_update({'requests': [
+            {'deleteDimension': {'range': {
+                'sheetId': agw.id, 'dimension': 'ROWS', 'startIndex': start - 1, 'endIndex': end - 1,
+            }}}
+            for start, end in reversed(runs(sorted(row_ids)))
+        ]})
 
 
 class Outcome(Transaction):
-    pattern = re.compile(rf'^{_amount}\b')
+    kind = OUTCOME
     ws_name = 'Expenses'
-    headers = ['#', 'Сумма', 'Валюта', 'Дата', 'Комментарий']
+    headers = ['#', 'Сумма', 'Валюта', 'Дата', 'Комментарий', 'Категория']
     ws_dim = (1, len(headers))
+    fields = {'amount': 1, 'currency': 2, 'date': 3, 'description': 4, 'category': 5}
 
-    async def make_row(self, message: Message) -> list:
+    async def make_row(self, message: Message, parsed: Parsed | None = None) -> list:
+        parsed = parsed or self.parse(message.text)
         conf = await self.cfg.get_data()
-        text = message.text
-
-        # amount is mandatory
-        amount = re.search(rf'^{_amount}\b', text).group()
-        # extracting amount from text
-        text = re.sub(rf'^{_amount}\b', '', text).strip()
-        amount = float(amount.replace(',', '.'))
-
-        # currency is optional
-        curr = conf.currency.upper()
-        match = re.search(rf'^{_curr}\b', text)
-        if match:
-            # no currency
-            curr = match.group()
-            text = re.sub(rf'^{_curr}\b', '', text).strip()
-            curr = curr.upper()
+        text = parsed.description
 
         # date is optional
         date = conf.now()
-        matches = search_dates(text, languages=['ru', 'en'], settings={
-            'TIMEZONE': conf.tzname,
-            'RETURN_AS_TIMEZONE_AWARE': True
-        })
-        if matches:
+        found = search_date(text, date)
+        if found:
             # take first found date
-            sub, date = matches[0]
+            sub, date = found
             text = text.replace(sub, '', 1).strip()
-        desc = text
+            if parsed.category:
+                text = ' '.join(text.split())
 
         return [
             message.message_id,
-            amount,
-            curr,
+            parsed.amount,
+            parsed.currency or conf.currency.upper(),
             date.strftime('%d.%m.%y %H:%M'),
-            desc
+            text,
+            parsed.category or ''
         ]
 
-    async def record(self, *args, **kwargs) -> None:
+    async def record(self, *args, **kwargs) -> int:
         row = await self.make_row(*args, **kwargs)
         return await self.write_row(row)
 
     @classmethod
     def from_ticket(cls, message: Message, data: dict) -> list:
+        """Row for the outbox, date is left as datetime."""
         return [
             message.message_id,
             data['ticket']['totalSum'],
             'KZT',
-            datetime.fromisoformat(data['ticket']['transactionDate']).strftime('%d.%m.%y %H:%M'),
-            'Покупки'
+            datetime.fromisoformat(data['ticket']['transactionDate']),
+            'Покупки',
+            ''
+        ]
+
+    @classmethod
+    def from_kaspi(cls, record: dict) -> list:
+        return [
+            record['key'],
+            record['amount'],
+            'KZT',
+            record['date'].strftime('%d.%m.%y %H:%M'),
+            record['desc'],
+            ''
+        ]
+
+    @classmethod
+    def from_payment(cls, message_id: int, payment: RecurringPayment, date: datetime) -> list:
+        return [
+            message_id,
+            payment.amount,
+            payment.currency,
+            date.strftime('%d.%m.%y %H:%M'),
+            payment.title,
+            payment.category or ''
         ]
 
 
 class Loan(Outcome):
-    pattern = re.compile(rf'^(?:долг|за[еёйи]м) (.*?) ([+-])?{_amount}(?: {_curr})?(?: {_date})?(?: (.*))?$', flags=re.I)
+    kind = LOAN
     ws_name = 'Loans'
     headers = ['#', "Сумма", "Валюта", "Заёмщик", "Дата", "Комментарий"]
     ws_dim = (1, len(headers))
+    fields = {'amount': 1, 'currency': 2, 'counterparty': 3, 'date': 4, 'description': 5}
 
-    async def make_row(self, message: Message) -> list:
+    async def make_row(self, message: Message, parsed: Parsed | None = None) -> list:
+        parsed = parsed or self.parse(message.text)
         conf = await self.cfg.get_data()
-
-        who, direction, amount, curr, date, desc = self.parse(message.text)
-        who = who.strip() if who else "Неизвестно"
-        direction = -1 if direction in ('-', None) else 1  # -100 and 100 both mean loan, +100 means payback
-        amount = float(amount.replace(',', '.')) * direction
-        curr = curr or conf.currency
-        date = datetime.strptime(date, '%d.%m.%Y') if date else conf.now()
+        date = datetime.strptime(parsed.date, '%d.%m.%Y') if parsed.date else conf.now()
         return [
             message.message_id,
-            amount,
-            curr,
-            who,
+            parsed.amount,
+            parsed.currency or conf.currency,
+            parsed.counterparty,
             date.strftime('%d.%m.%y %H:%M'),
-            desc
+            parsed.description
         ]
 
 
@@ -253,8 +513,10 @@ class Commodity(Transaction):
     ws_name = 'Commodities'
     ws_dim = (1, 6)
     headers = ['#', "Продукт", "Цена", "Количество", "Дата", "Организация"]
+    # amount is price, mirror multiplies it by quantity
+    fields = {'description': 1, 'amount': 2, 'quantity': 3, 'date': 4, 'counterparty': 5}
 
-    async def record(self, message: Message, data: dict) -> None:
+    def make_rows(self, message: Message, data: dict) -> list[list]:
         org = data['orgTitle']
         org = org.replace('ТОВАРИЩЕСТВО С ОГРАНИЧЕННОЙ ОТВЕТСТВЕННОСТЬЮ', 'ТОО')
         t = data['ticket']
@@ -270,33 +532,38 @@ class Commodity(Transaction):
                     cname,
                     i['commodity']['price'],
                     i['commodity']['quantity'],
-                    dt.strftime('%d.%m.%y %H:%M'),
+                    dt,
                     org
                 ]
                 rows.append(row)
             elif i['itemType'] == 5:  # position discount (usually goes right after an item)
                 rows[-1][2] -= (i['discount']['sum'] / rows[-1][3])  # reduce price of an item by discount amount
+        return rows
 
-        await self.write_rows(rows)
+    async def record(self, message: Message, data: dict) -> int:
+        rows = self.make_rows(message, data)
+        for row in rows:
+            row[4] = row[4].strftime('%d.%m.%y %H:%M')
+        return await self.write_rows(rows)
 
 
 class Wish(Transaction):
     ws_name = 'Wishlist'
     ws_dim = (1, 3)
     headers = ['#', 'Желание', 'Добавлено', 'Исполнено']
-    pattern = re.compile(r'^хочу\s+(.*?)$', re.IGNORECASE)
+    fields = {'description': 1, 'date': 2}
+    kind = WISH
 
-    async def make_row(self, message: Message) -> list:
-        wish = self.parse(message.text)
-        wish = wish[0] if wish else ''
+    async def make_row(self, message: Message, parsed: Parsed | None = None) -> list:
+        parsed = parsed or self.parse(message.text)
         conf = await self.cfg.get_data()
         return [
             message.message_id,
-            wish,
+            parsed.description,
             conf.nowstr(),
             ''
         ]
 
-    async def record(self, *args, **kwargs) -> None:
+    async def record(self, *args, **kwargs) -> int:
         row = await self.make_row(*args, **kwargs)
         return await self.write_row(row)
@@ -0,0 +1,160 @@
+"""Getting the bot ready to reply fast after a (re)start.
+
+Startup steps are timed and logged. The schema is checked with a single catalog query
+instead of create_all's query per table. Once the bot is serving, spreadsheets of chats
+active lately are opened in the background, so their first messages find them cached,
+and modules which are heavy to import on a first message are imported meanwhile.
+"""
+import asyncio
+import importlib
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+from gspread_asyncio import AsyncioGspreadClient
+from sqlalchemy import MetaData, select, func, union_all, text
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, AsyncSession
+
+from .models import Chat, Record
+from .scheduler import background
+from .sheets import ConfigSheet, Outcome, open_spreadsheet
+
+log = logging.getLogger(__name__)
+
+# imported by the first message with a date the grammar doesn't know, see telegrind.dates
+PRELOADED = ('dateparser.search',)
+
+
+class Timings:
+    """Durations of startup steps, the first one since `started`."""
+
+    def __init__(self, started: float | None = None):
+        self.last = started or time.perf_counter()
+        self.started = self.last
+        self.steps: dict[str, float] = {}
+
+    def mark(self, name: str):
+        """End of a step that began where the previous one ended."""
+        now = time.perf_counter()
+        self.steps[name] = now - self.last
+        self.last = now
+
+    @contextmanager
+    def step(self, name: str):
+        """Step running alongside others, not counted as a mark."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = time.perf_counter() - started
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def __str__(self):
+        return ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.steps.items())
+
+
+async def ensure_schema(engine: AsyncEngine, metadata: MetaData) -> bool:
+    """Create missing tables, columns and indexes, return whether anything was missing."""
+    tables = metadata.sorted_tables
+    expected = (
+        {t.name for t in tables}
+        | {i.name for t in tables for i in t.indexes}
+        | {f'{t.name}.{c.name}' for t in tables for c in t.columns}
+    )
+    async with engine.connect() as conn:
+        result = await conn.execute(union_all(
+            select(text('tablename')).select_from(text('pg_tables')).where(text('schemaname = current_schema()')),
+            select(text('indexname')).select_from(text('pg_indexes')).where(text('schemaname = current_schema()')),
+            select(text("table_name || '.' || column_name")).select_from(text('information_schema.columns'))
+            .where(text('table_schema = current_schema()')),
+        ))
+        existing = set(result.scalars())
+        if expected <= existing:
+            return False
+
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.create_all, checkfirst=True)
+        # create_all skips tables that already exist, along with their new columns and indexes
+        for table in tables:
+            if table.name not in existing:
+                continue
+            for column in table.columns:
+                if f'{table.name}.{column.name}' not in existing:
+                    spec = CreateColumn(column).compile(dialect=conn.dialect)
+                    await conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {spec}'))
+        for table in tables:
+            for index in table.indexes:
+                await conn.run_sync(index.create, checkfirst=True)
+    return True
+
+
+async def recent_chats(
+    async_session: async_sessionmaker[AsyncSession], days: float = 14, limit: int = 100
+) -> list[Chat]:
+    """Chats which recorded something lately, the latest first."""
+    # when the message was sent, a record's own date may be any day
+    latest = func.max(Record.sent_at)
+    recent = (
+        select(Record.chat_id, latest.label('latest'))
+        .where(Record.sent_at >= datetime.now(timezone.utc) - timedelta(days=days))
+        .group_by(Record.chat_id)
+        .subquery()
+    )
+    async with async_session() as session:
+        result = await session.execute(
+            select(Chat)
+            .join(recent, recent.c.chat_id == Chat.chat_id)
+            .where(Chat.sheet_url.is_not(None))
+            .order_by(recent.c.latest.desc())
+            .limit(limit)
+        )
+        return list(result.scalars())
+
+
+async def warm_chat(agc: AsyncioGspreadClient, chat: Chat):
+    """What the first expense of the chat needs: the spreadsheet, its config and worksheet."""
+    ags = await open_spreadsheet(agc, chat.chat_id, chat.sheet_url)
+    await ConfigSheet(ags).get_data()
+    await Outcome(ags).get_agw()
+
+
+async def warm_up(
+    authorize: Callable[[], Awaitable[AsyncioGspreadClient]],
+    async_session: async_sessionmaker[AsyncSession],
+    owns: Callable[[int], bool] = lambda chat_id: True,
+    limit: int = 100,
+    concurrency: int = 8,
+) -> int:
+    """Warm up recently active chats this process handles, return how many are ready.
+
+    `authorize` gives the client the bot's handlers share, so it is not authorized twice.
+    """
+    started = time.perf_counter()
+    for name in PRELOADED:
+        # in a thread, the loop keeps serving meanwhile
+        await asyncio.to_thread(importlib.import_module, name)
+
+    chats = [c for c in await recent_chats(async_session, limit=limit) if owns(c.chat_id)]
+    agc = await authorize()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def warm(chat: Chat) -> bool:
+        async with semaphore:
+            try:
+                await warm_chat(agc, chat)
+                return True
+            except Exception as e:
+                log.warning('failed to warm up chat %s: %r', chat.chat_id, e)
+                return False
+
+    # real messages go first
+    with background():
+        ready = sum(await asyncio.gather(*(warm(c) for c in chats)))
+    log.info('warmed up %d of %d recent chats in %.2fs', ready, len(chats), time.perf_counter() - started)
+    return ready
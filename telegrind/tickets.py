@@ -0,0 +1,125 @@
+"""Fiscal receipts (OFD tickets).
+
+Receipt QR code holds a link like
+    http://consumer.oofd.kz?i=<fiscal sign>&f=<cash register>&s=<sum>&t=<20240312T101500>
+which OFD resolves into the ticket JSON.
+"""
+import asyncio
+import re
+from io import BytesIO
+from typing import Protocol
+from urllib.parse import urlsplit, parse_qsl
+
+import aiohttp
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from .models import Ticket
+
+OFD_API_URL = 'https://consumer.oofd.kz/api/tickets/get-by-url'
+TICKET_URL = re.compile(r'https?://consumer\.(?:oofd|kofd)\.kz\S*\?\S+', re.I)
+
+
+def fiscal_id(url: str) -> str | None:
+    """Cash register number and fiscal sign identify a receipt."""
+    query = dict(parse_qsl(urlsplit(url).query))
+    if 'i' not in query or 'f' not in query:
+        return None
+    return f"{query['f']}:{query['i']}"
+
+
+class TicketFetcher(Protocol):
+    async def fetch(self, url: str) -> dict:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+
+class OfdFetcher:
+    """Fetches tickets from OFD consumer API over one pooled HTTP session."""
+
+    def __init__(
+        self,
+        api_url: str = OFD_API_URL,
+        timeout: float = 10,
+        limit: int = 20,
+    ):
+        self.api_url = api_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.limit = limit
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # created lazily, it must be created inside the running loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=self.limit),
+            )
+        return self._session
+
+    async def fetch(self, url: str) -> dict:
+        params = dict(parse_qsl(urlsplit(url).query))
+        async with self.session.get(self.api_url, params=params) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
+class TicketLog:
+    """Receipts the chats recorded, shared by instances, so a receipt is recorded once."""
+
+    def __init__(self, async_session: async_sessionmaker[AsyncSession]):
+        self.async_session = async_session
+
+    async def claim(self, chat_id: int, fid: str, message_id: int) -> bool:
+        """Take the receipt for the message, False when the chat has it recorded (or being recorded)."""
+        async with self.async_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    insert(Ticket)
+                    .values(chat_id=chat_id, fiscal_id=fid, message_id=message_id)
+                    .on_conflict_do_nothing(index_elements=[Ticket.chat_id, Ticket.fiscal_id])
+                    .returning(Ticket.id)
+                )
+                return result.first() is not None
+
+    async def release(self, chat_id: int, fid: str):
+        """Let the receipt be recorded again, e.g. when recording it failed."""
+        async with self.async_session() as session:
+            async with session.begin():
+                await session.execute(
+                    delete(Ticket).where(Ticket.chat_id == chat_id, Ticket.fiscal_id == fid)
+                )
+
+    async def forget(self, chat_id: int, *message_ids: int):
+        """Receipts of deleted messages may be recorded again."""
+        if not message_ids:
+            return
+        async with self.async_session() as session:
+            async with session.begin():
+                await session.execute(
+                    delete(Ticket).where(Ticket.chat_id == chat_id, Ticket.message_id.in_(message_ids))
+                )
+
+
+def _decode_qr(image: bytes) -> str | None:
+    from PIL import Image  # optional dependencies, see [receipts] extra
+    from pyzbar.pyzbar import decode
+
+    for code in decode(Image.open(BytesIO(image))):
+        text = code.data.decode(errors='ignore')
+        if TICKET_URL.search(text):
+            return text
+    return None
+
+
+async def decode_qr(image: bytes) -> str | None:
+    """Ticket link from a photo of the receipt, if there is one."""
+    return await asyncio.to_thread(_decode_qr, image)
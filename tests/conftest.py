@@ -0,0 +1,49 @@
+import asyncio
+import itertools
+import os
+from typing import Awaitable, Callable
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from telegrind import cache
+from telegrind.models import Model
+from telegrind.startup import ensure_schema
+
+# far from real chat ids, and from bench.py's
+FIRST_CHAT_ID = -(10 ** 14)
+_chat_ids = itertools.count(FIRST_CHAT_ID - os.getpid() * 1000, -1)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    # fake spreadsheets of different tests share ids
+    for value in vars(cache).values():
+        if isinstance(value, cache.TTLCache):
+            value.clear()
+
+
+@pytest.fixture
+def chat_id() -> int:
+    return next(_chat_ids)
+
+
+@pytest.fixture
+def db() -> Callable[[Callable[[AsyncEngine, async_sessionmaker[AsyncSession]], Awaitable]], object]:
+    """Runs a test coroutine against the scratch database at DATABASE_URL, as bench.py does."""
+    url = os.getenv("DATABASE_URL")
+    if not url:
+        pytest.skip("needs a scratch database at DATABASE_URL")
+
+    def run(test: Callable[[AsyncEngine, async_sessionmaker[AsyncSession]], Awaitable]):
+        async def main():
+            engine = create_async_engine(url)
+            try:
+                await ensure_schema(engine, Model.metadata)
+                return await test(engine, async_sessionmaker(engine, expire_on_commit=False))
+            finally:
+                await engine.dispose()
+
+        return asyncio.run(main())
+
+    return run
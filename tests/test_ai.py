@@ -0,0 +1,69 @@
+import asyncio
+
+from telegrind import cache
+from telegrind.ai import AiParser, MISSING
+from telegrind.fakes import FakeAPI, serve_fake_ai
+from telegrind.parsing import OUTCOME
+
+TEXTS = ["потратила 500 на кофе", "такси 1200,5", "как дела?", "Потратила  500 на КОФЕ"]
+
+
+async def serving(test, **kwargs):
+    api = FakeAPI()
+    runner = await serve_fake_ai(api, port=0)
+    host, port = runner.addresses[0][:2]
+    parser = AiParser(api_url=f"http://{host}:{port}/v1", max_delay=0.05, **kwargs)
+    try:
+        await test(parser, api)
+    finally:
+        await parser.close()
+        await runner.cleanup()
+
+
+def test_batch_across_chats():
+    async def test(parser: AiParser, api: FakeAPI):
+        results = await asyncio.gather(*(parser.parse(chat_id, text) for chat_id, text in enumerate(TEXTS)))
+        # a single request, the same text (give or take case and spaces) asked once
+        assert api.calls["chat/completions"] == 1
+        coffee, taxi, chatter, same = results
+        assert (coffee.kind, coffee.amount, coffee.description) == (OUTCOME, 500, "потратила на кофе")
+        assert (taxi.amount, taxi.description) == (1200.5, "такси")
+        assert chatter is None
+        assert same == coffee
+
+        # cached, not a record included
+        assert await parser.parse(1, "как  дела?") is None
+        assert await parser.parse(1, "такси 1200,5") == taxi
+        assert api.calls["chat/completions"] == 1
+
+    asyncio.run(serving(test))
+
+
+def test_batch_size():
+    async def test(parser: AiParser, api: FakeAPI):
+        await asyncio.gather(*(parser.parse(i, f"{i} кофе") for i in range(5)))
+        assert api.calls["chat/completions"] == 3
+
+    asyncio.run(serving(test, max_batch=2))
+
+
+def test_left_out_asked_again(monkeypatch):
+    async def test(parser: AiParser, api: FakeAPI):
+        request = parser.request
+        asked = []
+
+        async def leave_out_coffee(texts: list[str]) -> list:
+            asked.append(texts)
+            return [MISSING if "кофе" in t else r for t, r in zip(texts, await request(texts))]
+
+        monkeypatch.setattr(parser, "request", leave_out_coffee)
+        coffee, taxi = await asyncio.gather(parser.parse(1, "кофе 500"), parser.parse(2, "такси 1200"))
+        # asked once more, then given up on
+        assert asked == [["кофе 500", "такси 1200"], ["кофе 500"]]
+        assert coffee is None and taxi.amount == 1200
+        # the model's silence is not its answer, so not cached
+        assert cache.ai.get("кофе 500") is None
+        monkeypatch.setattr(parser, "request", request)
+        assert (await parser.parse(1, "кофе 500")).amount == 500
+
+    asyncio.run(serving(test))
@@ -0,0 +1,75 @@
+from datetime import datetime
+
+from telegrind.archive import Archiver
+from telegrind.fakes import FakeClientManager
+from telegrind.index import RowIndex
+from telegrind.sheets import Outcome, open_spreadsheet
+
+
+def test_rollover(db, chat_id):
+    async def test(engine, async_session):
+        agcm, index = FakeClientManager(), RowIndex(async_session)
+        ags = await open_spreadsheet(await agcm.authorize(), chat_id, f"https://fake/{chat_id}")
+        sheet = Outcome(ags)
+        await sheet.get_agw()
+        expenses = ags.sheets[Outcome.ws_name].rows
+        this_year = datetime.now().strftime("01.01.%y 12:00")
+        for key, date in enumerate(["01.02.20 10:00", "05.05.21 10:00", this_year, "03.03.20 10:00", this_year], 1):
+            expenses.append([key, 100, "KZT", date, "кофе"])
+        await index.add(chat_id, Outcome.ws_name, [1, 2, 3, 4, 5], first_row=2)
+
+        # a small worksheet is not even read (the settings are, once)
+        await sheet.cfg.get_data()
+        before = agcm.api.calls["get_values"]
+        assert await Archiver(async_session, index, min_rows=10).rollover(chat_id, sheet) == 0
+        assert agcm.api.calls["get_values"] == before
+
+        bodies = []
+        batch_update = ags.batch_update
+
+        async def appended_meanwhile(body: dict) -> dict:
+            bodies.append(body)
+            # the outbox appended a row after the rollover read the worksheet
+            expenses.append([6, 100, "KZT", this_year, "чай"])
+            await index.add(chat_id, Outcome.ws_name, [6], first_row=7)
+            return await batch_update(body)
+
+        ags.batch_update = appended_meanwhile
+        assert await Archiver(async_session, index, min_rows=2).rollover(chat_id, sheet) == 3
+
+        live, y2020, y2021 = (ags.sheets[f"Expenses {y}".strip()].id for y in ("", 2020, 2021))
+        # both archives got a header from get_agw, the moved rows go below it
+        assert bodies == [{"requests": [
+            {"appendDimension": {"sheetId": y2020, "dimension": "ROWS", "length": 2}},
+            {"cutPaste": {
+                "source": {"sheetId": live, "startRowIndex": 1, "endRowIndex": 2},
+                "destination": {"sheetId": y2020, "rowIndex": 1, "columnIndex": 0},
+                "pasteType": "PASTE_NORMAL",
+            }},
+            {"cutPaste": {
+                "source": {"sheetId": live, "startRowIndex": 4, "endRowIndex": 5},
+                "destination": {"sheetId": y2020, "rowIndex": 2, "columnIndex": 0},
+                "pasteType": "PASTE_NORMAL",
+            }},
+            {"appendDimension": {"sheetId": y2021, "dimension": "ROWS", "length": 1}},
+            {"cutPaste": {
+                "source": {"sheetId": live, "startRowIndex": 2, "endRowIndex": 3},
+                "destination": {"sheetId": y2021, "rowIndex": 1, "columnIndex": 0},
+                "pasteType": "PASTE_NORMAL",
+            }},
+            # bottom up
+            {"deleteDimension": {"range": {"sheetId": live, "dimension": "ROWS", "startIndex": 4, "endIndex": 5}}},
+            {"deleteDimension": {"range": {"sheetId": live, "dimension": "ROWS", "startIndex": 1, "endIndex": 3}}},
+        ]}]
+        assert [r[0] for r in expenses] == ["#", 3, 5, 6]
+        assert [r[0] for r in ags.sheets["Expenses 2020"].rows] == ["#", 1, 4]
+
+        where = {m: ((ref := await index.get(chat_id, m)).worksheet, ref.row_id) for m in range(1, 7)}
+        assert where == {
+            1: ("Expenses 2020", 2), 4: ("Expenses 2020", 3), 2: ("Expenses 2021", 2),
+            # the appended row moved up too
+            3: ("Expenses", 2), 5: ("Expenses", 3), 6: ("Expenses", 4),
+        }
+        assert await index.archives(chat_id, 4) == ["Expenses 2020"]
+
+    db(test)
@@ -0,0 +1,69 @@
+from datetime import date, datetime
+
+from sqlalchemy import select, literal
+
+from telegrind import budgets
+from telegrind.bot.records import budget_warning
+from telegrind.fakes import FakeClientManager, FakeRates
+from telegrind.models import Chat
+from telegrind.rates import Rates, converted
+from telegrind.sheets import BudgetSheet, open_spreadsheet
+
+# far from the days of real records, the fake has the same rates every day
+DAY = date(2001, 2, 3)
+
+
+def test_converted(db):
+    async def test(engine, async_session):
+        await Rates(async_session, FakeRates()).fill([DAY])
+
+        async def convert(amount: float, currency: str | None, target: str) -> tuple:
+            async with async_session() as session:
+                result = await session.execute(
+                    select(*converted(literal(amount), literal(currency), literal(DAY), target))
+                )
+                return tuple(result.one())
+
+        assert await convert(960, "KZT", "USD") == (2, "USD")
+        # through the dollar
+        assert await convert(960, "KZT", "EUR") == (960 * 0.92 / 480, "EUR")
+        # in the chat's currency
+        assert await convert(960, None, "KZT") == (960, "KZT")
+        # no rate, left as is
+        assert await convert(960, "XXX", "USD") == (960, "XXX")
+
+    db(test)
+
+
+def test_budget_in_another_currency(db, chat_id):
+    async def test(engine, async_session):
+        rates = Rates(async_session, FakeRates())
+        await rates.fill([DAY])
+        month = budgets.month_of(datetime(2001, 2, 3))
+        async with async_session() as session:
+            async with session.begin():
+                await budgets.shift(session, chat_id, {
+                    ("еда", "KZT", month): 4800, ("еда", "USD", month): 10, ("еда", "XXX", month): 7,
+                    # another category and month
+                    ("такси", "USD", month): 100, ("еда", "USD", datetime(2001, 1, 1)): 100,
+                })
+            async with session.begin():
+                # the tenge at 480 per dollar, the euro at 0.92, an unknown currency left out
+                eur = await budgets.spent(session, chat_id, "еда", "EUR", month, DAY)
+                kzt = await budgets.spent(session, chat_id, "еда", "KZT", month, DAY)
+            assert (eur, kzt) == (4800 / 480 * 0.92 + 10 * 0.92, 4800 + 10 * 480)
+
+        agcm = FakeClientManager()
+        chat = Chat(chat_id=chat_id, sheet_url=f"https://fake/{chat_id}")
+        ags = await open_spreadsheet(await agcm.authorize(), chat.chat_id, chat.sheet_url)
+        await BudgetSheet(ags).get_agw()
+        ags.sheets[BudgetSheet.ws_name].rows += [["#Еда", "15", "eur"], ["такси", "50 000", ""]]
+        row = [1, 2000, "KZT", "03.02.01 10:00", "обед", "еда"]
+        async with async_session() as session:
+            warning = await budget_warning(ags, chat, session, rates, row)
+            # in the chat's currency, 100 dollars are 48 000 tenge
+            assert await budget_warning(ags, chat, session, rates, [*row[:5], "такси"]) == ""
+        assert warning == "\n\n⚠️ Бюджет #еда превышен: 18.40 из 15.00 EUR"
+        await rates.close()
+
+    db(test)
@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from gspread import WorksheetNotFound
+
+from telegrind import cache
+from telegrind.fakes import FakeClientManager
+from telegrind.sheets import Config, ConfigSheet, Outcome, open_spreadsheet
+
+
+def test_ttl_and_lru():
+    items = cache.TTLCache("test", maxsize=2, ttl=0.05)
+    items.set("a", 1)
+    items.set("b", 2)
+    assert items.get("a") == 1
+    # the least recently used one goes
+    items.set("c", 3)
+    assert (items.get("b"), items.get("a"), items.get("c")) == (None, 1, 3)
+    time.sleep(0.06)
+    assert items.get("a", "expired") == "expired" and len(items) == 1
+    assert items.stats() == {"size": 1, "hits": 3, "misses": 2}
+
+
+def test_sheets_opened_once_and_forgotten_on_error():
+    async def main():
+        agcm = FakeClientManager()
+        agc = await agcm.authorize()
+        ags = await open_spreadsheet(agc, 1, "https://fake/cached")
+        await ConfigSheet(ags).write_data(Config(dt_offset=3))
+        await Outcome(ags).get_agw()
+        before = dict(agcm.api.calls)
+
+        # every message makes its sheets anew, they come from the caches
+        for _ in range(3):
+            ags = await open_spreadsheet(agc, 1, "https://fake/cached")
+            assert (await ConfigSheet(ags).get_data()).dt_offset == 3
+            await Outcome(ags).get_agw()
+        assert agcm.api.calls == before
+
+        sheet = ConfigSheet(ags)
+        agw, _ = await sheet.get_agw()
+
+        async def deleted(*args, **kwargs):
+            raise WorksheetNotFound(ConfigSheet.ws_name)
+
+        # deleted by hand meanwhile
+        agw.update_cells = deleted
+        try:
+            await sheet.write_data(Config())
+        except WorksheetNotFound:
+            pass
+        # read again on the next message
+        assert cache.configs.get(ags.id) is None and cache.worksheets.get((ags.id, ConfigSheet.ws_name)) is None
+
+    asyncio.run(main())
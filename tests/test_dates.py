@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from dateparser.search import search_dates
+
+from telegrind.dates import GRAMMAR, dateparser_settings, search_date
+
+NOW = datetime(2024, 5, 15, 13, 45, 30, tzinfo=timezone(timedelta(hours=6)))
+
+# forms the grammar handles and resolves the same as dateparser
+EQUIVALENT = [
+    "вчера", "позавчера", "сегодня", "завтра", "yesterday", "today", "tomorrow",
+    "2 часа назад", "три дня назад", "5 минут назад", "минуту назад", "час назад", "день назад",
+    "неделю назад", "две недели назад", "2 hours ago", "3 days ago", "a week ago", "10 mins ago",
+    "в 12:30", "в 14:30", "at 9:30", "at 23:10",
+]
+
+# forms dateparser gets wrong, with what the grammar makes of them
+DIVERGENT = {
+    # not found
+    "15.03.24": datetime(2024, 3, 15),
+    "1.2.24": datetime(2024, 2, 1),
+    "day ago": datetime(2024, 5, 14, 13, 45, 30),
+    # the year only
+    "31.12.2023": datetime(2023, 12, 31),
+    "15.03.2024": datetime(2024, 3, 15),
+    "March 5, 2024": datetime(2024, 3, 5),
+    # an hour of today
+    "hour ago": datetime(2024, 5, 15, 12, 45, 30),
+    "minute ago": datetime(2024, 5, 15, 13, 44, 30),
+    # the month only
+    "1 января": datetime(2024, 1, 1),
+    "5 мая": datetime(2024, 5, 5),
+    "20 марта 2024": datetime(2024, 3, 20),
+    "20 декабря 2023": datetime(2023, 12, 20),
+    "5 march": datetime(2024, 3, 5),
+    "March 5": datetime(2024, 3, 5),
+    # the time lost
+    "вчера в 9:15": datetime(2024, 5, 14, 9, 15),
+    "сегодня в 9:15": datetime(2024, 5, 15, 9, 15),
+    # the date lost
+    "1 января в 10:30": datetime(2024, 1, 1, 10, 30),
+    "10 мая в 8:00": datetime(2024, 5, 10, 8, 0),
+    "yesterday at 10:15": datetime(2024, 5, 14, 10, 15),
+}
+
+
+# sent on the 1st of January, a day and month without a year are last year's
+NEW_YEAR = datetime(2025, 1, 1, 10, 0, tzinfo=NOW.tzinfo)
+LAST_YEAR = {
+    "31 декабря": datetime(2024, 12, 31),
+    "31 dec": datetime(2024, 12, 31),
+    "December 31": datetime(2024, 12, 31),
+    "31 декабря в 20:00": datetime(2024, 12, 31, 20, 0),
+    "20 мая": datetime(2024, 5, 20),
+}
+
+
+def minute(dt: datetime) -> datetime:
+    return dt.replace(second=0, microsecond=0)
+
+
+@pytest.mark.parametrize("form", EQUIVALENT)
+@pytest.mark.parametrize("template", ["{}", "кофе {} 500", "#еда {} 500"])
+def test_same_as_dateparser(form, template):
+    text = template.format(form)
+    assert GRAMMAR.search(text), "left to dateparser"
+    found, date = search_date(text, NOW)
+    assert found == form
+    expected = search_dates(text, languages=["ru", "en"], settings=dateparser_settings(NOW))
+    assert expected and minute(date) == minute(expected[0][1])
+
+
+@pytest.mark.parametrize("form, expected", DIVERGENT.items())
+def test_differs_from_dateparser(form, expected):
+    text = f"кофе {form} 500"
+    found, date = search_date(text, NOW)
+    assert found == form
+    assert date == expected.replace(tzinfo=NOW.tzinfo)
+    theirs = search_dates(text, languages=["ru", "en"], settings=dateparser_settings(NOW))
+    assert not theirs or minute(theirs[0][1]) != minute(date)
+
+
+@pytest.mark.parametrize("form, expected", LAST_YEAR.items())
+def test_day_and_month_are_past(form, expected):
+    text = f"кофе {form} 500"
+    assert search_date(text, NEW_YEAR) == (form, expected.replace(tzinfo=NOW.tzinfo))
+    # dateparser takes the month only, but of the same year
+    theirs = search_dates(text, languages=["ru", "en"], settings=dateparser_settings(NEW_YEAR))
+    assert theirs[0][1].year == expected.year
+
+
+def test_given_year_and_today_kept():
+    assert search_date("кофе 31 декабря 2025", NEW_YEAR)[1] == datetime(2025, 12, 31, tzinfo=NOW.tzinfo)
+    assert search_date("кофе 1 января в 12:00", NEW_YEAR)[1] == datetime(2025, 1, 1, 12, 0, tzinfo=NOW.tzinfo)
+
+
+@pytest.mark.parametrize("text", ["2451 в 14:30 шоколадка", "43,24 в 14:30", "289.75 в 14:30"])
+def test_amount_is_not_date(text):
+    # dateparser's is in 2451, 1943 and 1975
+    assert search_date(text, NOW) == ("в 14:30", datetime(2024, 5, 14, 14, 30, tzinfo=NOW.tzinfo))
+
+
+def test_time_is_past():
+    assert search_date("обед в 12:30", NOW)[1] == datetime(2024, 5, 15, 12, 30, tzinfo=NOW.tzinfo)
+    assert search_date("обед в 14:30", NOW)[1] == datetime(2024, 5, 14, 14, 30, tzinfo=NOW.tzinfo)
+
+
+def test_fallback():
+    # not in the grammar, dateparser's
+    assert search_date("кофе в понедельник", NOW)[1].weekday() == 0
+    assert search_date("кофе с молоком", NOW) is None
@@ -0,0 +1,113 @@
+import asyncio
+import itertools
+import queue
+import time
+from datetime import datetime
+
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import Message
+
+from telegrind.bot.sharding import serve_shard
+from telegrind.debounce import Debouncer, Gatherer
+from telegrind.fakes import FakeSession
+
+
+def test_last_call_settles():
+    async def main():
+        edits = Debouncer(0.05)
+        first = asyncio.create_task(edits.settle("a"))
+        await asyncio.sleep(0.01)
+        # another key is on its own
+        assert await asyncio.gather(first, edits.settle("a"), edits.settle("b")) == [False, True, True]
+        # gone once settled
+        assert not edits._latest
+
+    asyncio.run(main())
+
+
+def test_cancelled_call_does_not_settle():
+    async def main():
+        edits = Debouncer(0.05)
+        pending = asyncio.create_task(edits.settle("a"))
+        await asyncio.sleep(0.01)
+        edits.cancel("a")
+        edits.cancel("b")
+        assert not await pending
+        assert await edits.settle("a")
+
+    asyncio.run(main())
+
+
+def test_gathered_in_one_batch():
+    async def main():
+        forwards = Gatherer(0.05)
+        first = asyncio.create_task(forwards.gather("chat", 1))
+        await asyncio.sleep(0.01)
+        assert await asyncio.gather(first, forwards.gather("chat", 2)) == [[1, 2], [1, 2]]
+        # the next batch starts anew
+        assert await forwards.gather("chat", 3) == [3]
+
+        # the last call left, the others don't wait for it
+        first = asyncio.create_task(forwards.gather("chat", 4))
+        last = asyncio.create_task(forwards.gather("chat", 5))
+        await asyncio.sleep(0.01)
+        last.cancel()
+        assert await first == [4, 5]
+
+    asyncio.run(main())
+
+
+def test_delete_does_not_wait_out_edit_debounce():
+    async def main():
+        dp, handled = Dispatcher(), []
+
+        @dp.edited_message()
+        async def edit(edited_message: Message, edits: Debouncer):
+            if await edits.settle((edited_message.chat.id, edited_message.message_id)):
+                handled.append((edited_message.chat.id, "edit"))
+
+        @dp.message(F.reply_to_message)
+        async def delete(message: Message):
+            handled.append((message.chat.id, "delete"))
+
+        @dp.message()
+        async def record(message: Message):
+            await asyncio.sleep(0.05)
+            handled.append((message.chat.id, "record"))
+
+        def message(chat_id: int, message_id: int, text: str, **extra) -> dict:
+            return dict(
+                message_id=message_id, date=int(datetime.now().timestamp()),
+                chat=dict(id=chat_id, type="private"), text=text, **extra,
+            )
+
+        update_ids = itertools.count()
+        updates, acks = queue.Queue(), queue.Queue()
+
+        def send(**event):
+            updates.put(dict(update_id=next(update_ids), **event))
+
+        # the first chat's edit is still waiting for its turn when the delete comes, the second's is debouncing
+        for chat_id in (1, 2):
+            send(message=message(chat_id, 1, "кофе 100"))
+            send(edited_message=message(chat_id, 1, "кофе 200", edit_date=0))
+        send(message=message(1, 2, "-", reply_to_message=message(1, 1, "кофе 200")))
+        bot = Bot("42:TEST", session=FakeSession())
+        started = time.monotonic()
+        serving = asyncio.create_task(serve_shard(dp, bot, updates, acks, edits=Debouncer(0.5)))
+        await asyncio.sleep(0.15)
+        send(message=message(2, 2, "-", reply_to_message=message(2, 1, "кофе 200")))
+        # another message's edit is not cancelled
+        send(message=message(2, 3, "чай 50"))
+        send(edited_message=message(2, 3, "чай 60", edit_date=0))
+        updates.put(None)
+        await serving
+        await bot.session.close()
+
+        assert [h for h in handled if h[0] == 1] == [(1, "record"), (1, "delete")]
+        assert [h for h in handled if h[0] == 2] == [(2, "record"), (2, "delete"), (2, "record"), (2, "edit")]
+        # the deletes went without waiting out the edits' window, only the last edit did
+        assert time.monotonic() - started < 1
+        assert sorted(acks.get_nowait() for _ in range(8)) == list(range(8))
+
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+import asyncio
+import csv
+import io
+import zipfile
+from datetime import datetime
+
+import pytest
+
+from telegrind.export import export
+from telegrind.fakes import FakeClientManager
+from telegrind.sheets import Outcome
+
+ROWS = [
+    Outcome.headers,
+    # unformatted, the date is a serial number
+    [1, 500, "KZT", 45000.5, "кофе", "Еда"],
+    [2, "1 200,5", "KZT", "12.03.24 10:15", "такси"],
+    ["", "", ""],
+    [3.0, 300, "KZT", 45001, "", "Еда"],
+]
+EXPECTED = [
+    ["1", 500.0, "KZT", datetime(2023, 3, 15, 12), "кофе", "Еда"],
+    ["2", 1200.5, "KZT", datetime(2024, 3, 12, 10, 15), "такси", None],
+    ["3", 300.0, "KZT", datetime(2023, 3, 16), None, "Еда"],
+]
+
+
+def exported(fmt: str, path) -> dict[str, int]:
+    async def main():
+        agcm = FakeClientManager()
+        ags = await agcm.client.open_by_url("https://fake/export")
+        for title, rows in (("Expenses", ROWS), ("Expenses 2023", ROWS[:2]), ("Notes", [["not the bot's"]])):
+            (await ags.add_worksheet(title, 1, 1)).rows = [list(r) for r in rows]
+        # several chunks of a worksheet, read in several requests
+        result = await export(ags, path, fmt, chunk_rows=2, batch_rows=2)
+        assert agcm.api.calls["values_batch_get"] == 4
+        return result
+
+    return asyncio.run(main())
+
+
+def test_csv(tmp_path):
+    path = tmp_path / "export.csv.zip"
+    assert exported("csv", path) == {"Expenses": 3, "Expenses 2023": 1}
+    with zipfile.ZipFile(path) as z:
+        assert z.namelist() == ["Expenses.csv", "Expenses 2023.csv"]
+        rows = list(csv.reader(io.TextIOWrapper(z.open("Expenses.csv"), encoding="utf-8-sig")))
+    assert rows == [
+        Outcome.headers,
+        ["1", "500.0", "KZT", "2023-03-15 12:00", "кофе", "Еда"],
+        ["2", "1200.5", "KZT", "2024-03-12 10:15", "такси", ""],
+        ["3", "300.0", "KZT", "2023-03-16 00:00", "", "Еда"],
+    ]
+
+
+def test_xlsx(tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    path = tmp_path / "export.xlsx"
+    assert exported("xlsx", path) == {"Expenses": 3, "Expenses 2023": 1}
+    book = openpyxl.load_workbook(path)
+    assert book.sheetnames == ["Expenses", "Expenses 2023"]
+    rows = [list(r) for r in book["Expenses"].iter_rows(values_only=True)]
+    assert rows == [Outcome.headers, *EXPECTED]
+
+
+def test_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "export.parquet.zip"
+    assert exported("parquet", path) == {"Expenses": 3, "Expenses 2023": 1}
+    with zipfile.ZipFile(path) as z:
+        assert z.namelist() == ["Expenses.parquet", "Expenses 2023.parquet"]
+        table = pq.read_table(io.BytesIO(z.read("Expenses.parquet")))
+    assert table.column_names == Outcome.headers
+    assert [list(r.values()) for r in table.to_pylist()] == EXPECTED
+    # the part file is gone
+    assert [p.name for p in tmp_path.iterdir()] == [path.name]
@@ -0,0 +1,25 @@
+from telegrind.index import RowIndex
+from telegrind.sheets import Outcome, Loan
+
+
+def test_remove_shifts_rows_below(db, chat_id):
+    async def test(engine, async_session):
+        index = RowIndex(async_session)
+        # messages 1..10 in rows 2..11, and a loan sheet left alone
+        await index.add(chat_id, Outcome.ws_name, list(range(1, 11)), 2)
+        await index.add(chat_id, Loan.ws_name, [11, 12], 2)
+
+        async def rows() -> dict[int, int]:
+            return {m: ref.row_id for m in range(1, 13) if (ref := await index.get(chat_id, m))}
+
+        await index.remove(chat_id, Outcome.ws_name, 3)
+        assert await rows() == {1: 2, 3: 3, 4: 4, 5: 5, 6: 6, 7: 7, 8: 8, 9: 9, 10: 10, 11: 2, 12: 3}
+
+        # rows of messages 4, 5 and 8, given in any order
+        await index.remove(chat_id, Outcome.ws_name, 8, 4, 5, 4)
+        assert await rows() == {1: 2, 3: 3, 6: 4, 7: 5, 9: 6, 10: 7, 11: 2, 12: 3}
+
+        await index.remove(chat_id, Outcome.ws_name)
+        assert await rows() == {1: 2, 3: 3, 6: 4, 7: 5, 9: 6, 10: 7, 11: 2, 12: 3}
+
+    db(test)
@@ -0,0 +1,119 @@
+from datetime import datetime
+
+import pytest
+from aiogram import Bot
+from aiogram.types import Message
+
+from telegrind.bot.handlers import kaspi as handler
+from telegrind.fakes import FakeClientManager, FakeSession
+from telegrind.kaspi import parse_lines, parse_statement
+from telegrind.mirror import Mirror
+from telegrind.models import Chat
+from telegrind.sheets import Outcome, open_spreadsheet
+
+PAGES = [
+    [
+        "Выписка по Kaspi Gold",
+        "12.03.24 - 2 500,00 ₸ Покупки ИП Кафе",
+        "13.03.24 + 10 000,00 ₸ Пополнение С Kaspi Депозита",
+        "12.03.24 - 2 500,00 ₸ Покупки ИП Кафе",
+    ],
+    [
+        "14.03.24 - 1 200,50 ₸ Покупки Magnum",
+        "15.03.24 - 15 000,00 ₸ Переводы Айгуль А.",
+        "15.03.24 - 300,00 ₸ Покупки Автобус",
+    ],
+]
+
+
+def pdf(pages: list[list[str]]) -> bytes:
+    """Statement made of text lines, fonts map their codes back to the characters as Kaspi's do."""
+    chars = sorted({c for page in pages for line in page for c in line})
+    codes = {c: i + 1 for i, c in enumerate(chars)}
+    cmap = "\n".join([
+        "/CIDInit /ProcSet findresource begin 12 dict begin begincmap",
+        "/CMapName /Statement def 1 begincodespacerange <00> <FF> endcodespacerange",
+        f"{len(chars)} beginbfchar",
+        *(f"<{codes[c]:02X}> <{ord(c):04X}>" for c in chars),
+        "endbfchar endcmap CMapName currentdict /CMap defineresource pop end end",
+    ]).encode()
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /ToUnicode 4 0 R >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(cmap), cmap),
+    ]
+    kids = []
+    for page in pages:
+        text = " ".join(f"<{''.join(f'{codes[c]:02X}' for c in line)}> Tj 0 -14 Td" for line in page)
+        content = f"BT /F1 10 Tf 40 800 Td {text} ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R"
+            b" /Resources << /Font << /F1 3 0 R >> >> >>" % len(objects)
+        )
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (i, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def test_parse_lines():
+    records = list(parse_lines(PAGES[0]))
+    # expenses only, the same purchase twice a day is two records
+    assert [(r["date"], r["amount"], r["desc"]) for r in records] == [
+        (datetime(2024, 3, 12), 2500, "Покупки ИП Кафе"),
+        (datetime(2024, 3, 12), 2500, "Покупки ИП Кафе"),
+    ]
+    assert records[0]["key"] != records[1]["key"]
+    # the same keys when imported again
+    assert [r["key"] for r in parse_lines(PAGES[0])] == [r["key"] for r in records]
+
+
+def test_parse_statement(tmp_path):
+    pytest.importorskip("pypdf")
+    path = tmp_path / "statement.pdf"
+    path.write_bytes(pdf(PAGES))
+    records = list(parse_statement(path))
+    assert [r["amount"] for r in records] == [2500, 2500, 1200.5, 15000, 300]
+    assert [r["key"] for r in records] == [r["key"] for r in parse_lines(PAGES[0] + PAGES[1])]
+
+
+def test_import_in_chunks_skipping_known(db, chat_id, monkeypatch):
+    pytest.importorskip("pypdf")
+    monkeypatch.setattr(handler, "CHUNK_SIZE", 2)
+
+    async def test(engine, async_session):
+        agcm, bot = FakeClientManager(), Bot("42:TEST", session=FakeSession(files={"statement": pdf(PAGES)}))
+        chat = Chat(chat_id=chat_id, sheet_url=f"https://fake/{chat_id}")
+        ags = await open_spreadsheet(await agcm.authorize(), chat.chat_id, chat.sheet_url)
+        keys = [r["key"] for r in parse_lines(PAGES[0] + PAGES[1])]
+        # imported before: one still in the sheet, one moved to an archive since
+        await Outcome(ags).get_agw()
+        await Outcome(ags).archive(2024).get_agw()
+        ags.sheets[Outcome.ws_name].rows.append([keys[0]])
+        ags.sheets[f"{Outcome.ws_name} 2024"].rows.append([keys[1]])
+
+        message = Message.model_validate(
+            dict(
+                message_id=1, date=datetime.now(), chat=dict(id=chat_id, type="private"),
+                document=dict(file_id="statement", file_unique_id="statement", mime_type="application/pdf"),
+            ),
+            context={"bot": bot},
+        )
+        reply = await handler.import_kaspi_statement(message, bot, agcm.client, chat, Mirror(async_session))
+        assert reply.text == "Записала 3 расходов из выписки! Ещё 2 уже были в книге."
+        # the first chunk is known, the other two are appended a request each
+        assert agcm.api.calls["append_rows"] == 2
+        assert [r[0] for r in ags.sheets[Outcome.ws_name].rows] == ["#", *keys[:1], *keys[2:]]
+        await bot.session.close()
+
+    db(test)
+
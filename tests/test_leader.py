@@ -0,0 +1,88 @@
+import asyncio
+
+from sqlalchemy import select, func, text
+
+from telegrind import cache
+from telegrind.bot.storage import PgStorage, CHATS_CHANNEL
+from telegrind.leader import Leader
+
+# far from leader.LOCK, so that a running bot keeps its own
+LOCK = 0x7465_7374
+
+
+def test_failover(db, chat_id):
+    async def test(engine, async_session):
+        runs = []
+
+        async def job(name: str):
+            runs.append(name)
+            await asyncio.Future()
+
+        first = Leader(engine, LOCK + chat_id, retry_interval=0.05, check_interval=0.05)
+        second = Leader(engine, LOCK + chat_id, retry_interval=0.05, check_interval=0.05)
+        leading = asyncio.create_task(first.run(lambda: job("first")))
+        await asyncio.sleep(0.2)
+        waiting = asyncio.create_task(second.run(lambda: job("second")))
+        await asyncio.sleep(0.2)
+        assert (first.leading, second.leading, runs) == (True, False, ["first"])
+
+        # e.g. the instance is gone
+        leading.cancel()
+        await asyncio.gather(leading, return_exceptions=True)
+        await asyncio.sleep(0.3)
+        assert (first.leading, second.leading, runs) == (False, True, ["first", "second"])
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+
+    db(test)
+
+
+def test_failed_job_restarted(db, chat_id):
+    async def test(engine, async_session):
+        runs = 0
+
+        async def job():
+            nonlocal runs
+            runs += 1
+            if runs == 1:
+                raise ConnectionError("e.g. the database went away")
+            await asyncio.Future()
+
+        leader = Leader(engine, LOCK + chat_id, retry_interval=0.05, check_interval=0.05)
+        leading = asyncio.create_task(leader.run(job))
+        await asyncio.sleep(0.5)
+        # started again, and still the leader
+        assert runs == 2 and leader.leading
+        leading.cancel()
+        await asyncio.gather(leading, return_exceptions=True)
+
+    db(test)
+
+
+def test_listen_again_when_disconnected(db, chat_id, caplog):
+    async def test(engine, async_session):
+        storage = PgStorage(engine, async_session)
+        listening = asyncio.create_task(storage.listen(check_interval=0.05, retry_interval=0.05))
+
+        async def notified() -> bool:
+            cache.chats.set(chat_id, "stale")
+            async with engine.begin() as conn:
+                await conn.execute(select(func.pg_notify(CHATS_CHANNEL, str(chat_id))))
+            await asyncio.sleep(0.1)
+            return cache.chats.get(chat_id) is None
+
+        await asyncio.sleep(0.2)
+        assert await notified()
+        async with engine.begin() as conn:
+            await conn.execute(text(
+                # the listening connection, it is the one pinging
+                "select pg_terminate_backend(pid) from pg_stat_activity"
+                " where pid <> pg_backend_pid() and datname = current_database() and query = 'SELECT 1'"
+            ))
+        await asyncio.sleep(0.3)
+        assert "stopped listening to other instances" in caplog.text
+        assert await notified()
+        listening.cancel()
+        await asyncio.gather(listening, return_exceptions=True)
+
+    db(test)
@@ -0,0 +1,48 @@
+import asyncio
+
+import aiohttp
+
+from telegrind import metrics
+
+
+def test_metrics_endpoint():
+    async def main():
+        latency = metrics.Histogram("test_handler_seconds", "Test handler.", ("handler",), buckets=(0.01, 0.1))
+        errors = metrics.Counter("test_errors_total", "Test errors.", ("status",))
+        try:
+            with metrics.collect_spans() as spans:
+                latency.observe(0.005, handler="record")
+                latency.observe(0.05, handler="record")
+                latency.observe(5, handler="record")
+            errors.inc(status='quota "exceeded"\n')
+            errors.inc(2, status='quota "exceeded"\n')
+            # the update being handled gets them too
+            assert metrics.format_spans(spans[:2]) == "test_handler[record] 0.005s, test_handler[record] 0.050s"
+
+            runner = await metrics.serve(host="127.0.0.1", port=0)
+            port = runner.addresses[0][1]
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                    assert response.content_type == "text/plain"
+                    text = await response.text()
+            await runner.cleanup()
+        finally:
+            metrics.registry.remove(latency)
+            metrics.registry.remove(errors)
+
+        assert "\n".join([
+            "# HELP test_handler_seconds Test handler.",
+            "# TYPE test_handler_seconds histogram",
+            'test_handler_seconds_bucket{handler="record",le="0.01"} 1',
+            'test_handler_seconds_bucket{handler="record",le="0.1"} 2',
+            'test_handler_seconds_bucket{handler="record",le="+Inf"} 3',
+            'test_handler_seconds_sum{handler="record"} 5.055',
+            'test_handler_seconds_count{handler="record"} 3',
+            "# HELP test_errors_total Test errors.",
+            "# TYPE test_errors_total counter",
+            'test_errors_total{status="quota \\"exceeded\\"\\n"} 3.0',
+        ]) in text
+        # every metric of the process is there
+        assert "# TYPE telegrind_sheets_queue gauge" in text
+
+    asyncio.run(main())
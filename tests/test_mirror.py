@@ -0,0 +1,49 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import select
+
+from telegrind.fakes import FakeClientManager
+from telegrind.index import RowIndex
+from telegrind.mirror import Mirror
+from telegrind.models import Record
+from telegrind.outbox import Outbox
+from telegrind.sheets import Outcome, open_spreadsheet
+
+SENT = datetime(2024, 3, 12, 10, 15, tzinfo=timezone.utc)
+
+
+def test_sync_picks_up_hand_edits(db, chat_id):
+    async def test(engine, async_session):
+        ags = await open_spreadsheet(await FakeClientManager().authorize(), chat_id, f"https://fake/{chat_id}")
+        sheet, mirror = Outcome(ags), Mirror(async_session)
+        await sheet.get_agw()
+        expenses = ags.sheets[Outcome.ws_name].rows
+        rows = [[1, 100, "KZT", "12.03.24 10:15", "кофе"], [2, 2500, "KZT", "12.03.24 13:00", "обед"]]
+        expenses += [list(r) for r in rows]
+        await mirror.put(chat_id, sheet, rows, sent_at=SENT)
+        assert await mirror.sync(chat_id, sheet) == 0
+
+        # one edited and one deleted by hand, one added, and one queued that is not in the sheet yet
+        expenses[1][1] = 150
+        del expenses[2]
+        expenses.append([3, "1 200,5", "usd", "13.03.24 09:00", "такси"])
+        outbox = Outbox(engine, async_session, RowIndex(async_session))
+        await outbox.put(chat_id, f"https://fake/{chat_id}", [(Outcome, [[4, 50, "KZT", "13.03.24 10:00", "чай"]])])
+        await mirror.put(chat_id, sheet, [[4, 50, "KZT", "13.03.24 10:00", "чай"]])
+        assert await mirror.sync(chat_id, sheet) == 3
+
+        async with async_session() as session:
+            result = await session.execute(
+                select(Record.key, Record.amount, Record.currency, Record.sent_at)
+                .where(Record.chat_id == chat_id).order_by(Record.key)
+            )
+            assert result.all() == [
+                # the time the message was sent is kept
+                ("1", 150, "KZT", SENT),
+                ("3", 1200.5, "USD", None),
+                ("4", 50, "KZT", None),
+            ]
+        assert await mirror.sync(chat_id, sheet) == 0
+        await outbox.discard(chat_id, 4)
+
+    db(test)
@@ -0,0 +1,161 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from aiogram import Bot
+from aiogram.types import Message
+from sqlalchemy import update, func
+
+from telegrind.bot.handlers.reports import pending
+from telegrind.fakes import FakeClientManager, FakeSession
+from telegrind.index import RowIndex
+from telegrind.models import Chat, OutboxRow
+from telegrind.outbox import Outbox
+from telegrind.sheets import Config, ConfigSheet, Outcome, open_spreadsheet
+
+
+def expense(message_id: int) -> list:
+    return [message_id, 100, "KZT", "12.03.24 10:15", "кофе"]
+
+
+async def setup(async_session, chat_id: int):
+    agcm = FakeClientManager()
+    chat = Chat(chat_id=chat_id, sheet_url=f"https://fake/{chat_id}")
+    ags = await open_spreadsheet(await agcm.authorize(), chat.chat_id, chat.sheet_url)
+    await Outcome(ags).get_agw()
+    return agcm, chat, ags
+
+
+def test_rows_indexed_where_they_went(db, chat_id):
+    async def test(engine, async_session):
+        agcm, chat, ags = await setup(async_session, chat_id)
+        index = RowIndex(async_session)
+        outbox = Outbox(engine, async_session, index)
+        expenses = ags.sheets[Outcome.ws_name].rows
+        # a note added by hand, without a '#': the rows go below it, not right after the last '#'
+        expenses += [expense(1), ["", "", "", "", "заметка"]]
+        await outbox.put(chat_id, chat.sheet_url, [(Outcome, [expense(2), expense(3)])])
+        assert await outbox.deliver(agcm, (chat_id, chat.sheet_url)) == 2
+        assert [r[0] for r in expenses] == ["#", 1, "", 2, 3]
+        assert [(await index.get(chat_id, m)).row_id for m in (2, 3)] == [4, 5]
+
+    db(test)
+
+
+def test_failed_append_retried(db, chat_id):
+    async def test(engine, async_session):
+        agcm, chat, ags = await setup(async_session, chat_id)
+        outbox = Outbox(engine, async_session, RowIndex(async_session))
+        key = chat_id, chat.sheet_url
+        expenses = ags.sheets[Outcome.ws_name].rows
+        batch_update = ags.batch_update
+        outcomes = iter(["down", "timed out"])
+
+        async def flaky(body: dict) -> dict:
+            outcome = next(outcomes, None)
+            if outcome == "timed out":
+                # appended, but the response got lost
+                await batch_update(body)
+            if outcome:
+                raise ConnectionError(outcome)
+            return await batch_update(body)
+
+        ags.batch_update = flaky
+        await outbox.put(chat_id, chat.sheet_url, [(Outcome, [expense(1), expense(2)])])
+        assert await outbox.deliver(agcm, key) == 0
+        count, _, error = await outbox.stats(chat_id)
+        assert (count, error) == (2, "down")
+        # left alone until its backoff is over
+        assert key in outbox._retry_at and outbox._failures[key] == 1
+
+        assert await outbox.deliver(agcm, key) == 0
+        assert [r[0] for r in expenses] == ["#", 1, 2]
+        # a third message came meanwhile, the first two are in the sheet already and not appended again
+        await outbox.put(chat_id, chat.sheet_url, [(Outcome, [expense(3)])])
+        delivered = []
+
+        async def report(chat_id: int, message_ids: list[int]):
+            delivered.append(message_ids)
+
+        assert await outbox.deliver(agcm, key, report) == 3
+        assert [r[0] for r in expenses] == ["#", 1, 2, 3]
+        assert delivered == [[1, 2, 3]]
+        assert key not in outbox._failures
+        assert (await outbox.stats(chat_id))[0] == 0
+
+    db(test)
+
+
+def test_interrupted_claims_released(db, chat_id):
+    async def test(engine, async_session):
+        outbox = Outbox(engine, async_session, RowIndex(async_session), lease=60)
+        await outbox.put(chat_id, "https://fake/released", [(Outcome, [expense(1), expense(2)])])
+        async with async_session() as session:
+            async with session.begin():
+                # one claimed by a deliverer that crashed, one by a live one
+                for message_id, claimed in ((1, timedelta(minutes=5)), (2, timedelta(seconds=1))):
+                    await session.execute(
+                        update(OutboxRow)
+                        .where(OutboxRow.chat_id == chat_id, OutboxRow.message_id == message_id)
+                        .values(sending=True, claimed_at=func.now() - claimed)
+                    )
+        # other tests' claims may go too
+        assert await outbox.release() >= 1
+        assert await outbox.pending(chat_id, 1) is not None
+        # still being appended, edits go to the sheet
+        assert await outbox.pending(chat_id, 2) is None
+        assert await outbox.discard(chat_id, 1, 2) == [(1, Outcome.ws_name)]
+        async with async_session() as session:
+            async with session.begin():
+                await session.execute(update(OutboxRow).where(OutboxRow.chat_id == chat_id).values(sending=False))
+        assert await outbox.discard(chat_id, 2) == [(2, Outcome.ws_name)]
+
+    db(test)
+
+
+def test_drain_concurrency(db, chat_id):
+    async def test(engine, async_session):
+        outbox = Outbox(engine, async_session, RowIndex(async_session), concurrency=2)
+        sheets = {(chat_id, f"https://fake/{chat_id}/{i}") for i in range(5)}
+        for _, sheet_url in sheets:
+            await outbox.put(chat_id, sheet_url, [(Outcome, [expense(1)])])
+        running, most, keys = 0, 0, []
+
+        async def deliver(agcm, key, delivered=None) -> int:
+            nonlocal running, most
+            running += 1
+            most = max(most, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            keys.append(key)
+            return 1
+
+        outbox.deliver = deliver
+        await outbox.drain(FakeClientManager())
+        # every sheet, other tests' ones included
+        assert sheets <= set(keys)
+        assert most == 2
+        await outbox.discard(chat_id, 1)
+
+    db(test)
+
+
+def test_pending_in_chat_time(db, chat_id):
+    async def test(engine, async_session):
+        agcm, chat, ags = await setup(async_session, chat_id)
+        outbox = Outbox(engine, async_session, RowIndex(async_session))
+        await ConfigSheet(ags).write_data(Config(dt_offset=3))
+        await outbox.put(chat_id, chat.sheet_url, [(Outcome, [expense(1)])])
+        _, oldest, _ = await outbox.stats(chat_id)
+
+        bot = Bot("42:TEST", session=FakeSession())
+        message = Message.model_validate(
+            dict(message_id=1, date=datetime.now(), chat=dict(id=chat_id, type="private"), text="/pending"),
+            context={"bot": bot},
+        )
+        reply = await pending(message, chat, outbox, agcm.client)
+        local = oldest.astimezone(timezone(timedelta(hours=3)))
+        assert reply.text == f"Ждут записи в таблицу: 1, самая давняя с {local:%d.%m.%y %H:%M}"
+        await outbox.discard(chat_id, 1)
+        await bot.session.close()
+
+    db(test)
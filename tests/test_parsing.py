@@ -0,0 +1,42 @@
+import asyncio
+from datetime import datetime
+
+from aiogram.types import Message
+
+from telegrind.fakes import FakeClientManager
+from telegrind.parsing import LOAN, OUTCOME, WISH, Parsed, classify
+from telegrind.sheets import Loan, Outcome, Wish
+
+
+def test_classify():
+    assert classify("500 кофе") == Parsed(OUTCOME, amount=500, description="кофе")
+    assert classify("2500,5 usd обед #Еда 12.03") == Parsed(
+        OUTCOME, amount=2500.5, currency="USD", description="обед 12.03", category="еда"
+    )
+    assert classify("долг Асель -5000 kzt 12.03.2024 за билеты") == Parsed(
+        LOAN, amount=-5000, currency="kzt", date="12.03.2024", counterparty="Асель", description="за билеты"
+    )
+    assert classify("займ Асель +5000").amount == 5000
+    assert classify("хочу велосипед") == Parsed(WISH, description="велосипед")
+    assert classify("привет") is None
+
+
+def test_parsed_once_for_all_filters():
+    classify.cache_clear()
+    text = "долг Асель 5000"
+    # as the router's filters ask, one after another
+    assert [s.classify(text) for s in (Outcome, Loan, Wish)] == [None, classify(text), None]
+    assert classify.cache_info().misses == 1
+
+
+def test_row_made_of_parsed_fields():
+    async def main():
+        ags = await (await FakeClientManager().authorize()).open_by_url("https://fake/parsed")
+        message = Message.model_validate(dict(
+            message_id=1, date=datetime.now(), chat=dict(id=1, type="private"), text="долг Асель 5000",
+        ))
+        # a language model's reading of the text, not parsed again
+        parsed = Parsed(LOAN, amount=-300, currency="USD", date="12.03.2024", counterparty="Асель", description="кино")
+        assert await Loan(ags).make_row(message, parsed) == [1, -300, "USD", "Асель", "12.03.24 00:00", "кино"]
+
+    asyncio.run(main())
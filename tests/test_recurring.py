@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta, timezone
+
+from telegrind.models import RecurringPayment
+from telegrind.recurring import Reminders, next_due, parse
+
+T0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def at(hours: int) -> datetime:
+    return T0 + timedelta(hours=hours)
+
+
+def test_due_in_order_stale_entries_dropped():
+    reminders = Reminders(None, None)
+    for payment_id, hours in ((1, 5), (2, 1), (3, 3), (4, 2)):
+        reminders.schedule(payment_id, at(hours))
+    # moved later and removed, their old heap entries stay behind
+    reminders.schedule(3, at(10))
+    reminders.unschedule(4)
+
+    assert reminders.pop_due(at(0)) == []
+    assert reminders.pop_due(at(5)) == [2, 1]
+    assert reminders.pop_due(at(9)) == []
+    assert reminders.pop_due(at(10)) == [3]
+    assert not reminders._heap and not reminders._due
+
+
+def test_next_due():
+    # 10:00 in the chat's time, UTC+5 here
+    assert next_due(15, 5, datetime(2024, 3, 15, 4, 59, tzinfo=timezone.utc)) == datetime(
+        2024, 3, 15, 10, tzinfo=timezone(timedelta(hours=5))
+    )
+    assert next_due(15, 5, datetime(2024, 3, 15, 5, tzinfo=timezone.utc)).date() == datetime(2024, 4, 15).date()
+    # short months on their last day, across the year
+    assert next_due(31, 0, datetime(2024, 2, 1, tzinfo=timezone.utc)).date() == datetime(2024, 2, 29).date()
+    assert next_due(31, 0, datetime(2024, 12, 31, 11, tzinfo=timezone.utc)).date() == datetime(2025, 1, 31).date()
+
+
+def test_parse():
+    assert parse("15 5000 usd интернет #Связь") == dict(
+        day=15, amount=5000, currency="USD", title="интернет", category="связь"
+    )
+    assert parse("1 9,99 #подписки") == dict(day=1, amount=9.99, currency=None, title="подписки", category="подписки")
+    assert parse("32 100 аренда") is None
+    assert parse("аренда 100") is None
+
+
+def test_missed_reminded_once_after_restart(db, chat_id):
+    async def test(engine, async_session):
+        now = datetime.now(timezone.utc)
+        async with async_session() as session:
+            async with session.begin():
+                payments = [
+                    RecurringPayment(
+                        chat_id=chat_id, title=title, amount=100, currency="KZT", day=1, dt_offset=0, next_due=due
+                    )
+                    for title, due in (("интернет", now - timedelta(days=40)), ("аренда", now - timedelta(hours=1)),
+                                       ("связь", now + timedelta(days=1)))
+                ]
+                session.add_all(payments)
+            ids = [p.id for p in payments]
+
+        # a new process picks them up from the database
+        reminders = Reminders(engine, async_session)
+        await reminders.load(ids)
+        missed = reminders.pop_due(now)
+        assert missed == ids[:2]
+        sent = []
+
+        async def send(chat_id: int, items: list[RecurringPayment]):
+            sent.append((chat_id, sorted(p.title for p in items)))
+
+        await reminders.fire(send, missed)
+        # one message for both, the months missed are not repeated
+        assert sent == [(chat_id, ["аренда", "интернет"])]
+        assert sorted(reminders._due) == ids
+        assert reminders._due[ids[0]] == next_due(1, 0, now)
+        # another instance firing them too finds them moved already
+        await Reminders(engine, async_session).fire(send, missed)
+        assert len(sent) == 1
+
+    db(test)
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from telegrind import metrics
+from telegrind.scheduler import Scheduler, TokenBucket, background
+
+
+def test_bucket_refill():
+    bucket = TokenBucket(per_minute=60, burst=2)
+    bucket.updated = 0
+    assert bucket.delay(0) == 0
+    bucket.take()
+    bucket.take()
+    # a token a second
+    assert bucket.delay(0) == 1
+    assert bucket.delay(0.25) == 0.75
+    assert bucket.delay(1) == 0
+    # no more than the burst however long idle
+    assert bucket.delay(100) == 0 and bucket.tokens == 2 and bucket.full
+    bucket.drain()
+    assert bucket.delay(100) == 1
+
+
+def test_interactive_first_then_in_order():
+    async def main():
+        # a call every 20ms, the first one right away
+        scheduler = Scheduler(account_per_minute=3000, burst=1)
+        order = []
+
+        async def call(name: str, spreadsheet_id: str | None = None):
+            await scheduler.acquire(spreadsheet_id, "write")
+            order.append(name)
+
+        async def export(name: str):
+            with background():
+                await call(name)
+
+        started = time.monotonic()
+        await asyncio.gather(call("first"), export("export 1"), export("export 2"), call("record 1"), call("record 2"))
+        assert order == ["first", "record 1", "record 2", "export 1", "export 2"]
+        assert time.monotonic() - started >= 0.07
+        assert scheduler.calls == 5
+        # gone through, nothing is waiting
+        assert metrics.sheets_queue.values[("background",)] == 0
+
+    asyncio.run(main())
+
+
+def test_reserved_bucket_not_taken_by_later_calls():
+    async def main():
+        scheduler = Scheduler(account_per_minute=60000, spreadsheet_per_minute=600, burst=1)
+        order = []
+
+        async def call(name: str, spreadsheet_id: str, kind: str = "write"):
+            await scheduler.acquire(spreadsheet_id, kind)
+            order.append(name)
+
+        await call("a", "A")
+        with background():
+            waiting = asyncio.gather(call("b", "A"), call("c", "A"))
+        # the spreadsheet's bucket is empty: the next of its calls waits, others go meanwhile
+        await asyncio.sleep(0.01)
+        assert metrics.sheets_queue.values[("background",)] == 2
+        await asyncio.gather(call("d", "B"), call("e", "A", "read"))
+        await waiting
+        assert order == ["a", "d", "e", "b", "c"]
+
+    asyncio.run(main())
@@ -0,0 +1,127 @@
+import asyncio
+import itertools
+import multiprocessing as mp
+import os
+import random
+import time
+from functools import partial
+from queue import Empty
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message, Update
+
+from telegrind.bot.sharding import Supervisor, serve_shard, is_barrier, is_edit, edited_of, deleted_of
+from telegrind.fakes import FakeSession
+
+CHATS = range(1, 7)
+
+
+class Feeder:
+    """Makes up updates of chats, as Telegram sends them to the supervisor."""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def message(self, chat_id: int, text: str, **extra) -> dict:
+        return dict(
+            message_id=next(self._message_ids),
+            date=int(time.time()),
+            chat=dict(id=chat_id, type="private"),
+            **{"from": dict(id=chat_id, is_bot=False, first_name="Test")},
+            text=text,
+            **extra,
+        )
+
+    def update(self, **event) -> dict:
+        return dict(update_id=next(self._update_ids), **event)
+
+
+def worker(handled: mp.Queue, crashed, queue: mp.Queue, acks: mp.Queue, shard: int) -> None:
+    asyncio.run(serve(handled, crashed, queue, acks))
+
+
+async def serve(handled: mp.Queue, crashed, queue: mp.Queue, acks: mp.Queue) -> None:
+    dp = Dispatcher()
+
+    @dp.message()
+    @dp.edited_message()
+    async def record(message: Message, event_update: Update):
+        if message.text == "crash" and not crashed.is_set():
+            crashed.set()
+            # after the updates handled so far got out, as a crash between them would
+            time.sleep(0.5)
+            os._exit(1)
+        await asyncio.sleep(random.uniform(0, 0.01))
+        handled.put(event_update.update_id)
+
+    bot = Bot("42:TEST", session=FakeSession())
+    await serve_shard(dp, bot, queue, acks)
+    await bot.session.close()
+
+
+def updates(feeder: Feeder, messages: int) -> list[dict]:
+    """Every chat sends and edits its messages, taking back every other one, chats interleaved."""
+    events = []
+    for i in range(messages):
+        for chat_id in CHATS:
+            message = feeder.message(chat_id, "crash" if (chat_id, i) == (1, messages // 2) else f"{i} кофе")
+            events += [
+                feeder.update(message=message),
+                feeder.update(edited_message=dict(message, text=f"2{message['text']}", edit_date=message["date"])),
+            ]
+            if i % 2:
+                events.append(feeder.update(message=feeder.message(chat_id, "-", reply_to_message=message)))
+    return events
+
+
+def kept(events: list[dict]) -> set[int]:
+    """Updates which must be handled: all but the edits of messages taken back, which may be dropped."""
+    deleted = {deleted_of(e) for e in events} - {None}
+    return {e["update_id"] for e in events if edited_of(e) not in deleted}
+
+
+def run(events: list[dict], workers: int, timeout: float = 30) -> list[int]:
+    expected = kept(events)
+    ctx = mp.get_context("spawn")
+    handled, crashed = ctx.Queue(), ctx.Event()
+
+    async def main() -> list[int]:
+        supervisor = Supervisor(workers, partial(worker, handled, crashed))
+        supervisor.start()
+        watcher = asyncio.create_task(supervisor.watch(0.1))
+        for event in events:
+            supervisor.route(event)
+        order, deadline = [], time.monotonic() + timeout
+        while not expected <= set(order) and time.monotonic() < deadline:
+            try:
+                order.append(await asyncio.to_thread(handled.get, timeout=1))
+            except Empty:
+                pass
+        watcher.cancel()
+        await supervisor.stop()
+        return order
+
+    return asyncio.run(main())
+
+
+def test_chat_order_across_workers_and_crash():
+    events = updates(Feeder(), messages=10)
+    order = run(events, workers=2)
+
+    # handled before the crash and again after it, the first time counts
+    first = {}
+    for i, update_id in enumerate(order):
+        first.setdefault(update_id, i)
+    assert kept(events) <= set(first) <= {e["update_id"] for e in events}
+
+    for chat_id in CHATS:
+        chat = [e for e in events if (e.get("message") or e.get("edited_message"))["chat"]["id"] == chat_id]
+        for k, later in enumerate(chat):
+            for earlier in chat[:k]:
+                # as ChatOrder runs them: edits and deletes wait for everything before,
+                # and everything waits for them, but edits don't wait for each other
+                if earlier["update_id"] not in first or later["update_id"] not in first:
+                    continue
+                if (is_barrier(later) or is_barrier(earlier)) and not (is_edit(later) and is_edit(earlier)):
+                    assert first[earlier["update_id"]] < first[later["update_id"]], (earlier, later)
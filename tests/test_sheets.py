@@ -0,0 +1,34 @@
+import asyncio
+
+from telegrind.fakes import FakeClientManager
+from telegrind.sheets import Outcome, runs
+
+
+def test_runs():
+    assert runs([]) == []
+    assert runs([2, 3, 4, 7, 9, 10]) == [(2, 5), (7, 8), (9, 11)]
+
+
+def test_delete_rows():
+    async def test():
+        ags = await (await FakeClientManager().authorize()).open_by_url("https://fake/delete")
+        sheet = Outcome(ags)
+        agw, _ = await sheet.get_agw()
+        agw.rows += [[i, 100 * i] for i in range(1, 11)]
+        bodies = []
+        batch_update = ags.batch_update
+
+        async def capture(body: dict) -> dict:
+            bodies.append(body)
+            return await batch_update(body)
+
+        ags.batch_update = capture
+        await sheet.delete_rows([9, 3, 4, 11, 6])
+        # a single request, whatever the order and runs of rows, bottom up
+        assert bodies == [{"requests": [
+            {"deleteDimension": {"range": {"sheetId": agw.id, "dimension": "ROWS", "startIndex": s, "endIndex": e}}}
+            for s, e in [(10, 11), (8, 9), (5, 6), (2, 4)]
+        ]}]
+        assert [r[0] for r in agw.rows] == ["#", 1, 4, 6, 7, 9]
+
+    asyncio.run(test())
@@ -0,0 +1,38 @@
+import os
+
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table, inspect
+
+from telegrind.startup import ensure_schema
+
+TABLE = f"test_schema_{os.getpid()}"
+
+
+def schema(*extra) -> MetaData:
+    metadata = MetaData()
+    Table(TABLE, metadata, Column("id", Integer, primary_key=True), Column("name", String), *extra)
+    return metadata
+
+
+def test_missing_column_and_index_added(db):
+    async def test(engine, async_session):
+        async def columns() -> tuple[list[str], list[str]]:
+            async with engine.connect() as conn:
+                return await conn.run_sync(lambda c: (
+                    [col["name"] for col in inspect(c).get_columns(TABLE)],
+                    [i["name"] for i in inspect(c).get_indexes(TABLE)],
+                ))
+
+        old = schema()
+        try:
+            assert await ensure_schema(engine, old)
+            assert not await ensure_schema(engine, old)
+            # a new version of the model, the table is there already
+            new = schema(Column("note", String, server_default="-"), Index(f"ix_{TABLE}_name", "name"))
+            assert await ensure_schema(engine, new)
+            assert await columns() == (["id", "name", "note"], [f"ix_{TABLE}_name"])
+            assert not await ensure_schema(engine, new)
+        finally:
+            async with engine.begin() as conn:
+                await conn.run_sync(old.drop_all)
+
+    db(test)
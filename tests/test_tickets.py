@@ -0,0 +1,94 @@
+import asyncio
+from collections import Counter
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.types import Message
+
+from telegrind.bot.handlers.tickets import record_ticket
+from telegrind.bot.records import delete_records
+from telegrind.debounce import Debouncer
+from telegrind.fakes import FakeClientManager, FakeFetcher, FakeSession
+from telegrind.index import RowIndex
+from telegrind.mirror import Mirror
+from telegrind.models import Chat
+from telegrind.outbox import Outbox
+from telegrind.sheets import Outcome, Commodity, open_spreadsheet
+from telegrind.tickets import TicketLog
+
+URL = "http://consumer.oofd.kz?i={}&f=1&s=300&t=20240312T101500"
+
+
+def test_ticket_written_and_deleted_whole(db, chat_id):
+    async def test(engine, async_session):
+        agcm, bot = FakeClientManager(), Bot("42:TEST", session=FakeSession())
+        chat = Chat(chat_id=chat_id, sheet_url=f"https://fake/{chat_id}")
+        index, mirror = RowIndex(async_session), Mirror(async_session)
+        outbox, tickets = Outbox(engine, async_session, index), TicketLog(async_session)
+        ags = await open_spreadsheet(await agcm.authorize(), chat.chat_id, chat.sheet_url)
+        # with their headers, and an expense before the tickets
+        await Outcome(ags).get_agw()
+        await Commodity(ags).get_agw()
+        ags.sheets[Outcome.ws_name].rows.append([1, 100])
+
+        async def send(message_id: int, ticket: int):
+            message = Message.model_validate(
+                dict(message_id=message_id, date=datetime.now(), chat=dict(id=chat_id, type="private"),
+                     text=URL.format(ticket)),
+                context={"bot": bot},
+            )
+            await record_ticket(message, URL.format(ticket), agcm.client, chat, FakeFetcher(items=3),
+                                outbox, mirror, tickets)
+
+        for message_id in (2, 3):
+            await send(message_id, ticket=message_id)
+
+        before = Counter(agcm.api.calls)
+        assert await outbox.deliver(agcm, (chat.chat_id, chat.sheet_url)) == 8
+        calls = agcm.api.calls - before
+        # the expenses and the commodities of both tickets, read and appended at once
+        assert calls == Counter(values_batch_get=1, batch_update=1)
+        expenses, commodities = ags.sheets[Outcome.ws_name].rows, ags.sheets[Commodity.ws_name].rows
+        assert [r[0] for r in expenses] == ["#", 1, 2, 3]
+        assert [r[0] for r in commodities] == ["#", 2, 2, 2, 3, 3, 3]
+        assert (await index.get(chat_id, 3)).row_id == 4
+
+        deleted = await delete_records(ags, chat, index, outbox, mirror, Debouncer(), tickets, [2])
+        assert deleted == 1
+        assert [r[0] for r in expenses] == ["#", 1, 3]
+        assert [r[0] for r in commodities] == ["#", 3, 3, 3]
+        # moved up along with its row
+        assert (await index.get(chat_id, 3)).row_id == 3
+        assert await mirror.known(chat_id, Commodity.ws_name, {2, 3}) == {3}
+
+        # the deleted receipt may be recorded again, the other one not
+        await send(4, ticket=2)
+        await send(5, ticket=3)
+        assert await outbox.deliver(agcm, (chat.chat_id, chat.sheet_url)) == 4
+        assert [r[0] for r in expenses] == ["#", 1, 3, 4]
+        await bot.session.close()
+
+    db(test)
+
+
+def test_ticket_recorded_once(db, chat_id):
+    async def test(engine, async_session):
+        tickets = TicketLog(async_session)
+        # sent twice at once, or by another instance
+        claims = await asyncio.gather(*(tickets.claim(chat_id, "1:42", m) for m in (1, 2)))
+        assert sorted(claims) == [False, True]
+        assert not await tickets.claim(chat_id, "1:42", 3)
+        # another chat's receipt
+        assert await tickets.claim(chat_id - 1, "1:42", 1)
+        await tickets.release(chat_id - 1, "1:42")
+
+        # fetching it failed
+        await tickets.release(chat_id, "1:42")
+        assert await tickets.claim(chat_id, "1:42", 3)
+        await tickets.forget(chat_id, 1, 2)
+        assert not await tickets.claim(chat_id, "1:42", 4)
+        await tickets.forget(chat_id, 3)
+        assert await tickets.claim(chat_id, "1:42", 4)
+        await tickets.forget(chat_id, 4)
+
+    db(test)
@@ -0,0 +1,54 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.types import Message
+
+from telegrind.bot.handlers.undo import forwarded_record, matches
+from telegrind.debounce import Gatherer
+from telegrind.models import Chat
+
+SENT = datetime(2024, 3, 12, 10, 15, tzinfo=timezone.utc)
+LATER = datetime(2024, 3, 12, 10, 16, tzinfo=timezone.utc)
+
+
+def test_matches():
+    records = [(1, SENT, 100), (2, SENT, 250.5), (3, SENT, None), (4, LATER, 100)]
+    assert matches(records, LATER, None) == [4]
+    assert matches(records, LATER, 999) == [4]
+    # several the same second, told apart by the amount
+    assert matches(records, SENT, 250.499) == [2]
+    # no amount, or none of them has it: unclear
+    assert matches(records, SENT, None) == [1, 2, 3]
+    assert matches(records, SENT, 7) == [1, 2, 3]
+    assert matches(records, datetime(2024, 3, 12, tzinfo=timezone.utc), 100) == []
+
+
+def forward(chat_type: str, sender_id: int, from_id: int) -> Message:
+    return Message.model_validate(dict(
+        message_id=10, date=LATER, text="100 кофе",
+        chat=dict(id=-1 if chat_type == "group" else from_id, type=chat_type),
+        **{"from": dict(id=from_id, is_bot=False, first_name="Test")},
+        forward_origin=dict(
+            type="user", date=SENT, sender_user=dict(id=sender_id, is_bot=False, first_name="Test"),
+        ),
+    ))
+
+
+@pytest.mark.parametrize("chat_type", ["private", "group"])
+def test_only_own_forwards_deleted(chat_type):
+    async def main():
+        chat = Chat(chat_id=-1, sheet_url="https://fake/undo")
+        forwards = Gatherer(0.01)
+        # someone else's record is left alone, in a group as well
+        with pytest.raises(SkipHandler):
+            await forwarded_record(forward(chat_type, sender_id=2, from_id=1), chat, forwards)
+
+        gathered, _ = await asyncio.gather(
+            forwards.gather(chat.chat_id, None),
+            forwarded_record(forward(chat_type, sender_id=1, from_id=1), chat, forwards),
+        )
+        assert gathered == [None, (SENT, 100)]
+
+    asyncio.run(main())
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import Update
+
+from telegrind.bot.middleware import deduplicate_update
+from telegrind.bot.storage import UpdateLog
+
+
+def update(update_id: int) -> Update:
+    return Update(update_id=update_id)
+
+
+async def handle(event: Update, data: dict):
+    data.setdefault("handled", []).append(event.update_id)
+    return True
+
+
+def test_single_process_skips_database():
+    # no UpdateLog, as in plain polling, nothing to claim
+    data = dict(updates=None)
+    assert asyncio.run(deduplicate_update(handle, update(1), data)) is True
+    assert data["handled"] == [1]
+
+
+def test_update_handled_once(db, chat_id):
+    async def test(engine, async_session):
+        updates = UpdateLog(async_session)
+        data = dict(updates=updates)
+        # far from real update ids, which are positive
+        update_id = chat_id
+        first, second = await asyncio.gather(
+            deduplicate_update(handle, update(update_id), data),
+            deduplicate_update(handle, update(update_id), data),
+        )
+        assert {first, second} == {True, UNHANDLED}
+        assert data["handled"] == [update_id]
+        # redelivered after it was handled
+        assert await deduplicate_update(handle, update(update_id), data) is UNHANDLED
+
+        async def fail(event: Update, data: dict):
+            raise RuntimeError("e.g. Google is down")
+
+        # a failed update is taken again
+        with pytest.raises(RuntimeError):
+            await deduplicate_update(fail, update(update_id - 1), data)
+        assert await deduplicate_update(handle, update(update_id - 1), data) is True
+
+    db(test)
@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from telegrind.bot.webhook import DrainingRequestHandler
+from telegrind.fakes import FakeSession
+
+SECRET = "s3cret"
+
+
+def test_secret_checked_and_updates_drained():
+    async def main():
+        dp, handled = Dispatcher(), []
+
+        @dp.message()
+        async def record(message: Message):
+            await asyncio.sleep(0.05)
+            handled.append(message.text)
+
+        app = web.Application()
+        handler = DrainingRequestHandler(
+            dispatcher=dp, bot=Bot("42:TEST", session=FakeSession()), secret_token=SECRET
+        )
+        handler.register(app, path="/webhook")
+
+        def update(update_id: int, text: str) -> dict:
+            return dict(update_id=update_id, message=dict(
+                message_id=update_id, date=int(time.time()), chat=dict(id=1, type="private"), text=text,
+            ))
+
+        async with TestClient(TestServer(app)) as client:
+            for headers in ({}, {"X-Telegram-Bot-Api-Secret-Token": "wrong"}):
+                response = await client.post("/webhook", json=update(1, "forged"), headers=headers)
+                assert response.status == 401
+            response = await client.post(
+                "/webhook", json=update(2, "100 кофе"), headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}
+            )
+            # answered right away, handled in the background
+            assert response.status == 200
+            assert handled == []
+        # the update in flight was handled before the bot session got closed
+        await handler.close()
+        assert handled == ["100 кофе"]
+
+    asyncio.run(main())